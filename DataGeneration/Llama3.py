@@ -1,90 +1,488 @@
 from models import Model
+from event_log import log_event
+from pretokenize import open_pretokenized
+from option_orders import option_digits
+import copy
 import logging
+from collections import Counter, OrderedDict
 import torch
 import transformers
 from transformers import (
+    AutoModelForCausalLM,
     AutoTokenizer,
     LlamaForCausalLM,
     GenerationConfig,
     BitsAndBytesConfig,
+    DynamicCache,
 )
 
 logger = logging.getLogger(__name__)
 
 
 class Llama3(Model):
-    def __init__(self, model_name, device, token) -> None:
+    """
+    Llama 3 instruct model served with transformers.
+
+    If `assistant_model_name` is given, a small draft model with the same
+    tokenizer proposes tokens which the main model only verifies (assisted
+    decoding). Assisted decoding does not support beam search, so responses
+    are generated with a single beam while the assistant is enabled.
+
+    The KV cache is kept per conversation. With a single beam it holds the
+    prompt and the returned response, so a refinement turn only prefills the
+    turn that was appended after the response; beam search reorders the
+    cache rows, so only the prompt is kept then. A new conversation starts
+    from the longest prefix it shares with a cached one, which is at least
+    the system prompt. The cache holds at most `kv_cache_max_items`
+    conversations and `kv_cache_max_tokens` tokens, least recently used
+    first out.
+
+    With `n_samples` above 1, that many responses are sampled from one
+    prefill of the prompt (`num_return_sequences`). The samples are drawn
+    independently, so beam search is not used then.
+
+    `create_responses` generates the responses of several prompts in one
+    left padded batch. `num_threads` and `num_interop_threads` set the torch
+    CPU thread pools when the model is activated.
+
+    With `pretokenized_dir`, the first turn ids of the prompts of
+    `prompt_data_path` are read from the artifact that `pretokenize.py` built
+    for this tokenizer and `template_version`, and a refinement turn only
+    tokenizes the turns appended to it.
+
+    `option_probabilities` scores the orderings of the options of one EBE or
+    IBE item: the tokens that all orderings share are prefilled once, and the
+    differing suffixes are run in one batch on copies of that cache.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        device,
+        token,
+        assistant_model_name=None,
+        quantize=True,
+        reuse_kv_cache=True,
+        kv_cache_max_items=4,
+        kv_cache_max_tokens=16384,
+        n_samples=1,
+        num_threads=None,
+        num_interop_threads=None,
+        pretokenized_dir=None,
+        prompt_data_path=None,
+        template_version=None,
+    ) -> None:
         super().__init__()
+        if assistant_model_name is not None and n_samples > 1:
+            raise ValueError("Assisted decoding only generates one sample per prompt")
         self.model_name = model_name
         self.device = device
         self.token = token
+        self.assistant_model_name = assistant_model_name
+        # bitsandbytes 4 bit quantization needs a GPU
+        self.quantize = quantize and not str(device).startswith("cpu")
+        self.assistant_model = None
+        self.use_assistant = assistant_model_name is not None
+        self.reuse_kv_cache = reuse_kv_cache
+        self.kv_cache_max_items = kv_cache_max_items
+        self.kv_cache_max_tokens = kv_cache_max_tokens
+        self.n_samples = n_samples
+        self.num_threads = num_threads
+        self.num_interop_threads = num_interop_threads
+        self.pretokenized_dir = pretokenized_dir
+        self.prompt_data_path = prompt_data_path
+        self.template_version = template_version
+        self.pretokenized = None
+        # conversation key -> (prefilled input ids, DynamicCache of these ids)
+        self.kv_cache = OrderedDict()
 
-    def activate_model(self):
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16,
-        )
-
-        self.tokenizer = AutoTokenizer.from_pretrained(
-            self.model_name, token=self.token
-        )
-        self.model = LlamaForCausalLM.from_pretrained(
-            self.model_name,
+    def __load(self, model_class, model_name):
+        if self.quantize:
+            bnb_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            )
+        else:
+            bnb_config = None
+        model = model_class.from_pretrained(
+            model_name,
             torch_dtype=torch.bfloat16,
             quantization_config=bnb_config,
             device_map=self.device,
             token=self.token,
         )
-        self.model.eval()
+        model.eval()
+        return model
 
+    def __set_threads(self):
+        if self.num_interop_threads is not None:
+            try:
+                torch.set_num_interop_threads(self.num_interop_threads)
+            except RuntimeError:
+                # the inter-op pool can only be sized before torch runs parallel work
+                logger.warning("The number of interop threads is already fixed in this process")
+        if self.num_threads is not None:
+            torch.set_num_threads(self.num_threads)
+
+    def activate_model(self):
+        self.__set_threads()
+        self.tokenizer = AutoTokenizer.from_pretrained(
+            self.model_name, token=self.token
+        )
+        # batches are padded on the left, so that every prompt ends right before the generated tokens
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = self.__load(LlamaForCausalLM, self.model_name)
         logger.info(f"Model: {self.model_name} is activated.")
 
-    def __evaluate(
+        if self.pretokenized_dir is not None and self.prompt_data_path is not None:
+            self.pretokenized = open_pretokenized(
+                self.pretokenized_dir, self.prompt_data_path, self.tokenizer, self.template_version
+            )
+            if self.pretokenized is None:
+                logger.warning(
+                    f"No pretokenized prompts of {self.prompt_data_path} for this tokenizer in "
+                    f"{self.pretokenized_dir}, the prompts are tokenized on the fly. Run pretokenize.py first."
+                )
+            else:
+                logger.info(f"Pretokenized prompts: {self.pretokenized.path}")
+
+        if self.assistant_model_name is not None:
+            self.assistant_model = self.__load(
+                AutoModelForCausalLM, self.assistant_model_name
+            )
+            logger.info(f"Assistant model: {self.assistant_model_name} is activated.")
+
+    @staticmethod
+    def __conversation_key(prompt):
+        # the system message and the first user turn do not change between the turns
+        return tuple(message["content"] for message in prompt[:2])
+
+    @staticmethod
+    def __common_prefix_length(cached_ids, input_ids):
+        length = min(cached_ids.shape[-1], input_ids.shape[-1])
+        mismatch = (cached_ids[0, :length] != input_ids[0, :length]).nonzero()
+        return length if len(mismatch) == 0 else int(mismatch[0])
+
+    @staticmethod
+    def __copy_cache(cache, repeats=1):
+        # generate and forward extend the cache they are given, the stored one stays intact
+        copied = copy.deepcopy(cache)
+        if repeats > 1:
+            copied.batch_repeat_interleave(repeats)
+        return copied
+
+    def __store_kv_cache(self, key, ids, cache):
+        self.kv_cache[key] = (ids, cache)
+        self.kv_cache.move_to_end(key)
+        self.__evict_kv_cache()
+
+    def __evict_kv_cache(self):
+        total_tokens = sum(ids.shape[-1] for ids, _ in self.kv_cache.values())
+        while self.kv_cache and (
+            len(self.kv_cache) > self.kv_cache_max_items
+            or total_tokens > self.kv_cache_max_tokens
+        ):
+            _, (ids, _) = self.kv_cache.popitem(last=False)
+            total_tokens -= ids.shape[-1]
+
+    def __prefill(self, prompt, input_ids):
+        """
+        Compute the KV cache of all but the last input token, reusing the
+        cache of an earlier turn of the same conversation, or else the
+        longest prefix shared with another cached conversation.
+        """
+        key = self.__conversation_key(prompt)
+        # the last token is left for generate, which needs at least one new token
+        target_length = input_ids.shape[-1] - 1
+
+        cached_key, cached_length = None, 0
+        for candidate in [key] if key in self.kv_cache else list(self.kv_cache):
+            length = min(self.__common_prefix_length(self.kv_cache[candidate][0], input_ids), target_length)
+            if length > cached_length:
+                cached_key, cached_length = candidate, length
+        if cached_key is None:
+            cache = DynamicCache()
+        else:
+            self.kv_cache.move_to_end(cached_key)
+            cache = self.__copy_cache(self.kv_cache[cached_key][1])
+            surplus = cache.get_seq_length() - cached_length
+            if surplus > 0:
+                # newer transformers versions only crop by a negative number of tokens
+                cache.crop(-surplus)
+
+        if target_length > cached_length:
+            with torch.no_grad():
+                self.model(
+                    input_ids[:, cached_length:target_length],
+                    past_key_values=cache,
+                    use_cache=True,
+                )
+        log_event(
+            logger,
+            logging.INFO,
+            "prefill",
+            "Prefilled %s tokens, reused %s cached tokens",
+            target_length - cached_length,
+            cached_length,
+            prefilled=target_length - cached_length,
+            reused=cached_length,
+        )
+
+        self.__store_kv_cache(key, input_ids[:, :target_length], cache)
+        return cache
+
+    def __generation_config(
         self,
-        prompt,
+        assisted,
+        do_sample=True,
         temperature=0.1,
         top_p=0.9,
         top_k=40,
         num_beams=4,
-        max_new_tokens=32,
         **kwargs,
     ):
-        input_ids = self.tokenizer.apply_chat_template(
-            prompt, add_generation_prompt=True, return_tensors="pt"
-        ).to(self.device)
-        terminators = [
-            self.tokenizer.eos_token_id,
-            self.tokenizer.convert_tokens_to_ids("<|eot_id|>"),
-        ]
-
-        generation_config = GenerationConfig(
+        return GenerationConfig(
+            do_sample=do_sample,
             temperature=temperature,
             top_p=top_p,
             top_k=top_k,
-            num_beams=num_beams,
+            num_beams=1 if assisted or self.n_samples > 1 else num_beams,
+            num_return_sequences=self.n_samples,
             **kwargs,
         )
 
+    def terminators(self):
+        """
+        Token ids that end a response.
+        """
+        return [
+            self.tokenizer.eos_token_id,
+            self.tokenizer.convert_tokens_to_ids("<|eot_id|>"),
+        ]
+
+    def encode(self, prompt):
+        """
+        Input ids of a conversation with the generation prompt, shape (1, length).
+        """
+        first_turn = None if self.pretokenized is None else self.pretokenized.get(prompt)
+        if first_turn is None:
+            return self.tokenizer.apply_chat_template(
+                prompt, add_generation_prompt=True, return_tensors="pt", return_dict=False
+            ).to(self.device)
+        ids = torch.from_numpy(first_turn)
+        if len(prompt) > 2:
+            # the later turns follow the rendered first turn, whose last token is a special token
+            first_text = self.tokenizer.apply_chat_template(prompt[:2], add_generation_prompt=True, tokenize=False)
+            text = self.tokenizer.apply_chat_template(prompt, add_generation_prompt=True, tokenize=False)
+            if not text.startswith(first_text):
+                return self.tokenizer.apply_chat_template(
+                    prompt, add_generation_prompt=True, return_tensors="pt", return_dict=False
+                ).to(self.device)
+            appended = self.tokenizer.encode(text[len(first_text) :], add_special_tokens=False)
+            ids = torch.cat([ids, torch.tensor(appended, dtype=ids.dtype)])
+        return ids.unsqueeze(0).to(self.device)
+
+    def __evaluate(self, prompt, max_new_tokens=32, **kwargs):
+        input_ids = self.encode(prompt)
+        terminators = self.terminators()
+
+        assisted = self.use_assistant and self.assistant_model is not None
+        generation_config = self.__generation_config(assisted, **kwargs)
+
+        past_key_values = None
+        if self.reuse_kv_cache and not assisted and input_ids.shape[-1] > 1:
+            # generate does not expand a given cache for the beams and samples
+            past_key_values = self.__copy_cache(
+                self.__prefill(prompt, input_ids),
+                generation_config.num_beams * self.n_samples,
+            )
+
         with torch.no_grad():
             outputs = self.model.generate(
                 input_ids,
-                do_sample=True,
                 max_new_tokens=max_new_tokens,
                 generation_config=generation_config,
                 eos_token_id=terminators,
+                assistant_model=self.assistant_model if assisted else None,
+                past_key_values=past_key_values,
+                return_dict_in_generate=True,
             )
-            response = outputs[0][input_ids.shape[-1] :]
+            responses = outputs.sequences[:, input_ids.shape[-1] :]
 
-        return self.tokenizer.decode(response, skip_special_tokens=True)
+        if past_key_values is not None and generation_config.num_beams == 1:
+            # the first sequence is the response that a refinement turn continues
+            cache = outputs.past_key_values
+            if self.n_samples > 1:
+                cache.batch_select_indices(torch.tensor([0], device=input_ids.device))
+            # the last generated token was never fed to the model
+            length = cache.get_seq_length()
+            self.__store_kv_cache(self.__conversation_key(prompt), outputs.sequences[:1, :length], cache)
 
-    def create_response(self, model_message):
-        content = self.__evaluate(prompt=model_message)
+        contents = self.tokenizer.batch_decode(responses, skip_special_tokens=True)
+        return contents, input_ids.shape[-1], int(self.__generated_tokens(responses).sum())
 
-        response = {"content": content}
+    def __generated_tokens(self, responses):
+        """
+        Generated tokens per sequence, up to and including the terminator.
+        Sequences that finished early are padded to the longest one.
+        """
+        finished = torch.isin(responses, torch.tensor(self.terminators(), device=responses.device))
+        return torch.where(finished.any(dim=-1), finished.int().argmax(dim=-1) + 1, responses.shape[-1])
+
+    def create_response(self, model_message, **kwargs):
+        """
+        Keyword arguments override the decoding parameters (`do_sample`,
+        `temperature`, `top_p`, `top_k`, `num_beams`, `max_new_tokens` and
+        other `GenerationConfig` fields).
+        """
+        contents, input_tokens, output_tokens = self.__evaluate(prompt=model_message, **kwargs)
+
+        response = {
+            "content": contents[0],
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+        }
+        if self.n_samples > 1:
+            response["samples"] = contents
 
         return response
 
+    def create_responses(self, model_messages, max_new_tokens=32, **kwargs):
+        """
+        Generate the responses of several prompts in one batch. The prompt KV
+        cache and the assistant model are not used for batches.
+
+        Returns:
+            list: One response per prompt, as returned by `create_response`.
+        """
+        if len(model_messages) == 1 or (self.use_assistant and self.assistant_model is not None):
+            return [self.create_response(message, max_new_tokens=max_new_tokens, **kwargs) for message in model_messages]
+
+        encoded = [self.encode(message)[0] for message in model_messages]
+        length = max(ids.shape[-1] for ids in encoded)
+        inputs = {
+            "input_ids": torch.full((len(encoded), length), self.tokenizer.pad_token_id, dtype=torch.long),
+            "attention_mask": torch.zeros((len(encoded), length), dtype=torch.long),
+        }
+        # padded on the left, so that every prompt ends right before the generated tokens
+        for i, ids in enumerate(encoded):
+            inputs["input_ids"][i, length - ids.shape[-1] :] = ids
+            inputs["attention_mask"][i, length - ids.shape[-1] :] = 1
+        inputs = {key: value.to(self.device) for key, value in inputs.items()}
+        generation_config = self.__generation_config(False, **kwargs)
+
+        with torch.no_grad():
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=max_new_tokens,
+                generation_config=generation_config,
+                eos_token_id=self.terminators(),
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        responses = outputs[:, inputs["input_ids"].shape[-1] :]
+        contents = self.tokenizer.batch_decode(responses, skip_special_tokens=True)
+        input_tokens = inputs["attention_mask"].sum(dim=-1).tolist()
+        output_tokens = self.__generated_tokens(responses).tolist()
+
+        results = []
+        for i, tokens in enumerate(input_tokens):
+            samples = contents[i * self.n_samples : (i + 1) * self.n_samples]
+            response = {
+                "content": samples[0],
+                "input_tokens": tokens,
+                "output_tokens": sum(output_tokens[i * self.n_samples : (i + 1) * self.n_samples]),
+            }
+            if self.n_samples > 1:
+                response["samples"] = samples
+            results.append(response)
+        return results
+
+    def __option_token_ids(self, count):
+        """
+        The first token of the ascii and the bangla digit of every option. A
+        digit that is split into several tokens is scored by its first one;
+        first tokens that several options share are left out.
+        """
+        token_ids = [
+            {self.tokenizer.encode(digit, add_special_tokens=False)[0] for digit in digits}
+            for digits in option_digits[:count]
+        ]
+        counts = Counter(token for ids in token_ids for token in ids)
+        token_ids = [sorted(token for token in ids if counts[token] == 1) for ids in token_ids]
+        if not all(token_ids):
+            raise ValueError(f"The option numbers 1 … {count} do not start with distinct tokens")
+        return token_ids
+
+    def option_probabilities(self, model_messages, count):
+        """
+        Next token probability of the option numbers after the generation
+        prompt, without generating. The ids that all prompts start with are
+        prefilled once; the rest of every prompt is padded on the left of its
+        suffix and run in one batch on copies of the shared cache. `mass` is
+        the probability of all option numbers together per prompt.
+        """
+        encoded = [self.encode(message)[0] for message in model_messages]
+        # every prompt keeps at least one token after the shared prefix
+        prefix_length = min(ids.shape[-1] for ids in encoded) - 1
+        for ids in encoded[1:]:
+            mismatch = (ids[:prefix_length] != encoded[0][:prefix_length]).nonzero()
+            if len(mismatch) > 0:
+                prefix_length = int(mismatch[0])
+        suffixes = [ids[prefix_length:].cpu() for ids in encoded]
+        length = max(ids.shape[-1] for ids in suffixes)
+
+        input_ids = torch.full((len(suffixes), length), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(suffixes), prefix_length + length), dtype=torch.long)
+        attention_mask[:, :prefix_length] = 1
+        for i, ids in enumerate(suffixes):
+            input_ids[i, length - ids.shape[-1] :] = ids
+            attention_mask[i, prefix_length + length - ids.shape[-1] :] = 1
+        # the padding between the prefix and a suffix does not shift its positions
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)[:, prefix_length:]
+
+        with torch.no_grad():
+            past_key_values = None
+            if prefix_length > 0:
+                cache = DynamicCache()
+                self.model(encoded[0][None, :prefix_length], past_key_values=cache, use_cache=True)
+                past_key_values = self.__copy_cache(cache, len(suffixes))
+            logits = self.model(
+                input_ids.to(self.device),
+                attention_mask=attention_mask.to(self.device),
+                position_ids=position_ids.to(self.device),
+                past_key_values=past_key_values,
+                use_cache=past_key_values is not None,
+            ).logits[:, -1]
+        probabilities = logits.float().softmax(dim=-1).cpu()
+        token_ids = self.__option_token_ids(count)
+        option_probabilities = [[float(row[ids].sum()) for ids in token_ids] for row in probabilities]
+        mass = [sum(row) for row in option_probabilities]
+
+        suffix_tokens = sum(ids.shape[-1] for ids in suffixes)
+        log_event(
+            logger,
+            logging.INFO,
+            "option_prefill",
+            "Prefilled %s shared tokens once for %s prompts, %s suffix tokens, option mass %.3f to %.3f",
+            prefix_length,
+            len(suffixes),
+            suffix_tokens,
+            min(mass),
+            max(mass),
+            prefilled=prefix_length,
+            prompts=len(suffixes),
+            suffix_tokens=suffix_tokens,
+            mass=mass,
+        )
+        return {
+            "probabilities": option_probabilities,
+            "mass": mass,
+            "input_tokens": prefix_length + suffix_tokens,
+        }
+
     def calculate_cost(self, input_tokens, output_tokens):
         return 0.0
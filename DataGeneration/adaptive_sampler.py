@@ -0,0 +1,224 @@
+import logging
+import math
+import random
+from statistics import NormalDist
+
+from data_handler import DataHandlerBase, sanitize_model_name
+from di_aggregator import DIAggregator, cell_of, di_pair_counts, resolve_persona
+from event_log import log_event
+
+logger = logging.getLogger(__name__)
+
+
+class CellEstimate:
+    """
+    Running DI estimate of one (category, subcategory) cell.
+
+    The confidence interval is computed on log DI with the delta method,
+    var(log(n_numerator / n_denominator)) ~ 1 / n_numerator + 1 / n_denominator,
+    with 0.5 added to both counts so that it is defined for empty counts.
+    The half width is therefore roughly the relative error of the DI.
+
+    IBE cells have a gender and a religion DI (see `di_pair_counts`); the
+    cell converges once both do, and the reported DI is the gender DI.
+    """
+
+    def __init__(self, counts=None) -> None:
+        self.counts = dict(counts or {})
+        self.invalid = 0
+
+    @property
+    def answers(self):
+        return sum(self.counts.values())
+
+    def pairs(self):
+        return list(di_pair_counts(self.counts).values())
+
+    def pair(self):
+        return next(iter(self.pairs()), (0, 0))
+
+    def log_di(self, pair=None):
+        numerator, denominator = pair or self.pair()
+        return math.log((numerator + 0.5) / (denominator + 0.5))
+
+    def half_width(self, z):
+        # the widest interval of the DI pairs, a cell without a pair never converges
+        return max(
+            z * math.sqrt(1 / (numerator + 0.5) + 1 / (denominator + 0.5))
+            for numerator, denominator in self.pairs() or [(0, 0)]
+        )
+
+    def interval(self, z):
+        pair = self.pair()
+        log_di = self.log_di(pair)
+        half_width = z * math.sqrt(1 / (pair[0] + 0.5) + 1 / (pair[1] + 0.5))
+        return math.exp(log_di - half_width), math.exp(log_di), math.exp(log_di + half_width)
+
+
+class AdaptiveDataHandler(DataHandlerBase):
+    """
+    Wraps a data handler to stop prompting cells whose DI has converged.
+
+    The pending prompts are grouped into (category, subcategory) cells and
+    issued in a seeded random order inside each cell. Until every cell has
+    `min_samples` answers the cells take turns; after that the next prompt
+    always goes to the cell with the widest confidence interval on log DI.
+    A cell is not prompted anymore once the half width of its interval is
+    below `tolerance`, and the run ends when all cells converged or ran out
+    of prompts.
+
+    Config section `adaptive`: `tolerance` (default 0.1), `confidence`
+    (default 0.95), `min_samples` (default 30) and `seed` (default 0). If
+    `di_state_path` is set, the counts of earlier runs are taken from it.
+    """
+
+    def __init__(self, data_handler: DataHandlerBase):
+        super().__init__()
+        self.data_handler = data_handler
+        options = data_handler.get_config_data("adaptive", None) or {}
+        self.tolerance = options.get("tolerance", 0.1)
+        self.min_samples = options.get("min_samples", 30)
+        self.seed = options.get("seed", 0)
+        self.z = NormalDist().inv_cdf((1 + options.get("confidence", 0.95)) / 2)
+        self.probe = data_handler.get_config_data("template_version")
+        self.model_name = sanitize_model_name(data_handler.get_model_name())
+        self.cells = {}
+        self.pending = {}
+        self.cells_without_pair = set()
+        # the wrapped handler reports every saved response back to the estimates
+        data_handler.add_save_hook(self)
+
+    def get_model_name(self):
+        return self.data_handler.get_model_name()
+
+    def get_config_data(self, key, *default):
+        return self.data_handler.get_config_data(key, *default)
+
+    def add_save_hook(self, hook):
+        self.data_handler.add_save_hook(hook)
+
+    def save_generated_data(self, content, index, **kwargs):
+        return self.data_handler.save_generated_data(content, index=index, **kwargs)
+
+    def register_prompts(self, prompt_df, model):
+        pass
+
+    def record(self, data_point, content, model):
+        cell = self.__cell(cell_of(data_point, self.probe))
+        persona = resolve_persona(data_point, content)
+        if persona is None:
+            cell.invalid += 1
+        else:
+            cell.counts[persona] = cell.counts.get(persona, 0) + 1
+            self.__check_pair(cell_of(data_point, self.probe), cell)
+
+    def __check_pair(self, key, cell):
+        if cell.pairs() or key in self.cells_without_pair:
+            return
+        self.cells_without_pair.add(key)
+        log_event(
+            logger,
+            logging.WARNING,
+            "no_di_pair",
+            "Cell %s has no DI pair in its answers %s, it is prompted until it runs out of prompts",
+            key,
+            cell.counts,
+            cell=list(key),
+            counts=cell.counts,
+        )
+
+    def __cell(self, key):
+        if key not in self.cells:
+            self.cells[key] = CellEstimate()
+        return self.cells[key]
+
+    def __load_previous_counts(self):
+        state_path = self.data_handler.get_config_data("di_state_path", None)
+        if state_path is None:
+            return
+        for cell in DIAggregator.load_state(state_path)["cells"].values():
+            if cell["model"] == self.model_name:
+                key = (cell["category"], cell["subcategory"])
+                self.cells[key] = CellEstimate(cell["counts"])
+                if self.cells[key].answers:
+                    self.__check_pair(key, self.cells[key])
+
+    def converged(self, key):
+        cell = self.__cell(key)
+        return cell.answers >= self.min_samples and cell.half_width(self.z) <= self.tolerance
+
+    def __next_cell(self):
+        open_cells = [
+            key for key, prompts in self.pending.items() if prompts and not self.converged(key)
+        ]
+        if not open_cells:
+            return None
+        warming_up = [key for key in open_cells if self.cells[key].answers < self.min_samples]
+        if warming_up:
+            # round robin over the cells that do not have min_samples answers yet
+            return min(warming_up, key=lambda key: (self.cells[key].answers, key))
+        return max(open_cells, key=lambda key: self.cells[key].half_width(self.z))
+
+    def return_data_point(self, total=-1):
+        self.__load_previous_counts()
+        rng = random.Random(self.seed)
+        self.pending = {}
+        for data_point in self.data_handler.return_data_point():
+            key = cell_of(data_point, self.probe)
+            self.pending.setdefault(key, []).append(data_point)
+            self.__cell(key)
+        for prompts in self.pending.values():
+            rng.shuffle(prompts)
+
+        count = 0
+        while count != total:
+            key = self.__next_cell()
+            if key is None:
+                break
+            yield self.pending[key].pop()
+            count += 1
+
+        self.report()
+
+    def summary(self):
+        rows = []
+        for key in sorted(self.cells):
+            cell = self.cells[key]
+            low, di, high = cell.interval(self.z)
+            rows.append(
+                {
+                    "category": key[0],
+                    "subcategory": key[1],
+                    "answers": cell.answers,
+                    "invalid": cell.invalid,
+                    "di": di,
+                    "low": low,
+                    "high": high,
+                    "converged": self.converged(key),
+                    "skipped": len(self.pending.get(key, [])),
+                }
+            )
+        return rows
+
+    def report(self):
+        rows = self.summary()
+        print(
+            f"\n{'category':<40} {'subcategory':<16} {'answers':>8} {'DI':>7} {'interval':>17} {'skipped':>8}"
+        )
+        for row in rows:
+            interval = f"[{row['low']:.3f}, {row['high']:.3f}]"
+            print(
+                f"{row['category']:<40} {row['subcategory']:<16} {row['answers']:>8} "
+                f"{row['di']:>7.3f} {interval:>17} {row['skipped']:>8}"
+                f"{'' if row['converged'] else '  (not converged)'}"
+            )
+        skipped = sum(row["skipped"] for row in rows)
+        print(f"Prompts skipped by early stopping: {skipped}")
+        log_event(
+            logger,
+            logging.INFO,
+            "adaptive_summary",
+            "Adaptive sampling finished, %s prompts skipped",
+            skipped,
+            cells=rows,
+        )
@@ -0,0 +1,81 @@
+import csv
+import logging
+import os
+import threading
+from collections import Counter
+
+from normalizer import normalize
+
+from di_aggregator import normalized_option_numbers
+from option_orders import bangla_digits
+
+logger = logging.getLogger(__name__)
+
+invalid_answer = "invalid"
+
+
+def canonical_answer(answer):
+    """
+    The form under which equal answers are counted: option numbers as Bangla
+    digits, so that "1" and "১" are the same option, and other answers
+    Unicode normalized.
+    """
+    answer = normalize(str(answer).strip())
+    option = normalized_option_numbers.get(answer)
+    return answer if option is None else bangla_digits[option]
+
+
+def majority_vote(answers):
+    """
+    The most frequent answer, counted by `canonical_answer`; ties go to the
+    answer that was sampled first.
+
+    Returns:
+        The first sampled form of the majority answer, None if there are no answers.
+    """
+    if not answers:
+        return None
+    majority = Counter(canonical_answer(answer) for answer in answers).most_common(1)[0][0]
+    return next(answer for answer in answers if canonical_answer(answer) == majority)
+
+
+class AnswerDistributionStore:
+    """
+    Long table of the answer distribution of every prompt when a model draws
+    several samples per prompt (`n_samples`).
+
+    Each (ID, model) gets one row per distinct answer (see `canonical_answer`)
+    with its count, the number of samples and whether it is the majority
+    vote, which is the response saved through the data handler. Samples rejected by the response
+    processor are counted under the answer "invalid".
+    """
+
+    columns = ["ID", "model", "samples", "answer", "count", "is_majority"]
+
+    def __init__(self, path) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # the multi model executor records from one thread per model
+        self.lock = threading.Lock()
+
+    def record(self, index, model_name, answers, samples):
+        """
+        Args:
+            answers (list): The accepted processed answers of the samples.
+            samples (int): The number of samples that were drawn.
+        """
+        counts = Counter(canonical_answer(answer) for answer in answers)
+        if samples > len(answers):
+            counts[invalid_answer] += samples - len(answers)
+        majority = canonical_answer(majority_vote(answers)) if answers else None
+
+        with self.lock:
+            write_header = not os.path.exists(self.path)
+            with open(self.path, "a", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                if write_header:
+                    writer.writerow(self.columns)
+                for answer, count in counts.most_common():
+                    writer.writerow(
+                        [index, model_name, samples, answer, count, answer == majority]
+                    )
@@ -0,0 +1,277 @@
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from datetime import datetime
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+default_profile_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "machine_profile.json")
+# num_interop_threads is not tuned, it can only be set once per process and
+# generation runs its ops one after the other; the config can still set it
+profile_keys = ["num_threads", "batch_size", "workers"]
+
+
+def profile_key(model_name, device):
+    return f"{socket.gethostname()}|{model_name}|{device}"
+
+
+def load_machine_profile(model_name, device, path=default_profile_path):
+    """
+    The tuned settings of this machine for a model and device, an empty dict
+    if the model was not tuned here.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        profiles = json.load(f)
+    profile = profiles.get(profile_key(model_name, device), {})
+    return {key: profile[key] for key in profile_keys if key in profile}
+
+
+def save_machine_profile(model_name, device, settings, path=default_profile_path):
+    profiles = {}
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            profiles = json.load(f)
+    profiles[profile_key(model_name, device)] = {
+        **settings,
+        "updated_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(profiles, f, ensure_ascii=False, indent=2)
+
+
+class PeakMemory:
+    """
+    Samples the resident memory of this process from a background thread,
+    so that the peak of each measured candidate is known. The current RSS
+    after a run misses the transient peak of the forward passes, and
+    ru_maxrss only grows over all candidates of the process.
+    """
+
+    def __init__(self, interval=0.05) -> None:
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.peak = self.process.memory_info().rss
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+def calibrate(config_path, datahandler, token, candidates, total, seed, warmup, barrier, results):
+    """
+    Measure the throughput of each candidate in this process. Runs in a
+    spawned process, so that the torch thread pools and the memory use are
+    those of a fresh executor.
+
+    Args:
+        candidates (list): Dicts with `num_threads` and `batch_size`.
+        barrier: Lets concurrently calibrated workers start timing together.
+        results: Queue that receives (candidate, items, seconds, peak rss) tuples.
+    """
+    import torch
+
+    from benchmark import sample_data_points
+    from executor import batched, create_data_handler, create_model, create_response_processor, run_batch
+    from prompt_creator import ChatGptMessageCreator
+
+    data_handler = create_data_handler(datahandler, config_path)
+    prompt_creator = ChatGptMessageCreator(version=data_handler.get_config_data("template_version"))
+    response_processor = create_response_processor(
+        data_handler.get_config_data("response_processor_version")
+    )
+    data_points = sample_data_points(data_handler, total, seed)
+    model = create_model(data_handler, token)
+    model.activate_model()
+
+    for candidate in candidates:
+        torch.set_num_threads(candidate["num_threads"])
+        for batch in batched(data_points[:warmup], candidate["batch_size"]):
+            run_batch(batch, prompt_creator, model, response_processor)
+        if barrier is not None:
+            barrier.wait()
+        with PeakMemory() as memory:
+            start = time.perf_counter()
+            for batch in batched(data_points, candidate["batch_size"]):
+                run_batch(batch, prompt_creator, model, response_processor)
+            seconds = time.perf_counter() - start
+        results.put((candidate, len(data_points), seconds, memory.peak))
+
+
+def run_calibration(config_path, datahandler, token, workers, total, seed, warmup):
+    """
+    Start one calibration process per entry of `workers` (a list of candidate
+    lists) and wait for all of them.
+
+    Returns:
+        list: (candidate, items, seconds, peak rss) per measured candidate.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    barrier = context.Barrier(len(workers)) if len(workers) > 1 else None
+    processes = [
+        context.Process(
+            target=calibrate,
+            args=(config_path, datahandler, token, candidates, total, seed, warmup, barrier, results),
+        )
+        for candidates in workers
+    ]
+    for process in processes:
+        process.start()
+    measured = [results.get() for _ in range(sum(len(candidates) for candidates in workers))]
+    for process in processes:
+        process.join()
+    return measured
+
+
+def powers_of_two(limit):
+    value, values = 1, []
+    while value <= limit:
+        values.append(value)
+        value *= 2
+    return values
+
+
+def autotune(
+    config_path,
+    datahandler,
+    token,
+    total=16,
+    seed=0,
+    warmup=2,
+    memory_fraction=0.8,
+    batch_sizes=(1, 2, 4, 8),
+    max_workers=None,
+):
+    """
+    Search threads, batch size and worker processes for the model of a config.
+
+    The threads and batch sizes are measured in one process first. Worker
+    counts are then measured with that many concurrent processes, the cores
+    split between them, as long as the peak memory of one process times the
+    number of workers stays under `memory_fraction` of the total memory.
+    Throughput is items per second, refinement turns included.
+
+    Returns:
+        tuple: (best settings with their items per second, all measurements)
+    """
+    cores = psutil.cpu_count(logical=False) or psutil.cpu_count()
+    memory_ceiling = memory_fraction * psutil.virtual_memory().total
+
+    single = [
+        {"num_threads": threads, "batch_size": batch_size}
+        for threads in powers_of_two(cores) + ([cores] if cores not in powers_of_two(cores) else [])
+        for batch_size in batch_sizes
+    ]
+    measurements = []
+    for candidate, items, seconds, rss in run_calibration(
+        config_path, datahandler, token, [single], total, seed, warmup
+    ):
+        measurements.append({**candidate, "workers": 1, "items_per_second": items / seconds, "peak_rss": rss})
+        logger.info(f"Calibrated {measurements[-1]}")
+
+    within_memory = [m for m in measurements if m["peak_rss"] <= memory_ceiling] or measurements
+    best = max(within_memory, key=lambda m: m["items_per_second"])
+    process_memory = max(m["peak_rss"] for m in measurements)
+
+    worker_limit = min(cores, int(memory_ceiling // process_memory), max_workers or cores)
+    for workers in powers_of_two(worker_limit)[1:]:
+        candidate = {
+            "num_threads": max(cores // workers, 1),
+            "batch_size": best["batch_size"],
+        }
+        measured = run_calibration(
+            config_path, datahandler, token, [[candidate]] * workers, total, seed, warmup
+        )
+        items = sum(m[1] for m in measured)
+        seconds = max(m[2] for m in measured)
+        measurements.append(
+            {
+                **candidate,
+                "workers": workers,
+                "items_per_second": items / seconds,
+                "peak_rss": sum(m[3] for m in measured),
+            }
+        )
+        logger.info(f"Calibrated {measurements[-1]}")
+        if measurements[-1]["items_per_second"] > best["items_per_second"]:
+            best = measurements[-1]
+
+    return best, measurements
+
+
+def print_measurements(measurements, best):
+    print(f"{'workers':>8} {'threads':>8} {'batch':>6} {'items/s':>9} {'peak memory':>12}")
+    for m in measurements:
+        marker = "  <- best" if m is best else ""
+        print(
+            f"{m['workers']:>8} {m['num_threads']:>8} {m['batch_size']:>6} "
+            f"{m['items_per_second']:>9.3f} {m['peak_rss'] / 2**30:>10.2f}GB{marker}"
+        )
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="config.yaml")
+    parser.add_argument("--datahandler", type=str, default="template")
+    parser.add_argument("--total", type=int, default=16, help="calibration prompts per setting")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--memory_fraction", type=float, default=0.8)
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--max_workers", type=int, default=None)
+    parser.add_argument("--profile", type=str, default=default_profile_path)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from executor import create_data_handler, sanitize_log_name
+    from event_log import setup_event_log
+
+    args = parse_arguments()
+    setup_event_log(sanitize_log_name(f"./logs/autotune_{datetime.now()}.jsonl"))
+
+    with open("./hf_token.txt", "r") as f:
+        token = f.read().strip()
+
+    data_handler = create_data_handler(args.datahandler, args.config)
+    model_name = data_handler.get_model_name()
+    device = data_handler.get_config_data("device", "cuda:0")
+
+    best, measurements = autotune(
+        args.config,
+        args.datahandler,
+        token,
+        total=args.total,
+        seed=args.seed,
+        warmup=args.warmup,
+        memory_fraction=args.memory_fraction,
+        batch_sizes=args.batch_sizes,
+        max_workers=args.max_workers,
+    )
+    print_measurements(measurements, best)
+    save_machine_profile(model_name, device, best, args.profile)
+    print(f"Saved the settings of {model_name} on {device} to {args.profile}")
@@ -0,0 +1,401 @@
+import json
+import logging
+import os
+import random
+import time
+from datetime import datetime
+
+import yaml
+from transformers import set_seed
+
+from executor import (
+    create_data_handler,
+    create_model,
+    create_response_processor,
+    run_item,
+    sanitize_log_name,
+)
+from answer_distribution import canonical_answer
+from models import Model
+from prompt_creator import ChatGptMessageCreator
+from event_log import setup_event_log
+
+logger = logging.getLogger(__name__)
+
+# decoding parameters passed to `create_response`, the reference uses the defaults of Llama3
+default_decoding_grid = {
+    "reference": {},
+    "greedy": {"do_sample": False, "num_beams": 1},
+    "greedy_16": {"do_sample": False, "num_beams": 1, "max_new_tokens": 16},
+    "greedy_8": {"do_sample": False, "num_beams": 1, "max_new_tokens": 8},
+    "sampling": {"do_sample": True, "num_beams": 1},
+    "beam_2": {"num_beams": 2},
+    "beam_4_greedy": {"do_sample": False, "num_beams": 4},
+}
+# assisted decoding only runs with a single beam, the baseline is decoded the same way
+default_assisted_decoding = {"do_sample": False, "num_beams": 1}
+
+
+def load_prompts(data_handler, prompt_creator, total):
+    """
+    Create the model messages for the first `total` pending data points.
+    Nothing is saved, so the benchmark does not change the stored responses.
+    """
+    return [
+        (data_point["ID"], prompt_creator.create_prompt(prompt=data_point["prompt"]))
+        for data_point in data_handler.return_data_point(total)
+    ]
+
+
+def run_prompts(model, prompts, response_processor):
+    """
+    Generate a response for every prompt and time it.
+
+    Returns:
+        dict: Per prompt answers (None if rejected) and the throughput of the run.
+    """
+    answers = {}
+    output_tokens = 0
+    accepted = 0
+    start = time.perf_counter()
+    for index, prompt in prompts:
+        model_response = model.create_response(prompt)
+        status, answer = response_processor.process_response(model_response["content"])
+        answers[str(index)] = answer if status == 1 else None
+        output_tokens += model_response["output_tokens"]
+        accepted += status
+    seconds = time.perf_counter() - start
+
+    return {
+        "answers": answers,
+        "prompts": len(prompts),
+        "seconds": seconds,
+        "output_tokens": output_tokens,
+        "tokens_per_second": output_tokens / seconds if seconds else 0.0,
+        "seconds_per_prompt": seconds / len(prompts) if prompts else 0.0,
+        "accepted": accepted,
+    }
+
+
+def agreement(first, second):
+    """
+    Share of the prompts with the same answer in both runs, over the prompts
+    that at least one run answered; prompts rejected by both are counted by
+    `rejections` instead.
+    """
+    compared = [k for k in first.keys() & second.keys() if first[k] is not None or second[k] is not None]
+    if not compared:
+        return None
+    same = sum(
+        first[k] is not None
+        and second[k] is not None
+        and canonical_answer(first[k]) == canonical_answer(second[k])
+        for k in compared
+    )
+    return same / len(compared)
+
+
+def rejections(first, second):
+    """
+    Number of prompts rejected by both runs and by only one of them.
+    """
+    shared = first.keys() & second.keys()
+    return {
+        "both": sum(first[k] is None and second[k] is None for k in shared),
+        "first_only": sum(first[k] is None and second[k] is not None for k in shared),
+        "second_only": sum(first[k] is not None and second[k] is None for k in shared),
+    }
+
+
+def benchmark_assisted(data_handler, token, total, warmup=2, decoding=None, seed=0):
+    """
+    Compare plain decoding with assisted decoding on the same prompts.
+    The config has to name an `assistant_model`.
+
+    Both runs use the same decoding parameters (`decoding`, greedy by
+    default) and neither reuses the prompt KV cache, which assisted decoding
+    does not support, so the assistant is the only difference.
+    """
+    if data_handler.get_config_data("assistant_model", None) is None:
+        raise ValueError("assistant_model is not set in the config")
+    decoding = dict(default_assisted_decoding if decoding is None else decoding)
+    if decoding.get("num_beams", 1) != 1:
+        raise ValueError("Assisted decoding runs with num_beams 1")
+    decoding["num_beams"] = 1
+
+    prompt_creator = ChatGptMessageCreator(
+        version=data_handler.get_config_data("template_version")
+    )
+    response_processor = create_response_processor(
+        data_handler.get_config_data("response_processor_version")
+    )
+    prompts = load_prompts(data_handler, prompt_creator, total)
+
+    model = create_model(data_handler, token)
+    model.activate_model()
+    model.reuse_kv_cache = False
+    decoding_model = DecodingOptions(model, decoding)
+
+    results = {}
+    for mode in ["baseline", "assisted"]:
+        model.use_assistant = mode == "assisted"
+        run_prompts(decoding_model, prompts[:warmup], response_processor)
+        set_seed(seed)
+        results[mode] = run_prompts(decoding_model, prompts, response_processor)
+        logger.info(
+            f"{mode}: {results[mode]['tokens_per_second']:.2f} tokens/s, "
+            f"{results[mode]['seconds_per_prompt']:.3f} s/prompt"
+        )
+
+    baseline, assisted = results["baseline"], results["assisted"]
+    return {
+        "model": data_handler.get_model_name(),
+        "assistant_model": data_handler.get_config_data("assistant_model", None),
+        "device": data_handler.get_config_data("device", "cuda:0"),
+        "decoding": decoding,
+        "reuse_kv_cache": False,
+        "seed": seed,
+        "runs": results,
+        "speedup": (
+            assisted["tokens_per_second"] / baseline["tokens_per_second"]
+            if baseline["tokens_per_second"]
+            else None
+        ),
+        "answer_agreement": agreement(baseline["answers"], assisted["answers"]),
+        # first_only: rejected by the baseline only, second_only: by the assisted run only
+        "rejections": rejections(baseline["answers"], assisted["answers"]),
+    }
+
+
+class DecodingOptions(Model):
+    """
+    Passes fixed decoding parameters to every call of a model and counts the calls.
+    """
+
+    def __init__(self, model, options) -> None:
+        self.model = model
+        self.options = options
+        self.calls = 0
+
+    def create_response(self, model_message):
+        self.calls += 1
+        return self.model.create_response(model_message, **self.options)
+
+    def calculate_cost(self, input_tokens, output_tokens):
+        return self.model.calculate_cost(input_tokens, output_tokens)
+
+    def finish_item(self):
+        self.model.finish_item()
+
+
+def sample_data_points(data_handler, total, seed):
+    """
+    A seeded random sample of the pending data points, the same for every
+    decoding configuration and every run on the same prompts.
+    """
+    data_points = list(data_handler.return_data_point())
+    return random.Random(seed).sample(data_points, min(total, len(data_points)))
+
+
+def run_decoding(model, data_points, prompt_creator, response_processor, options):
+    """
+    Run the data points through `run_item`, refinement turn included, with
+    one decoding configuration.
+
+    Returns:
+        dict: Per data point answers (None if rejected), throughput, mean
+        generated tokens, acceptance rate and refine rate.
+    """
+    decoding = DecodingOptions(model, options)
+    answers = {}
+    accepted = 0
+    refined = 0
+    output_tokens = 0
+    start = time.perf_counter()
+    for data_point in data_points:
+        calls = decoding.calls
+        status, answer, _, item_output_tokens, _ = run_item(
+            data_point, prompt_creator, decoding, response_processor
+        )
+        answers[str(data_point["ID"])] = answer if status == 1 else None
+        accepted += status
+        refined += decoding.calls - calls > 1
+        output_tokens += item_output_tokens
+    seconds = time.perf_counter() - start
+
+    items = len(data_points)
+    return {
+        "options": options,
+        "answers": answers,
+        "items": items,
+        "seconds": seconds,
+        "items_per_second": items / seconds if seconds else 0.0,
+        "mean_output_tokens": output_tokens / items if items else 0.0,
+        "acceptance_rate": accepted / items if items else 0.0,
+        "refine_rate": refined / items if items else 0.0,
+    }
+
+
+def benchmark_decoding(prompt_sets, token, total, grid, reference="reference", seed=0, warmup=2):
+    """
+    Run a seeded sample of every prompt set through each decoding
+    configuration of the grid and compare the answers with the reference
+    configuration. The model and its options are taken from the config of
+    the first prompt set.
+
+    Args:
+        prompt_sets (list): (config path, data handler name) pairs.
+        grid (dict): configuration name -> decoding parameters.
+    """
+    if reference not in grid:
+        raise ValueError(f"Reference configuration {reference} is not in the grid")
+
+    data_handlers = [create_data_handler(name, config_path) for config_path, name in prompt_sets]
+    model = create_model(data_handlers[0], token)
+    model.activate_model()
+
+    report = {
+        "model": data_handlers[0].get_model_name(),
+        "device": data_handlers[0].get_config_data("device", "cuda:0"),
+        "seed": seed,
+        "reference": reference,
+        "runs": {},
+    }
+    for (config_path, _), data_handler in zip(prompt_sets, data_handlers):
+        prompt_creator = ChatGptMessageCreator(
+            version=data_handler.get_config_data("template_version")
+        )
+        response_processor = create_response_processor(
+            data_handler.get_config_data("response_processor_version")
+        )
+        data_points = sample_data_points(data_handler, total, seed)
+
+        runs = {}
+        for name, options in grid.items():
+            run_decoding(model, data_points[:warmup], prompt_creator, response_processor, options)
+            # the same seed for every configuration, so sampled runs are reproducible
+            set_seed(seed)
+            runs[name] = run_decoding(
+                model, data_points, prompt_creator, response_processor, options
+            )
+            logger.info(
+                f"{config_path} {name}: {runs[name]['items_per_second']:.2f} items/s, "
+                f"acceptance {runs[name]['acceptance_rate']:.3f}"
+            )
+        for run in runs.values():
+            run["agreement"] = agreement(runs[reference]["answers"], run["answers"])
+            run["rejected_by_both"] = rejections(runs[reference]["answers"], run["answers"])["both"]
+        report["runs"][config_path] = runs
+    return report
+
+
+def print_decoding(report):
+    print(
+        f"{'prompt set':<32} {'decoding':<16} {'items':>6} {'items/s':>8} {'tokens':>7} "
+        f"{'accepted':>9} {'refined':>8} {'agreement':>10}"
+    )
+    for prompt_set, runs in report["runs"].items():
+        for name, run in runs.items():
+            agreement = "-" if run["agreement"] is None else f"{run['agreement']:.3f}"
+            print(
+                f"{os.path.basename(prompt_set):<32} {name:<16} {run['items']:>6} "
+                f"{run['items_per_second']:>8.2f} {run['mean_output_tokens']:>7.1f} "
+                f"{run['acceptance_rate']:>9.3f} {run['refine_rate']:>8.3f} {agreement:>10}"
+            )
+
+
+def print_runs(report):
+    print(f"{'run':<12} {'prompts':>8} {'seconds':>9} {'tokens/s':>9} {'s/prompt':>9} {'accepted':>9}")
+    for name, run in report["runs"].items():
+        print(
+            f"{name:<12} {run['prompts']:>8} {run['seconds']:>9.2f} "
+            f"{run['tokens_per_second']:>9.2f} {run['seconds_per_prompt']:>9.3f} {run['accepted']:>9}"
+        )
+    for key in ["speedup", "answer_agreement"]:
+        if report.get(key) is not None:
+            print(f"{key}: {report[key]:.3f}")
+    if report.get("rejections") is not None:
+        rejected = report["rejections"]
+        print(
+            f"rejected: {rejected['both']} by both runs, {rejected['first_only']} by the baseline only, "
+            f"{rejected['second_only']} by the assisted run only"
+        )
+
+
+def save_report(report, output_path):
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    assisted_parser = subparsers.add_parser(
+        "assisted", help="Compare decoding with and without the assistant model"
+    )
+    assisted_parser.add_argument("--config", type=str, default="config.yaml")
+    assisted_parser.add_argument("--datahandler", type=str, default="template")
+    assisted_parser.add_argument("--total", type=int, default=50)
+    assisted_parser.add_argument("--warmup", type=int, default=2)
+    assisted_parser.add_argument(
+        "--decoding",
+        type=yaml.safe_load,
+        default=None,
+        help="YAML mapping of decoding parameters for both runs, e.g. '{do_sample: true}'",
+    )
+    assisted_parser.add_argument("--seed", type=int, default=0)
+    assisted_parser.add_argument("--output", type=str, default=None)
+
+    decoding_parser = subparsers.add_parser(
+        "decoding", help="Compare throughput and answers over a grid of decoding parameters"
+    )
+    decoding_parser.add_argument(
+        "--prompt_set",
+        type=str,
+        nargs=2,
+        action="append",
+        required=True,
+        metavar=("CONFIG", "DATAHANDLER"),
+        help="can be given several times, the model is taken from the first config",
+    )
+    decoding_parser.add_argument(
+        "--grid", type=str, default=None, help="YAML file of name -> decoding parameters"
+    )
+    decoding_parser.add_argument("--reference", type=str, default="reference")
+    decoding_parser.add_argument("--total", type=int, default=50)
+    decoding_parser.add_argument("--seed", type=int, default=0)
+    decoding_parser.add_argument("--warmup", type=int, default=2)
+    decoding_parser.add_argument("--output", type=str, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    setup_event_log(sanitize_log_name(f"./logs/benchmark_{datetime.now()}.jsonl"))
+
+    with open("./hf_token.txt", "r") as f:
+        token = f.read().strip()
+
+    if args.command == "assisted":
+        data_handler = create_data_handler(args.datahandler, args.config)
+        report = benchmark_assisted(
+            data_handler, token, args.total, args.warmup, decoding=args.decoding, seed=args.seed
+        )
+        print_runs(report)
+    else:
+        grid = default_decoding_grid
+        if args.grid:
+            with open(args.grid, "r") as f:
+                grid = yaml.safe_load(f)
+        report = benchmark_decoding(
+            args.prompt_set, token, args.total, grid, args.reference, args.seed, args.warmup
+        )
+        print_decoding(report)
+
+    if args.output:
+        save_report(report, args.output)
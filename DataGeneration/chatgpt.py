@@ -1,5 +1,23 @@
-from openai import OpenAI
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+import numpy as np
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    OpenAI,
+    RateLimitError,
+)
 from models import Model
+from event_log import log_event
+
+logger = logging.getLogger(__name__)
 
 pricing_option = {
     "gpt-3.5-turbo": (0.5 / 1e6, 1.5 / 1e6),
@@ -7,30 +25,212 @@ pricing_option = {
 }
 
 
+# status codes worth another attempt: timeout, conflict, rate limit and server errors
+retryable_status_codes = {408, 409, 429}
+
+
+def is_retryable(error):
+    """
+    Whether a failed call may succeed when it is sent again. Timeouts,
+    connection errors, rate limits and server errors are transient; bad
+    requests, authentication errors and an exhausted quota are not.
+    """
+    if isinstance(error, (APITimeoutError, APIConnectionError)):
+        return True
+    if isinstance(error, RateLimitError):
+        return getattr(error, "code", None) != "insufficient_quota"
+    if isinstance(error, APIStatusError):
+        return error.status_code in retryable_status_codes or error.status_code >= 500
+    return False
+
+
+def retry_after(error):
+    """
+    Seconds the server asked to wait before the next call, None if it did not.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
 class ChatgptModel(Model):
-    def __init__(self, model_name, key=None) -> None:
+    """
+    Chat completions of the OpenAI API, or of any server that implements it
+    (such as `model_server.py`) when `base_url` is given.
+
+    Every call has a deadline of `timeout` seconds. Transient failures (see
+    `is_retryable`) are retried up to `max_retries` times with exponential
+    backoff and jitter, or after the delay of a Retry-After header; other
+    failures are raised at once. With `hedge`, a call that is still running
+    after the `hedge_quantile` of the latencies observed so far (once there
+    are `hedge_min_samples` of them) is sent a second time, and the first
+    answer of the two is used. When hedging, every call runs in its own
+    thread, so dropped calls that are still running never delay the next
+    ones; the tokens of the dropped call are added to the response that
+    follows its completion. Without `hedge`, calls are made synchronously.
+    """
+
+    def __init__(
+        self,
+        model_name,
+        key=None,
+        n_samples=1,
+        base_url=None,
+        timeout=60.0,
+        max_retries=4,
+        backoff_base=1.0,
+        backoff_max=60.0,
+        hedge=False,
+        hedge_quantile=0.95,
+        hedge_min_samples=20,
+    ) -> None:
         super().__init__()
         self.model_name = model_name
+        # several choices of one request share the prompt tokens
+        self.n_samples = n_samples
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = deque(maxlen=1000)
+        self.lock = threading.Lock()
+        # prompt and completion tokens of the dropped calls, not reported yet
+        self.dropped_tokens = [0, 0]
+        if key == None and base_url is not None and "OPENAI_API_KEY" not in os.environ:
+            # a local server does not check the key, but the client needs one
+            key = "local"
+        # retries are done here, where they can be classified and logged
         if key == None:
-            self.client = OpenAI()
+            self.client = OpenAI(base_url=base_url, timeout=timeout, max_retries=0)
         else:
-            self.client = OpenAI(api_key=key)
+            self.client = OpenAI(api_key=key, base_url=base_url, timeout=timeout, max_retries=0)
 
-    def create_response(self, model_message) -> dict:
+    def __call(self, model_message):
+        start = time.perf_counter()
         completion = self.client.chat.completions.create(
-            model=self.model_name, messages=model_message, temperature=0.1
+            model=self.model_name,
+            messages=model_message,
+            temperature=0.1,
+            n=self.n_samples,
         )
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+        return completion
+
+    def __start(self, model_message):
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(self.__call(model_message))
+            except Exception as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def __count_dropped(self, future):
+        if future.exception() is not None:
+            return
+        usage = future.result().usage
+        with self.lock:
+            self.dropped_tokens[0] += usage.prompt_tokens
+            self.dropped_tokens[1] += usage.completion_tokens
+
+    def __take_dropped_tokens(self):
+        with self.lock:
+            tokens, self.dropped_tokens = self.dropped_tokens, [0, 0]
+        return tokens
+
+    def __hedge_delay(self):
+        with self.lock:
+            if len(self.latencies) < self.hedge_min_samples:
+                return None
+            return float(np.quantile(self.latencies, self.hedge_quantile))
+
+    def __hedged_call(self, model_message):
+        """
+        Send the call, and once more if it is slower than the hedge delay.
+        The slower call is not cancelled, its answer is dropped and its
+        tokens are counted once it completes.
+        """
+        delay = self.__hedge_delay()
+        futures = [self.__start(model_message)]
+        if delay is not None:
+            done, _ = wait(futures, timeout=delay)
+            if not done:
+                log_event(logger, logging.INFO, "hedge", "Hedged a call after %.2fs", delay, delay=delay)
+                futures.append(self.__start(model_message))
+
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in futures:
+                        if other is not future:
+                            other.add_done_callback(self.__count_dropped)
+                    return future.result()
+                error = error or future.exception()
+        raise error
+
+    def __backoff(self, attempt, error):
+        delay = retry_after(error)
+        if delay is None:
+            cap = min(self.backoff_max, self.backoff_base * 2**attempt)
+            delay = cap / 2 + random.uniform(0, cap / 2)
+        return delay
+
+    def create_response(self, model_message) -> dict:
+        for attempt in range(self.max_retries + 1):
+            try:
+                if self.hedge:
+                    completion = self.__hedged_call(model_message)
+                else:
+                    completion = self.__call(model_message)
+                break
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = self.__backoff(attempt, e)
+                log_event(
+                    logger,
+                    logging.WARNING,
+                    "retry",
+                    "Call failed with %s, retry %s in %.1fs",
+                    type(e).__name__,
+                    attempt + 1,
+                    delay,
+                    error=type(e).__name__,
+                    attempt=attempt + 1,
+                    delay=delay,
+                )
+                time.sleep(delay)
 
+        dropped_input_tokens, dropped_output_tokens = self.__take_dropped_tokens()
         response = {
             "content": completion.choices[0].message.content,
-            "total_tokens": completion.usage.total_tokens,
-            "input_tokens": completion.usage.prompt_tokens,
-            "output_tokens": completion.usage.completion_tokens,
+            "total_tokens": completion.usage.total_tokens + dropped_input_tokens + dropped_output_tokens,
+            "input_tokens": completion.usage.prompt_tokens + dropped_input_tokens,
+            "output_tokens": completion.usage.completion_tokens + dropped_output_tokens,
         }
+        if self.n_samples > 1:
+            response["samples"] = [choice.message.content for choice in completion.choices]
 
         return response
 
     def calculate_cost(self, input_tokens, output_tokens):
+        if self.base_url is not None and self.model_name not in pricing_option:
+            return 0.0
         if self.model_name not in pricing_option:
             raise ValueError("Model not found in pricing options")
         input_cost, output_cost = pricing_option[self.model_name]
@@ -3,6 +3,10 @@ import yaml
 import logging
 import pandas as pd
 import os
+import csv
+import threading
+from prompt_space import CombinatorialPromptSpace
+from event_log import log_event
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +18,10 @@ def sanitize_model_name(model_name: str):
 
 
 class DataHandlerBase(ABC):
+    def __init__(self):
+        self.save_hooks = []
+        self.data_points = {}
+
     @abstractmethod
     def get_model_name(self):
         pass
@@ -22,17 +30,73 @@ class DataHandlerBase(ABC):
     def return_data_point(self, total=-1):
         pass
 
-    @abstractmethod
-    def get_config_data(self, key):
-        pass
+    def get_config_data(self, key, *default):
+        """
+        Value of a config key. A missing key raises KeyError unless a default
+        is given, as optional keys do.
+        """
+        if default:
+            return self.config.get(key, default[0])
+        return self.config[key]
 
     @abstractmethod
     def save_generated_data(self, content, index, filepath=None):
         pass
 
+    def release_data_points(self, indices):
+        """
+        Called for data points whose item failed and that will not be saved.
+        Handlers that lease their data points stop holding them.
+        """
+
+    def add_save_hook(self, hook):
+        """
+        Register a hook that is notified about every saved response.
+
+        A hook must implement `register_prompts(prompt_df, model)`, which is
+        called once the prompts are read, and `record(data_point, content, model)`,
+        which is called after each successful save.
+        """
+        self.save_hooks.append(hook)
+
+    def _selected_ids(self):
+        """
+        The IDs listed in the file at `id_list_path` (one ID per line, as
+        written by sample_planner.py), or None if the key is not set.
+        """
+        id_list_path = self.get_config_data("id_list_path", None)
+        if id_list_path is None:
+            return None
+        with open(id_list_path, "r", encoding="utf-8") as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def _select_prompts(self, prompt_df):
+        selected_ids = self._selected_ids()
+        if selected_ids is None:
+            return prompt_df
+        prompt_df = prompt_df[prompt_df["ID"].astype(str).isin(selected_ids)]
+        print(f"Prompts in the ID list: {len(prompt_df)}")
+        return prompt_df
+
+    def _register_prompts(self, prompt_df, valid_data_points, model_names=None):
+        self.data_points = {data_point["ID"]: data_point for data_point in valid_data_points}
+        for model_name in model_names or [self.get_model_name()]:
+            for hook in self.save_hooks:
+                hook.register_prompts(prompt_df, sanitize_model_name(model_name))
+
+    def _run_save_hooks(self, content, index, model_name=None):
+        data_point = self.data_points.get(index, {"ID": index})
+        model_name = sanitize_model_name(model_name or self.get_model_name())
+        for hook in self.save_hooks:
+            try:
+                hook.record(data_point, content, model_name)
+            except Exception as e:
+                logger.error(f"Save hook {type(hook).__name__} failed for index {index}: {e}")
+
 
 class DataHandler(DataHandlerBase):
     def __init__(self, config_file_path):
+        super().__init__()
         self.config_file_path = config_file_path
         self.__read_config_file()
 
@@ -55,25 +119,31 @@ class DataHandler(DataHandlerBase):
             f"{model_name}_response.txt",
         )
         if os.path.exists(response_file_path):
-            logger.info(f"Response already exist for index: {index}")
+            log_event(
+                logger,
+                logging.INFO,
+                "skipped",
+                "Response already exist for index: %s",
+                index,
+                index=index,
+            )
             return False
 
         return True
 
     def __create_valid_data_points(self):
-        prompt_df = self.__read_prompts()
+        prompt_df = self._select_prompts(self.__read_prompts())
         prompt_df_valid_mask = prompt_df["ID"].apply(
             lambda x: self.__is_datapoint_eligible(x)
         )
         prompt_df_valid = prompt_df[prompt_df_valid_mask]
-        return prompt_df_valid.to_dict(orient="records")
+        valid_data_points = prompt_df_valid.to_dict(orient="records")
+        self._register_prompts(prompt_df, valid_data_points)
+        return valid_data_points
 
     def get_model_name(self):
         return self.config["model"]
 
-    def get_config_data(self, key):
-        return self.config[key]
-
     def return_data_point(self, total=-1):
         valid_data_points = self.__create_valid_data_points()
 
@@ -112,7 +182,15 @@ class DataHandler(DataHandlerBase):
             # Write the content to the file
             with open(filepath, "w", encoding="utf-8") as file:
                 file.write(content)
-                logger.info(f"Content saved to file: {filepath}\n")
+                log_event(
+                    logger,
+                    logging.INFO,
+                    "saved",
+                    "Content saved to file: %s",
+                    filepath,
+                    index=index,
+                )
+            self._run_save_hooks(content, index)
         except Exception as e:
             # Log any errors that occur during the writing operation
             logger.error(f"Error occurred while writing to file: {e}\n")
@@ -121,6 +199,7 @@ class DataHandler(DataHandlerBase):
 
 class DataHandlerEBE(DataHandlerBase):
     def __init__(self, config_file_path):
+        super().__init__()
         self.config_file_path = config_file_path
         self.__read_config_file()
 
@@ -138,18 +217,18 @@ class DataHandlerEBE(DataHandlerBase):
         return prompt_df
 
     def __create_valid_data_points(self):
-        prompt_df = self.__read_prompts_df()
+        # the full table stays in storage, only the listed IDs are prompted
+        prompt_df = self._select_prompts(self.__read_prompts_df())
         prompt_df_valid = prompt_df[prompt_df["response"].isna()]
         print("Valid Data Points: ", len(prompt_df_valid))
         logger.info(f"Starting from index: {prompt_df_valid['ID'].iloc[0]}\n\n")
-        return prompt_df_valid.to_dict(orient="records")
+        valid_data_points = prompt_df_valid.to_dict(orient="records")
+        self._register_prompts(prompt_df, valid_data_points)
+        return valid_data_points
 
     def get_model_name(self):
         return self.config["model"]
 
-    def get_config_data(self, key):
-        return self.config[key]
-
     def return_data_point(self, total=-1):
         valid_data_points = self.__create_valid_data_points()
 
@@ -185,7 +264,15 @@ class DataHandlerEBE(DataHandlerBase):
 
             # Save the updated DataFrame back to the CSV file
             prompt_df.to_csv(self.config["storage_path"], index=False)
-            logger.info(f"Content saved to 'response' field in CSV at index {index}\n")
+            log_event(
+                logger,
+                logging.INFO,
+                "saved",
+                "Content saved to 'response' field in CSV at index %s",
+                index,
+                index=index,
+            )
+            self._run_save_hooks(content, index)
         except Exception as e:
             # Log any errors that occur during the updating operation
             logger.error(f"Error occurred while updating the CSV file: {e}\n")
@@ -194,6 +281,7 @@ class DataHandlerEBE(DataHandlerBase):
 
 class DataHandlerIBE(DataHandlerBase):
     def __init__(self, config_file_path):
+        super().__init__()
         self.config_file_path = config_file_path
         self.__read_config_file()
 
@@ -211,19 +299,19 @@ class DataHandlerIBE(DataHandlerBase):
         return prompt_df
 
     def __create_valid_data_points(self):
-        prompt_df = self.__read_prompts_df()
+        # the full table stays in storage, only the listed IDs are prompted
+        prompt_df = self._select_prompts(self.__read_prompts_df())
 
         prompt_df_valid = prompt_df[prompt_df["response"].isna()]
         print("Valid Data Points: ", len(prompt_df_valid))
         logger.info(f"Starting from index: {prompt_df_valid['ID'].iloc[0]}\n\n")
-        return prompt_df_valid.to_dict(orient="records")
+        valid_data_points = prompt_df_valid.to_dict(orient="records")
+        self._register_prompts(prompt_df, valid_data_points)
+        return valid_data_points
 
     def get_model_name(self):
         return self.config["model"]
 
-    def get_config_data(self, key):
-        return self.config[key]
-
     def return_data_point(self, total=-1):
         valid_data_points = self.__create_valid_data_points()
 
@@ -259,13 +347,228 @@ class DataHandlerIBE(DataHandlerBase):
 
             # Save the updated DataFrame back to the CSV file
             prompt_df.to_csv(self.config["storage_path"], index=False)
-            logger.info(f"Content saved to 'response' field in CSV at index {index}\n")
+            log_event(
+                logger,
+                logging.INFO,
+                "saved",
+                "Content saved to 'response' field in CSV at index %s",
+                index,
+                index=index,
+            )
+            self._run_save_hooks(content, index)
         except Exception as e:
             # Log any errors that occur during the updating operation
             logger.error(f"Error occurred while updating the CSV file: {e}\n")
             pass  # Skip the operation if an error occurs
 
 
+class DataHandlerVirtual(DataHandlerBase):
+    """
+    Data handler over a virtual CombinatorialPromptSpace.
+
+    The prompts are computed on demand from the adjective list and the prompt
+    templates instead of being read from a prompt file. IDs are derived from
+    the words of each prompt, so they stay the same across regenerations.
+    Responses are stored per ID like in `DataHandler`.
+
+    Optional config keys: `sample_seed` to visit the prompts in a seeded random
+    order, and `num_shards` / `shard_index` to process one contiguous range of
+    that order.
+    """
+
+    def __init__(self, config_file_path):
+        super().__init__()
+        self.config_file_path = config_file_path
+        self.__read_config_file()
+        self.space = CombinatorialPromptSpace.from_files(
+            self.config["adjective_data_path"],
+            self.config["prompt_template_path"],
+            self.config["topic"],
+        )
+
+    def __read_config_file(self):
+        with open(self.config_file_path, "r") as f:
+            self.config = yaml.safe_load(f)
+
+    def __response_filename(self):
+        return f"{sanitize_model_name(self.config['model'])}_response.txt"
+
+    def __completed_ids(self):
+        storage_path = self.config["storage_folder_path"]
+        if not os.path.exists(storage_path):
+            return set()
+        filename = self.__response_filename()
+        completed = set()
+        with os.scandir(storage_path) as entries:
+            for entry in entries:
+                if entry.is_dir() and os.path.exists(os.path.join(entry.path, filename)):
+                    completed.add(entry.name)
+        return completed
+
+    def get_model_name(self):
+        return self.config["model"]
+
+    def return_data_point(self, total=-1):
+        completed = self.__completed_ids()
+        selected_ids = self._selected_ids()
+        print(f"\nPrompt space size: {len(self.space)}, completed: {len(completed)}")
+        self._register_prompts(self.space.cell_counts(), [])
+
+        count = 0
+        for i in self.space.iter_indices(
+            seed=self.config.get("sample_seed"),
+            shard_index=self.config.get("shard_index", 0),
+            num_shards=self.config.get("num_shards", 1),
+        ):
+            data_point = self.space[i]
+            if data_point["ID"] in completed:
+                continue
+            if selected_ids is not None and data_point["ID"] not in selected_ids:
+                continue
+            self.data_points[data_point["ID"]] = data_point
+            yield data_point
+            count += 1
+            if count == total:
+                break
+
+    def save_generated_data(self, content, index, filepath=None):
+        """
+        Save generated data to the response file of the data point.
+
+        Args:
+            content (str): The content to be saved.
+            index (str): The ID of the data point.
+            filepath (str, optional): The file path relative to the storage folder.
+        """
+        if filepath is None:
+            folder_path = os.path.join(self.config["storage_folder_path"], str(index))
+            os.makedirs(folder_path, exist_ok=True)
+            filepath = os.path.join(folder_path, self.__response_filename())
+        else:
+            filepath = os.path.join(self.config["storage_folder_path"], filepath)
+
+        try:
+            with open(filepath, "w", encoding="utf-8") as file:
+                file.write(content)
+                log_event(
+                    logger,
+                    logging.INFO,
+                    "saved",
+                    "Content saved to file: %s",
+                    filepath,
+                    index=index,
+                )
+            self._run_save_hooks(content, index)
+        except Exception as e:
+            logger.error(f"Error occurred while writing to file: {e}\n")
+        finally:
+            self.data_points.pop(index, None)
+
+
+class DataHandlerMultiModel(DataHandlerBase):
+    """
+    Data handler for running several models over the same prompts in one pass.
+
+    The models are listed under `models` in the config, either as a name or
+    as a mapping with a `name` and backend options such as `device`. Each
+    prompt of `prompt_data_path` is read once and yielded with the models
+    that have not answered it yet in `pending_models`. Responses are appended
+    to one long table at `storage_path` with one row per (ID, model), so
+    every model resumes on its own.
+    """
+
+    storage_columns = ["ID", "model", "response"]
+
+    def __init__(self, config_file_path):
+        super().__init__()
+        self.config_file_path = config_file_path
+        self.__read_config_file()
+        # responses of several models are saved from different threads
+        self.lock = threading.Lock()
+
+    def __read_config_file(self):
+        with open(self.config_file_path, "r") as f:
+            self.config = yaml.safe_load(f)
+
+    def get_model_configs(self):
+        return [
+            {"name": model} if isinstance(model, str) else dict(model)
+            for model in self.config["models"]
+        ]
+
+    def get_model_names(self):
+        return [model["name"] for model in self.get_model_configs()]
+
+    def get_model_name(self):
+        return ", ".join(self.get_model_names())
+
+    def __completed(self):
+        storage_path = self.config["storage_path"]
+        if not os.path.exists(storage_path):
+            return set()
+        storage_df = pd.read_csv(storage_path, usecols=["ID", "model"], dtype=str)
+        return set(zip(storage_df["ID"], storage_df["model"]))
+
+    def return_data_point(self, total=-1):
+        prompt_df = pd.read_csv(self.config["prompt_data_path"])
+        print(f"\nSelected data points length: {len(prompt_df)}")
+        prompt_df = self._select_prompts(prompt_df)
+        model_names = self.get_model_names()
+        completed = self.__completed()
+
+        valid_data_points = []
+        for data_point in prompt_df.to_dict(orient="records"):
+            pending_models = [
+                model_name
+                for model_name in model_names
+                if (str(data_point["ID"]), model_name) not in completed
+            ]
+            if pending_models:
+                data_point["pending_models"] = pending_models
+                valid_data_points.append(data_point)
+        print("Valid Data Points: ", len(valid_data_points))
+        self._register_prompts(prompt_df, valid_data_points, model_names)
+
+        for i, data_point in enumerate(valid_data_points):
+            yield data_point
+            if i == total - 1:
+                break
+
+    def save_generated_data(self, content, index, model_name):
+        """
+        Append the response of one model to the long response table.
+
+        Args:
+            content (str): The content to be saved.
+            index (int): The ID of the data point.
+            model_name (str): The model name as listed in the config.
+        """
+        storage_path = self.config["storage_path"]
+        try:
+            with self.lock:
+                write_header = not os.path.exists(storage_path)
+                if write_header:
+                    os.makedirs(os.path.dirname(storage_path) or ".", exist_ok=True)
+                with open(storage_path, "a", encoding="utf-8", newline="") as f:
+                    writer = csv.writer(f)
+                    if write_header:
+                        writer.writerow(self.storage_columns)
+                    writer.writerow([index, model_name, str(content)])
+                log_event(
+                    logger,
+                    logging.INFO,
+                    "saved",
+                    "Content of %s saved for index %s",
+                    model_name,
+                    index,
+                    index=index,
+                    model=model_name,
+                )
+                self._run_save_hooks(content, index, model_name)
+        except Exception as e:
+            logger.error(f"Error occurred while writing to the response table: {e}\n")
+
+
 if __name__ == "__main__":
     data_handler = DataHandlerEBE("config_ebe.yaml")
 
@@ -0,0 +1,243 @@
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import shutil
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+default_max_bytes = 100 * 1024 * 1024
+default_backup_count = 10
+
+
+def log_event(logger, level, event, msg, *args, **fields):
+    """
+    Log a structured event. The message is %-formatted lazily by the
+    background writer, and `fields` are written as JSON values.
+
+        log_event(logger, logging.INFO, "saved", "Content saved for index %s", index, index=index)
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, extra={"event": event, "fields": fields})
+
+
+class EventFilter(logging.Filter):
+    """
+    Per event type level threshold and sampling rate.
+
+    `events` maps an event type to {"level": ..., "sample": ...}. Records
+    without an event type are of type "message". Records at WARNING or above
+    are never sampled away.
+    """
+
+    def __init__(self, events=None, seed=None) -> None:
+        super().__init__()
+        self.levels = {}
+        self.samples = {}
+        for event, options in (events or {}).items():
+            if "level" in options:
+                self.levels[event] = self.level_number(event, options["level"])
+            if "sample" in options:
+                self.samples[event] = float(options["sample"])
+                if not 0 <= self.samples[event] <= 1:
+                    raise ValueError(f"Invalid sample rate for event {event}: {options['sample']}")
+        self.rng = random.Random(seed)
+
+    @staticmethod
+    def level_number(event, level):
+        if isinstance(level, int):
+            return level
+        number = logging.getLevelName(str(level).upper())
+        # getLevelName returns the string "Level X" for unknown names
+        if not isinstance(number, int):
+            raise ValueError(f"Invalid log level for event {event}: {level}")
+        return number
+
+    def filter(self, record):
+        event = getattr(record, "event", "message")
+        if record.levelno < self.levels.get(event, logging.NOTSET):
+            return False
+        sample = self.samples.get(event)
+        if sample is not None and record.levelno < logging.WARNING:
+            return self.rng.random() < sample
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that leaves the message formatting to the listener thread.
+    Only the exception traceback is rendered here, while it is still available.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonLineFormatter(logging.Formatter):
+    def format(self, record):
+        event = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": getattr(record, "event", "message"),
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            event["fields"] = fields
+        if record.exc_text:
+            event["exception"] = record.exc_text
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+def gzip_rotator(source, destination):
+    with open(source, "rb") as f_in, gzip.open(destination, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def setup_event_log(log_path, options=None, level=logging.INFO):
+    """
+    Route all logging through a queue to a background thread that writes
+    JSON lines to log_path.
+
+    options (the `event_log` section of a config) may set `max_bytes` and
+    `backup_count` for rotation, `compress` to gzip rotated files, and
+    `events` with per event type `level` and `sample`. Every run starts
+    with a `run_start` event that records these `events` options, so that
+    readers of the log know which events were sampled.
+
+    Returns:
+        QueueListener: already started; it is stopped at exit.
+    """
+    options = options or {}
+    os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_path,
+        maxBytes=options.get("max_bytes", default_max_bytes),
+        backupCount=options.get("backup_count", default_backup_count),
+        encoding="utf-8",
+    )
+    if options.get("compress", True):
+        file_handler.namer = lambda name: f"{name}.gz"
+        file_handler.rotator = gzip_rotator
+    file_handler.setFormatter(JsonLineFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    # filtering happens before the record is queued, so dropped events cost almost nothing
+    queue_handler.addFilter(EventFilter(options.get("events")))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    log_event(
+        logger,
+        logging.INFO,
+        "run_start",
+        "Run started, process %s",
+        os.getpid(),
+        pid=os.getpid(),
+        events=options.get("events") or {},
+    )
+    return listener
+
+
+def open_log(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def read_events(paths, events=None, min_level=logging.NOTSET):
+    for path in paths:
+        with open_log(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                event = json.loads(line)
+                if events and event["event"] not in events:
+                    continue
+                if logging.getLevelName(event["level"]) < min_level:
+                    continue
+                yield event
+
+
+def render_event(event):
+    text = f"{event['time']} {event['level']}:{event['logger']}:{event['message']}"
+    if "exception" in event:
+        text = f"{text}\n{event['exception']}"
+    return text
+
+
+def rotated_files(log_path):
+    """
+    The rotated files of a log, oldest first, followed by the log itself.
+    """
+    directory = os.path.dirname(log_path) or "."
+    prefix = os.path.basename(log_path) + "."
+    backups = []
+    for name in os.listdir(directory):
+        suffix = name[len(prefix) :].removesuffix(".gz")
+        if name.startswith(prefix) and suffix.isdigit():
+            backups.append((int(suffix), os.path.join(directory, name)))
+    return [path for _, path in sorted(backups, reverse=True)] + [log_path]
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    render_parser = subparsers.add_parser("render", help="Print an event log as text")
+    render_parser.add_argument("log", type=str, help="event log, rotated files are included")
+    render_parser.add_argument("--event", type=str, nargs="*", default=None)
+    render_parser.add_argument("--level", type=str, default="NOTSET")
+    render_parser.add_argument("--output", type=str, default=None)
+
+    count_parser = subparsers.add_parser("count", help="Count events per type and level")
+    count_parser.add_argument("log", type=str)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    paths = rotated_files(args.log)
+
+    if args.command == "render":
+        events = read_events(paths, args.event, logging.getLevelName(args.level.upper()))
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                for event in events:
+                    f.write(render_event(event) + "\n")
+        else:
+            try:
+                for event in events:
+                    print(render_event(event))
+            except BrokenPipeError:
+                # the output was piped into a command like head
+                pass
+    else:
+        counts = {}
+        for event in read_events(paths):
+            key = (event["event"], event["level"])
+            counts[key] = counts.get(key, 0) + 1
+        for (event, level), count in sorted(counts.items()):
+            print(f"{event:<24} {level:<8} {count:>10}")
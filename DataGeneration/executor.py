@@ -1,15 +1,262 @@
 from data_handler import *
 from prompt_creator import *
 from Llama3 import *
+from chatgpt import ChatgptModel
 from datetime import datetime
+import queue
+import sys
+import yaml
+import threading
 from tqdm import tqdm
 from response_processor import *
+from di_aggregator import DIAggregator, normalized_option_numbers
+from results_store import ResultsStore
+from openai_batch import export_batch, import_batch
+from event_log import log_event, setup_event_log
+from work_queue import QueuedDataHandler
+from adaptive_sampler import AdaptiveDataHandler
+from answer_distribution import AnswerDistributionStore, majority_vote
+from autotune import load_machine_profile
+from synthetic_model import SyntheticModel, answers_by_processor
+from failed_items import FailedItemLog
+from option_orders import (
+    bangla_digits,
+    combine_orders,
+    option_labels,
+    option_orders,
+    permuted_prompt,
+    split_options,
+    undetermined_answer,
+)
+from run_estimator import (
+    estimate_run,
+    print_estimate,
+    read_benchmark_throughput,
+    read_log_throughput,
+)
 
 logger = logging.getLogger(__name__)
 # To add the variables from .env file
 #  export $(cat .env | xargs) && env
 
 
+def process_samples(model_response, response_processor: ResponseProcessorBase):
+    """
+    Run every sample of a model response through the response processor.
+
+    Returns:
+        tuple: (status, processed response, accepted answers); the processed
+        response is the majority vote of the accepted answers, or the first
+        rejected one if no answer was accepted.
+    """
+    processed = [
+        response_processor.process_response(sample)
+        for sample in model_response.get("samples", [model_response["content"]])
+    ]
+    answers = [answer for status, answer in processed if status == 1]
+    if answers:
+        return 1, majority_vote(answers), answers
+    status, modified_response = processed[0]
+    return status, modified_response, answers
+
+
+def run_item(
+    data_point: dict,
+    prompt_creator: PromptCreator,
+    model: Model,
+    response_processor: ResponseProcessorBase,
+):
+    """
+    Prompt the model with one data point, and once more with the refined
+    prompt if the first response is rejected by the response processor.
+
+    If the model returns several `samples`, each one is run through the
+    response processor and the majority vote of the accepted answers is the
+    processed response. The prompt is only refined if no sample is accepted.
+
+    Returns:
+        tuple: (status, processed response, input tokens, output tokens,
+        accepted answers of the samples of the last turn)
+    """
+    input_tokens = 0
+    output_tokens = 0
+    try:
+        for iteration in range(2):
+            log_event(logger, logging.INFO, "iteration", "Iteration: %s", iteration, iteration=iteration)
+            if iteration == 0:
+                prompt = prompt_creator.create_prompt(
+                    prompt=data_point["prompt"],
+                )
+            else:
+                prompt = prompt_creator.refine_prompt(
+                    prompt_list=prompt,
+                    response=response,
+                )
+
+            model_response = model.create_response(prompt)
+            response = model_response["content"]
+            status, modified_response, answers = process_samples(model_response, response_processor)
+
+            input_tokens += model_response.get("input_tokens", 0)
+            output_tokens += model_response.get("output_tokens", 0)
+            if status == 1:
+                break
+    finally:
+        model.finish_item()
+
+    return status, modified_response, input_tokens, output_tokens, answers
+
+
+def run_batch(
+    data_points: list,
+    prompt_creator: PromptCreator,
+    model: Model,
+    response_processor: ResponseProcessorBase,
+):
+    """
+    `run_item` for several data points: the first turns are generated in one
+    batch and the refinement turns of the rejected ones in a second batch.
+
+    Returns:
+        list: One `run_item` result per data point.
+    """
+    prompts = [prompt_creator.create_prompt(prompt=data_point["prompt"]) for data_point in data_points]
+    results = [None] * len(data_points)
+    pending = list(range(len(data_points)))
+    try:
+        for iteration in range(2):
+            log_event(logger, logging.INFO, "iteration", "Iteration: %s", iteration, iteration=iteration)
+            model_responses = model.create_responses([prompts[i] for i in pending])
+            rejected = []
+            for i, model_response in zip(pending, model_responses):
+                status, modified_response, answers = process_samples(model_response, response_processor)
+                input_tokens, output_tokens = (results[i] or (0, 0, 0, 0))[2:4]
+                results[i] = (
+                    status,
+                    modified_response,
+                    input_tokens + model_response.get("input_tokens", 0),
+                    output_tokens + model_response.get("output_tokens", 0),
+                    answers,
+                )
+                if status == 0:
+                    prompts[i] = prompt_creator.refine_prompt(
+                        prompt_list=prompts[i],
+                        response=model_response["content"],
+                    )
+                    rejected.append(i)
+            pending = rejected
+            if not pending:
+                break
+    finally:
+        model.finish_item()
+    return results
+
+
+def run_option_orders(
+    data_point: dict,
+    prompt_creator: PromptCreator,
+    model: Model,
+    response_processor: ResponseProcessorBase,
+    mode: str = "cyclic",
+    min_option_mass: float = 0.5,
+):
+    """
+    Evaluate an EBE or IBE data point with its options in several orders
+    (see `option_orders`) and combine them into one answer per persona, so
+    that a preference for the first option does not enter the DI.
+
+    Backends with `option_probabilities` score all orderings from one shared
+    prefill; the others answer every ordering with `run_batch` and each
+    accepted answer counts as probability one. Scores where the option
+    numbers have less than `min_option_mass` of the next token probability
+    in some ordering are not trusted, and the orderings are answered with
+    `run_batch` instead.
+
+    Returns:
+        tuple: As `run_item`. The processed response is the option number of
+        the combined persona in the order of the prompt file, so that
+        `firstOption` and `serial` still resolve it, or "undetermined" with
+        status 0 if several personas tie. The answers are the
+        option numbers picked by the orderings (None if an ordering had no
+        answer), in the same order.
+    """
+    parts = split_options(data_point["prompt"])
+    if parts is None:
+        raise ValueError(f"No numbered options in the prompt of {data_point['ID']}")
+    count = len(parts[2])
+    labels = option_labels(data_point, count)
+    orders = option_orders(count, mode)
+    prompts = [permuted_prompt(parts, order) for order in orders]
+
+    rejected_response = None
+    try:
+        scored = model.option_probabilities(
+            [prompt_creator.create_prompt(prompt=prompt) for prompt in prompts], count
+        )
+    finally:
+        model.finish_item()
+    if scored is not None and min(scored["mass"]) < min_option_mass:
+        log_event(
+            logger,
+            logging.WARNING,
+            "option_mass",
+            "Option numbers of %s have %.3f of the probability, answering by generation",
+            data_point["ID"],
+            min(scored["mass"]),
+            index=data_point["ID"],
+            mass=scored["mass"],
+        )
+        scored = None
+    if scored is not None:
+        probabilities = scored["probabilities"]
+        input_tokens, output_tokens = scored["input_tokens"], 0
+    else:
+        results = run_batch(
+            [{**data_point, "prompt": prompt} for prompt in prompts], prompt_creator, model, response_processor
+        )
+        probabilities = []
+        for status, modified_response, *_ in results:
+            position = None
+            if status == 1:
+                position = normalized_option_numbers.get(normalize(str(modified_response).strip()))
+            probabilities.append([float(position == i) for i in range(count)])
+        rejected_response = results[0][1]
+        input_tokens = sum(result[2] for result in results)
+        output_tokens = sum(result[3] for result in results)
+
+    label, scores, picks = combine_orders(orders, labels, probabilities)
+    log_event(
+        logger,
+        logging.INFO,
+        "option_orders",
+        "Option orders of %s: %s",
+        data_point["ID"],
+        picks,
+        index=data_point["ID"],
+        orders=[list(order) for order in orders],
+        picks=picks,
+        scores=scores,
+    )
+    answers = [None if pick is None else bangla_digits[labels.index(pick)] for pick in picks]
+    if label is None and any(pick is not None for pick in picks):
+        # the orderings disagree evenly, no option is preferred
+        return 0, undetermined_answer, input_tokens, output_tokens, answers
+    if label is None:
+        return 0, rejected_response, input_tokens, output_tokens, answers
+    return 1, bangla_digits[labels.index(label)], input_tokens, output_tokens, answers
+
+
+def batched(data_points, batch_size):
+    batch = []
+    for data_point in data_points:
+        batch.append(data_point)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 def generate_inference_data(
     data_handler: DataHandlerBase,
     prompt_creator: PromptCreator,
@@ -17,62 +264,308 @@ def generate_inference_data(
     response_processor: ResponseProcessor,
     total: int = -1,
     calcualate_cost: bool = False,
+    answer_store: AnswerDistributionStore = None,
+    batch_size: int = 1,
+    failed_items: FailedItemLog = None,
+    option_order_mode: str = None,
+    min_option_mass: float = 0.5,
 ):
     datapoints = data_handler.return_data_point(total)
     total_input_tokens = 0
     total_output_tokens = 0
-    current_input_tokens = 0
-    current_output_tokens = 0
-    for data_point in tqdm(datapoints):
-        current_index = data_point["ID"]
-        logger.info(f"Current index: {current_index}")
+    progress = tqdm()
+    for batch in batched(datapoints, batch_size):
+        for data_point in batch:
+            log_event(logger, logging.INFO, "item", "Current index: %s", data_point["ID"], index=data_point["ID"])
 
         try:
-            for iteration in range(2):
-                logger.info("Iteration: " + str(iteration))
-                if iteration == 0:
-                    prompt = prompt_creator.create_prompt(
-                        prompt=data_point["prompt"],
-                    )
-                else:
-                    prompt = prompt_creator.refine_prompt(
-                        prompt_list=prompt,
-                        response=response,
+            if option_order_mode is not None:
+                results = [
+                    run_option_orders(
+                        data_point, prompt_creator, model, response_processor, option_order_mode, min_option_mass
                     )
-
-                model_response = model.create_response(prompt)
-                response = model_response["content"]
-                (status, modified_response) = response_processor.process_response(
-                    response
-                )
-
-                if calcualate_cost:
-                    current_input_tokens = model_response["input_tokens"]
-                    current_output_tokens = model_response["output_tokens"]
-                if status == 1:
-                    break
+                    for data_point in batch
+                ]
+            elif batch_size == 1:
+                results = [run_item(batch[0], prompt_creator, model, response_processor)]
+            else:
+                results = run_batch(batch, prompt_creator, model, response_processor)
         except Exception as e:
-            logger.error(f"Error in creating response for index {current_index}")
+            logger.error(f"Error in creating response for index {', '.join(str(dp['ID']) for dp in batch)}")
             logger.error(e)
+            if failed_items is not None:
+                failed_items.record([dp["ID"] for dp in batch], data_handler.get_model_name(), e)
+            data_handler.release_data_points([dp["ID"] for dp in batch])
+            progress.update(len(batch))
             continue
 
-        if status == 0:
-            logger.error(f"INCORRECT RESPONSE FOR {current_index}: {modified_response}")
-        data_handler.save_generated_data(modified_response, index=current_index)
+        for data_point, result in zip(batch, results):
+            current_index = data_point["ID"]
+            (
+                status,
+                modified_response,
+                current_input_tokens,
+                current_output_tokens,
+                answers,
+            ) = result
 
-        if calcualate_cost:
-            total_input_tokens += current_input_tokens
-            total_output_tokens += current_output_tokens
-            cost = model.calculate_cost(current_input_tokens, current_output_tokens)
-            cost_till_now = model.calculate_cost(
-                total_input_tokens, total_output_tokens
-            )
-            logger.info(
-                f"Cost for index {current_index}: {cost}, Total cost: {cost_till_now}"
+            if status == 0:
+                log_event(
+                    logger,
+                    logging.ERROR,
+                    "incorrect_response",
+                    "INCORRECT RESPONSE FOR %s: %s",
+                    current_index,
+                    modified_response,
+                    index=current_index,
+                    response=modified_response,
+                )
+            data_handler.save_generated_data(modified_response, index=current_index)
+            if answer_store is not None:
+                samples = model.n_samples
+                if option_order_mode is not None:
+                    # one answer per ordering, the orderings without one are counted as invalid
+                    samples = len(answers)
+                    answers = [answer for answer in answers if answer is not None]
+                answer_store.record(
+                    current_index, data_handler.get_model_name(), answers, samples
+                )
+
+            if calcualate_cost:
+                total_input_tokens += current_input_tokens
+                total_output_tokens += current_output_tokens
+                cost = model.calculate_cost(current_input_tokens, current_output_tokens)
+                cost_till_now = model.calculate_cost(
+                    total_input_tokens, total_output_tokens
+                )
+                logger.info(
+                    f"Cost for index {current_index}: {cost}, Total cost: {cost_till_now}"
+                )
+        progress.update(len(batch))
+    progress.close()
+
+
+def generate_multi_model_data(
+    data_handler: DataHandlerMultiModel,
+    prompt_creator: PromptCreator,
+    models: dict,
+    response_processor: ResponseProcessorBase,
+    total: int = -1,
+    answer_store: AnswerDistributionStore = None,
+    failed_items: FailedItemLog = None,
+):
+    """
+    Run every prompt through all models of a multi model data handler.
+
+    The prompts are read once and handed to one worker thread per model, so
+    the backends run in parallel and a slow backend does not hold back the
+    others. Each model only gets the prompts it has not answered yet.
+    """
+    queues = {model_name: queue.Queue() for model_name in models}
+    progress = tqdm(desc="responses")
+
+    def worker(model_name):
+        model = models[model_name]
+        while True:
+            data_point = queues[model_name].get()
+            if data_point is None:
+                break
+            current_index = data_point["ID"]
+            try:
+                status, modified_response, _, _, answers = run_item(
+                    data_point, prompt_creator, model, response_processor
+                )
+            except Exception as e:
+                logger.error(f"Error in creating response of {model_name} for index {current_index}")
+                logger.error(e)
+                if failed_items is not None:
+                    failed_items.record([current_index], model_name, e)
+                # failed items are counted too, as in generate_inference_data
+                progress.update(1)
+                continue
+
+            if status == 0:
+                log_event(
+                    logger,
+                    logging.ERROR,
+                    "incorrect_response",
+                    "INCORRECT RESPONSE OF %s FOR %s: %s",
+                    model_name,
+                    current_index,
+                    modified_response,
+                    index=current_index,
+                    model=model_name,
+                    response=modified_response,
+                )
+            data_handler.save_generated_data(
+                modified_response, index=current_index, model_name=model_name
             )
+            if answer_store is not None:
+                answer_store.record(current_index, model_name, answers, model.n_samples)
+            progress.update(1)
+
+    threads = [
+        threading.Thread(target=worker, args=(model_name,), daemon=True)
+        for model_name in models
+    ]
+    for thread in threads:
+        thread.start()
+
+    for data_point in data_handler.return_data_point(total):
+        for model_name in data_point["pending_models"]:
+            queues[model_name].put(data_point)
+    for model_queue in queues.values():
+        model_queue.put(None)
+
+    for thread in threads:
+        thread.join()
+    progress.close()
+
+
+def create_data_handler(name: str, config_path: str) -> DataHandlerBase:
+    if name == "template":
+        data_handler = DataHandler(config_path)
+        logger.info(f"Template Based Data Handler")
+    elif name == "virtual":
+        data_handler = DataHandlerVirtual(config_path)
+        logger.info(f"Virtual Template Based Data Handler")
+    elif name == "multi":
+        data_handler = DataHandlerMultiModel(config_path)
+        logger.info(f"Multi Model Data Handler")
+    elif name == "ibe":
+        data_handler = DataHandlerIBE(config_path)
+        logger.info(f"IBE Based Data Handler")
+    else:
+        data_handler = DataHandlerEBE(config_path)
+        logger.info(f"EBE Based Data Handler")
+    return data_handler
+
+
+def create_response_processor(version: str) -> ResponseProcessorBase:
+    if version == "base":
+        return ResponseProcessor()
+    elif version == "ibe":
+        return ResponseProcessorIBE()
+    elif version == "ebe":
+        return ResponseProcessorEBE()
+    else:
+        raise ValueError("Invalid response_processor_version")
+
+
+def create_model(
+    data_handler: DataHandlerBase, token: str, model_config: dict = None
+) -> Model:
+    """
+    Create a model from the config. `model_config` is one entry of the
+    `models` list of a multi model config; its keys take precedence over
+    the top level keys of the config.
+
+    The backend is `openai` for gpt models and `llama3` otherwise, unless
+    `backend` is set. The openai backend reads `base_url` to use another
+    server of the OpenAI API, e.g. a local `model_server.py`, and `timeout`,
+    `max_retries`, `hedge`, `hedge_quantile` and `hedge_min_samples` for its calls. The
+    `synthetic` backend answers without a model, with the `SyntheticModel`
+    arguments of the `synthetic` key. Optional llama3 keys: `device` (default cuda:0),
+    `quantize` (default true, ignored on CPU), `assistant_model`, a small
+    draft model for assisted decoding, and `reuse_kv_cache`,
+    `kv_cache_max_items` and `kv_cache_max_tokens` for the prompt KV cache
+    that is reused by the refinement turn. `n_samples` (default 1) is the
+    number of responses sampled per prompt by either backend.
+    `num_threads` and `num_interop_threads` size the torch CPU thread pools;
+    they default to the machine profile written by `autotune.py`.
+    `pretokenized_dir` is the cache directory of `pretokenize.py`.
+    """
+    model_config = model_config or {}
+    profile = machine_profile(data_handler, model_config)
+
+    def option(key, default=None):
+        return model_config.get(key, data_handler.get_config_data(key, profile.get(key, default)))
+
+    model_name = model_config.get("name", data_handler.get_model_name())
+    backend = option("backend", "openai" if model_name.startswith("gpt") else "llama3")
+    if backend == "openai":
+        return ChatgptModel(
+            model_name,
+            n_samples=option("n_samples", 1),
+            base_url=option("base_url"),
+            timeout=option("timeout", 60.0),
+            max_retries=option("max_retries", 4),
+            hedge=option("hedge", False),
+            hedge_quantile=option("hedge_quantile", 0.95),
+            hedge_min_samples=option("hedge_min_samples", 20),
+        )
+    elif backend == "synthetic":
+        return SyntheticModel(
+            model_name,
+            answers=answers_by_processor.get(data_handler.get_config_data("response_processor_version")),
+            n_samples=option("n_samples", 1),
+            **option("synthetic", {}),
+        )
+    elif backend == "llama3":
+        return Llama3(
+            model_name=model_name,
+            device=option("device", "cuda:0"),
+            token=token,
+            assistant_model_name=option("assistant_model"),
+            quantize=option("quantize", True),
+            reuse_kv_cache=option("reuse_kv_cache", True),
+            kv_cache_max_items=option("kv_cache_max_items", 4),
+            kv_cache_max_tokens=option("kv_cache_max_tokens", 16384),
+            n_samples=option("n_samples", 1),
+            num_threads=option("num_threads"),
+            num_interop_threads=option("num_interop_threads"),
+            pretokenized_dir=option("pretokenized_dir"),
+            prompt_data_path=data_handler.get_config_data("prompt_data_path", None),
+            template_version=data_handler.get_config_data("template_version"),
+        )
+    else:
+        raise ValueError(f"Invalid backend: {backend}")
+
+
+def machine_profile(data_handler: DataHandlerBase, model_config: dict = None) -> dict:
+    """
+    The settings `autotune.py` found for the model and device of a config on
+    this machine, an empty dict if it was not tuned here.
+    """
+    model_config = model_config or {}
+    model_name = model_config.get("name", data_handler.get_model_name())
+    device = model_config.get("device", data_handler.get_config_data("device", "cuda:0"))
+    return load_machine_profile(model_name, device)
+
+
+def attach_save_hooks(data_handler: DataHandlerBase, results: bool = True):
+    """
+    Attach the save hooks of the config: the running DI counts
+    (`di_state_path`) and, if `results` is set, the results database
+    (`results_db_path`).
 
-            current_input_tokens = 0
-            current_output_tokens = 0
+    Returns:
+        DIAggregator: The DI aggregator, None if `di_state_path` is not set.
+    """
+    template_version = data_handler.get_config_data("template_version")
+
+    di_aggregator = None
+    di_state_path = data_handler.get_config_data("di_state_path", None)
+    if di_state_path is not None:
+        di_aggregator = DIAggregator(
+            di_state_path,
+            probe=template_version,
+            flush_every=data_handler.get_config_data("di_flush_every", 1),
+        )
+        data_handler.add_save_hook(di_aggregator)
+        logger.info(f"Running DI counts are stored in: {di_state_path}")
+
+    results_db_path = data_handler.get_config_data("results_db_path", None)
+    if results_db_path is not None and results:
+        data_handler.add_save_hook(
+            ResultsStore(
+                results_db_path,
+                probe=template_version,
+                topic=data_handler.get_config_data("topic", None),
+            )
+        )
+        logger.info(f"Responses are also written to the results database: {results_db_path}")
+    return di_aggregator
 
 
 def sanitize_log_name(filename):
@@ -87,56 +580,196 @@ def parse_arguments():
     parser.add_argument("--total", type=int, default=-1)
     parser.add_argument("--calculate_cost", type=bool, default=False)
     parser.add_argument("--datahandler", type=str, default="template")
+    parser.add_argument(
+        "--mode",
+        type=str,
+        default="generate",
+        choices=["generate", "batch_export", "batch_import", "dry_run"],
+        help="batch modes write and read OpenAI Batch API files instead of running the model, "
+        "dry_run estimates the tokens, cost and time of a run",
+    )
+    parser.add_argument("--batch_input", type=str, default="../Data/batch_input.jsonl")
+    parser.add_argument("--batch_output", type=str, default="../Data/batch_output.jsonl")
+    parser.add_argument("--batch_retry", type=str, default="../Data/batch_retry.jsonl")
+    parser.add_argument("--benchmark", type=str, default=None, help="benchmark.py report for dry_run")
+    parser.add_argument(
+        "--throughput_log", type=str, default=None, help="event log of an earlier run for dry_run"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="executor processes sharing the work queue, defaults to the machine profile",
+    )
     return parser.parse_args()
 
 
+def start_workers(workers):
+    """
+    Start `workers - 1` more executors with the same arguments; they share the
+    prompts of this one through the work queue.
+    """
+    import subprocess
+
+    processes = [
+        subprocess.Popen([sys.executable, sys.argv[0], *sys.argv[1:], "--workers", "1"])
+        for _ in range(workers - 1)
+    ]
+    logger.info(f"Started {len(processes)} more workers")
+    return processes
+
+
 if __name__ == "__main__":
     args = parse_arguments()
 
-    logging.basicConfig(
-        filename=sanitize_log_name(f"./logs/data_generation_{datetime.now()}.log"),
-        level=logging.INFO,
+    with open(args.config, "r") as f:
+        event_log_options = yaml.safe_load(f).get("event_log")
+    setup_event_log(
+        sanitize_log_name(f"./logs/data_generation_{datetime.now()}.jsonl"),
+        event_log_options,
     )
 
-    with open("./hf_token.txt", "r") as f:
-        token = f.read().strip()
-
-    if args.datahandler == "template":
-        data_handler = DataHandler(args.config)
-        logger.info(f"Template Based Data Handler")
-    elif args.datahandler == "ibe":
-        data_handler = DataHandlerIBE(args.config)
-        logger.info(f"IBE Based Data Handler")
-    else:
-        data_handler = DataHandlerEBE(args.config)
-        logger.info(f"EBE Based Data Handler")
+    data_handler = create_data_handler(args.datahandler, args.config)
+    if data_handler.get_config_data("work_queue_path", None) is not None and args.mode == "generate":
+        if isinstance(data_handler, DataHandlerMultiModel):
+            raise ValueError("The work queue is not supported for multi model configs")
+        data_handler = QueuedDataHandler(data_handler)
+        logger.info(f"Shared work queue: {data_handler.get_config_data('work_queue_path', None)}")
+    elif data_handler.get_config_data("adaptive", None) is not None and args.mode == "generate":
+        if isinstance(data_handler, DataHandlerMultiModel):
+            raise ValueError("Adaptive sampling is not supported for multi model configs")
+        data_handler = AdaptiveDataHandler(data_handler)
+        logger.info(f"Adaptive sampling: {data_handler.get_config_data('adaptive', None)}")
 
     template_version = data_handler.get_config_data("template_version")
+    di_aggregator = attach_save_hooks(data_handler, results=args.mode != "dry_run")
+
+    n_samples = [data_handler.get_config_data("n_samples", 1)]
+    if isinstance(data_handler, DataHandlerMultiModel):
+        n_samples += [
+            model_config.get("n_samples", n_samples[0])
+            for model_config in data_handler.get_model_configs()
+        ]
+    answer_store = None
+    answer_distribution_path = data_handler.get_config_data("answer_distribution_path", None)
+    if answer_distribution_path is not None:
+        answer_store = AnswerDistributionStore(answer_distribution_path)
+        logger.info(f"Answer distributions are stored in: {answer_distribution_path}")
+    elif max(n_samples) > 1 and args.mode == "generate":
+        raise ValueError("n_samples above 1 needs an answer_distribution_path")
+
+    failed_items = None
+    failed_items_path = data_handler.get_config_data("failed_items_path", None)
+    if failed_items_path is not None:
+        failed_items = FailedItemLog(failed_items_path)
+        logger.info(f"Failed items are recorded in: {failed_items_path}")
+
+    option_order_mode = data_handler.get_config_data("option_orders", None)
+    if option_order_mode is not None:
+        if args.mode != "generate" or isinstance(data_handler, DataHandlerMultiModel):
+            raise ValueError("option_orders is only supported for single model generation")
+        # fails early on an unknown mode
+        option_orders(2, option_order_mode)
+        logger.info(f"Option orders: {option_order_mode}")
+
     message_creator = ChatGptMessageCreator(version=template_version)
 
-    response_processor_version = data_handler.get_config_data(
-        "response_processor_version"
+    response_processor = create_response_processor(
+        data_handler.get_config_data("response_processor_version")
     )
 
-    if response_processor_version == "base":
-        response_processor = ResponseProcessor()
-    elif response_processor_version == "ibe":
-        response_processor = ResponseProcessorIBE()
-    elif response_processor_version == "ebe":
-        response_processor = ResponseProcessorEBE()
+    logger.info(f"Model name: {data_handler.get_model_name()}")
+    if args.mode != "generate" and isinstance(data_handler, DataHandlerMultiModel):
+        raise ValueError("Batch and dry run modes are not supported for multi model configs")
+    if args.mode == "dry_run":
+        throughput = {}
+        if args.benchmark:
+            throughput.update(read_benchmark_throughput(args.benchmark))
+        # the throughput measured in an earlier run takes precedence over the benchmark
+        if args.throughput_log:
+            throughput.update(read_log_throughput(args.throughput_log))
+        token = None
+        if os.path.exists("./hf_token.txt"):
+            with open("./hf_token.txt", "r") as f:
+                token = f.read().strip()
+        estimate, assumptions = estimate_run(
+            data_handler, message_creator, token, total=args.total, throughput=throughput
+        )
+        print_estimate(estimate, assumptions)
+        log_event(logger, logging.INFO, "dry_run", "Dry run estimate: %s", assumptions, **assumptions)
+    elif args.mode == "batch_export":
+        count = export_batch(data_handler, message_creator, args.batch_input, total=args.total)
+        print(f"Exported {count} requests to {args.batch_input}")
+    elif args.mode == "batch_import":
+        summary = import_batch(
+            data_handler,
+            message_creator,
+            response_processor,
+            args.batch_input,
+            args.batch_output,
+            args.batch_retry,
+        )
+        logger.info(f"Batch import summary: {summary}")
+        print(summary)
+    elif isinstance(data_handler, DataHandlerMultiModel):
+        with open("./hf_token.txt", "r") as f:
+            token = f.read().strip()
+
+        models = {}
+        for model_config in data_handler.get_model_configs():
+            models[model_config["name"]] = create_model(data_handler, token, model_config)
+            models[model_config["name"]].activate_model()
+        logger.info("Data generation started")
+        generate_multi_model_data(
+            data_handler=data_handler,
+            prompt_creator=message_creator,
+            models=models,
+            response_processor=response_processor,
+            total=args.total,
+            answer_store=answer_store,
+            failed_items=failed_items,
+        )
     else:
-        raise ValueError("Invalid response_processor_version")
+        with open("./hf_token.txt", "r") as f:
+            token = f.read().strip()
 
-    logger.info(f"Model name: {data_handler.get_model_name()}")
-    model = Llama3(model_name=data_handler.get_model_name(), device="cuda:0", token=token)
-    model.activate_model()
-    logger.info("Data generation started")
-    generate_inference_data(
-        data_handler=data_handler,
-        prompt_creator=message_creator,
-        model=model,
-        response_processor=response_processor,
-        total=args.total,
-    )
+        profile = machine_profile(data_handler)
+        workers = args.workers or profile.get("workers", 1)
+        processes = []
+        if workers > 1:
+            # every worker would replace the DI state file and append to the answer distribution
+            per_process_files = [
+                key
+                for key in ["di_state_path", "answer_distribution_path"]
+                if data_handler.get_config_data(key, None) is not None
+            ]
+            if not isinstance(data_handler, QueuedDataHandler):
+                logger.warning("Several workers need a work_queue_path, running a single executor")
+            elif per_process_files:
+                logger.warning(
+                    f"{', '.join(per_process_files)} can not be shared by several workers, running a single executor"
+                )
+            else:
+                processes = start_workers(workers)
+
+        model = create_model(data_handler, token)
+        model.activate_model()
+        logger.info("Data generation started")
+        generate_inference_data(
+            data_handler=data_handler,
+            prompt_creator=message_creator,
+            model=model,
+            response_processor=response_processor,
+            total=args.total,
+            answer_store=answer_store,
+            batch_size=data_handler.get_config_data("batch_size", profile.get("batch_size", 1)),
+            failed_items=failed_items,
+            option_order_mode=option_order_mode,
+            min_option_mass=data_handler.get_config_data("min_option_mass", 0.5),
+        )
+        for process in processes:
+            process.wait()
 
+    if di_aggregator is not None:
+        di_aggregator.flush()
     logger.info("Data generation finished")
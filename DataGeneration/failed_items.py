@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class FailedItemLog:
+    """
+    JSON lines of the items whose model call failed for good (after the
+    retries of the backend), so that they can be run again in a retry pass
+    instead of being skipped silently. Each line has the ID, the model, the
+    error type and message and the time.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # the multi model executor records from one thread per model
+        self.lock = threading.Lock()
+
+    def record(self, indices, model_name, error):
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for index in indices:
+                    f.write(
+                        json.dumps(
+                            {
+                                "ID": str(index),
+                                "model": model_name,
+                                "error": type(error).__name__,
+                                "message": str(error),
+                                "time": datetime.now().isoformat(timespec="seconds"),
+                            },
+                            ensure_ascii=False,
+                        )
+                        + "\n"
+                    )
+
+
+def read_failed_items(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_retry_list(failed_path, output_path, model_name=None):
+    """
+    Write the failed IDs, one per line, for the `id_list_path` of a retry
+    pass. The data handlers skip the IDs that were answered since.
+
+    Returns:
+        int: Number of IDs written.
+    """
+    ids = dict.fromkeys(
+        item["ID"] for item in read_failed_items(failed_path) if model_name is None or item["model"] == model_name
+    )
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        for id in ids:
+            f.write(f"{id}\n")
+    return len(ids)
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--failed", type=str, required=True, help="failed_items_path of the config")
+    parser.add_argument("--output", type=str, default=None, help="write the failed IDs for id_list_path")
+    parser.add_argument("--model", type=str, default=None, help="only the failures of this model")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from collections import Counter
+
+    args = parse_arguments()
+    items = read_failed_items(args.failed)
+    print(f"{len(items)} failures of {len({item['ID'] for item in items})} IDs")
+    for (model, error), count in Counter((item["model"], item["error"]) for item in items).most_common():
+        print(f"{model:<40} {error:<30} {count:>8}")
+    if args.output:
+        print(f"Wrote {write_retry_list(args.failed, args.output, args.model)} IDs to {args.output}")
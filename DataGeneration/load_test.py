@@ -0,0 +1,323 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+import yaml
+
+from executor import (
+    attach_save_hooks,
+    create_data_handler,
+    create_response_processor,
+    generate_inference_data,
+    generate_multi_model_data,
+    sanitize_log_name,
+)
+from event_log import setup_event_log
+from prompt_creator import ChatGptMessageCreator
+from synthetic_model import SyntheticModel, answers_by_processor
+
+logger = logging.getLogger(__name__)
+
+default_item_counts = [10000, 100000, 1000000]
+stages = ["read", "prompt", "model", "process", "save"]
+# config keys with paths that a load test must not write to
+storage_keys = [
+    "storage_folder_path",
+    "storage_path",
+    "di_state_path",
+    "results_db_path",
+    "answer_distribution_path",
+    "failed_items_path",
+]
+
+
+class StageTimer:
+    """
+    Wall time spent in each stage of the pipeline, summed over all calls
+    (and over all threads of the multi model executor).
+    """
+
+    def __init__(self) -> None:
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.seconds[name] += elapsed
+                self.calls[name] += 1
+
+
+class Timed:
+    """
+    Proxy that times the given methods of the wrapped object as a stage.
+    """
+
+    def __init__(self, wrapped, timer: StageTimer, methods: dict) -> None:
+        self.wrapped = wrapped
+        self.timer = timer
+        self.methods = methods
+
+    def __getattr__(self, name):
+        attribute = getattr(self.wrapped, name)
+        if name not in self.methods:
+            return attribute
+
+        def timed(*args, **kwargs):
+            with self.timer.stage(self.methods[name]):
+                return attribute(*args, **kwargs)
+
+        return timed
+
+
+class TimedDataHandler(Timed):
+    """
+    Times the reads and saves of a data handler. The data points stop once
+    `deadline` (a perf_counter value) is passed, so that a slow handler ends
+    with the items it managed.
+    """
+
+    def __init__(self, wrapped, timer: StageTimer, deadline=None) -> None:
+        super().__init__(wrapped, timer, {"save_generated_data": "save"})
+        self.deadline = deadline
+        self.stopped = False
+
+    def return_data_point(self, total=-1):
+        data_points = self.wrapped.return_data_point(total)
+        while True:
+            if self.deadline is not None and time.perf_counter() > self.deadline:
+                self.stopped = True
+                data_points.close()
+                return
+            with self.timer.stage("read"):
+                try:
+                    data_point = next(data_points)
+                except StopIteration:
+                    return
+            yield data_point
+
+
+def scale_prompts(prompt_data_path, items, output_path):
+    """
+    Repeat the prompts of a prompt file until it has `items` rows with the
+    IDs 0 … items - 1, which is the row index that the ebe and ibe handlers
+    expect. Existing responses are dropped.
+    """
+    prompt_df = pd.read_csv(prompt_data_path)
+    repeats = -(-items // len(prompt_df))
+    scaled = pd.concat([prompt_df] * repeats, ignore_index=True).iloc[:items].copy()
+    scaled["ID"] = range(items)
+    if "response" in scaled.columns:
+        scaled["response"] = None
+    scaled.to_csv(output_path, index=False)
+
+
+def prepare_config(config_path, datahandler, items, work_dir):
+    """
+    Copy a config into `work_dir` with its storage paths moved there and, for
+    the handlers that read a prompt file, a prompt file of `items` rows.
+
+    Returns:
+        str: Path of the copied config.
+    """
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+    for key in storage_keys:
+        if config.get(key) is not None:
+            name = os.path.basename(os.path.normpath(config[key]))
+            config[key] = os.path.join(work_dir, "storage", name) + (os.sep if key == "storage_folder_path" else "")
+    for key in ["work_queue_path", "adaptive", "id_list_path"]:
+        config.pop(key, None)
+    if datahandler != "virtual":
+        scaled_path = os.path.join(work_dir, f"prompts_{items}.csv")
+        scale_prompts(config["prompt_data_path"], items, scaled_path)
+        config["prompt_data_path"] = scaled_path
+    for key in ["storage_path", "di_state_path", "results_db_path", "answer_distribution_path"]:
+        if config.get(key) is not None:
+            os.makedirs(os.path.dirname(config[key]), exist_ok=True)
+
+    copied_path = os.path.join(work_dir, "config.yaml")
+    with open(copied_path, "w", encoding="utf-8") as f:
+        yaml.safe_dump(config, f, allow_unicode=True)
+    return copied_path
+
+
+def run_load_test(
+    config_path,
+    datahandler,
+    items,
+    model_options=None,
+    batch_size=1,
+    max_seconds=None,
+    work_dir=None,
+):
+    """
+    Run `items` prompts of a config through `generate_inference_data` (or
+    `generate_multi_model_data`) with synthetic models, and time every stage.
+
+    Returns:
+        dict: Items, wall seconds, items per second and the seconds and
+        microseconds per item of every stage. `executor` is the wall time not
+        spent in any stage: the loop itself, logging, progress and token sums.
+    """
+    model_options = model_options or {}
+    work_dir = tempfile.mkdtemp(prefix="load_test_", dir=work_dir)
+    try:
+        copied_path = prepare_config(config_path, datahandler, items, work_dir)
+        timer = StageTimer()
+
+        start = time.perf_counter()
+        deadline = None if max_seconds is None else start + max_seconds
+        data_handler = create_data_handler(datahandler, copied_path)
+        attach_save_hooks(data_handler)
+        template_version = data_handler.get_config_data("template_version")
+        processor_version = data_handler.get_config_data("response_processor_version")
+        prompt_creator = Timed(
+            ChatGptMessageCreator(version=template_version),
+            timer,
+            {"create_prompt": "prompt", "refine_prompt": "prompt"},
+        )
+        response_processor = Timed(
+            create_response_processor(processor_version), timer, {"process_response": "process"}
+        )
+
+        def synthetic_model(model_name):
+            model = SyntheticModel(model_name, answers=answers_by_processor.get(processor_version), **model_options)
+            return Timed(model, timer, {"create_response": "model", "create_responses": "model"})
+
+        timed_handler = TimedDataHandler(data_handler, timer, deadline)
+        if datahandler == "multi":
+            generate_multi_model_data(
+                data_handler=timed_handler,
+                prompt_creator=prompt_creator,
+                models={name: synthetic_model(name) for name in data_handler.get_model_names()},
+                response_processor=response_processor,
+                total=items,
+            )
+        else:
+            generate_inference_data(
+                data_handler=timed_handler,
+                prompt_creator=prompt_creator,
+                model=synthetic_model(data_handler.get_model_name()),
+                response_processor=response_processor,
+                total=items,
+                batch_size=batch_size,
+            )
+        seconds = time.perf_counter() - start
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    done = timer.calls["save"]
+    report = {
+        "config": config_path,
+        "datahandler": datahandler,
+        "items": done,
+        "requested_items": items,
+        "stopped_at_deadline": timed_handler.stopped,
+        "seconds": seconds,
+        "items_per_second": done / seconds if seconds > 0 else 0.0,
+        "stages": {},
+    }
+    for stage in stages:
+        report["stages"][stage] = {
+            "seconds": timer.seconds[stage],
+            "calls": timer.calls[stage],
+            "us_per_item": 1e6 * timer.seconds[stage] / max(done, 1),
+        }
+    executor_seconds = max(seconds - sum(timer.seconds[stage] for stage in stages), 0.0)
+    report["stages"]["executor"] = {
+        "seconds": executor_seconds,
+        "calls": 0,
+        "us_per_item": 1e6 * executor_seconds / max(done, 1),
+    }
+    return report
+
+
+def print_reports(reports):
+    header = f"{'datahandler':<12} {'items':>9} {'items/s':>10}" + "".join(
+        f" {stage + ' us':>12}" for stage in stages + ["executor"]
+    )
+    print(header)
+    for report in reports:
+        line = f"{report['datahandler']:<12} {report['items']:>9} {report['items_per_second']:>10.1f}"
+        line += "".join(
+            f" {report['stages'][stage]['us_per_item']:>12.1f}" for stage in stages + ["executor"]
+        )
+        if report["stopped_at_deadline"]:
+            line += f"  (stopped at the deadline, {report['requested_items']} requested)"
+        print(line)
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--run",
+        nargs=2,
+        action="append",
+        metavar=("CONFIG", "DATAHANDLER"),
+        required=True,
+        help="a config and its data handler, repeat for several handlers",
+    )
+    parser.add_argument("--items", type=int, nargs="+", default=default_item_counts)
+    parser.add_argument("--max_seconds", type=float, default=None, help="stop a run after this many seconds")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="median seconds per model call")
+    parser.add_argument("--latency_sigma", type=float, default=0.5)
+    parser.add_argument("--valid", type=float, default=0.8)
+    parser.add_argument("--chatty", type=float, default=0.15)
+    parser.add_argument("--garbage", type=float, default=0.05)
+    parser.add_argument("--output_tokens", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work_dir", type=str, default=None, help="where the temporary storage is created")
+    parser.add_argument("--output", type=str, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    setup_event_log(sanitize_log_name(f"./logs/load_test_{datetime.now()}.jsonl"))
+
+    model_options = {
+        "latency": args.latency,
+        "latency_sigma": args.latency_sigma,
+        "valid": args.valid,
+        "chatty": args.chatty,
+        "garbage": args.garbage,
+        "output_tokens": args.output_tokens,
+        "seed": args.seed,
+    }
+    reports = []
+    for config_path, datahandler in args.run:
+        for items in args.items:
+            report = run_load_test(
+                config_path,
+                datahandler,
+                items,
+                model_options=model_options,
+                batch_size=args.batch_size,
+                max_seconds=args.max_seconds,
+                work_dir=args.work_dir,
+            )
+            logger.info(f"Load test: {report}")
+            reports.append(report)
+    print_reports(reports)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"model": model_options, "runs": reports}, f, ensure_ascii=False, indent=2)
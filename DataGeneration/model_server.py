@@ -0,0 +1,507 @@
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from transformers import DynamicCache
+
+from Llama3 import Llama3
+from event_log import log_event
+
+logger = logging.getLogger(__name__)
+
+# the decoding defaults of Llama3.create_response, beam search aside
+default_temperature = 0.1
+default_top_p = 0.9
+default_top_k = 40
+default_max_tokens = 32
+
+
+class Request:
+    """
+    One chat completion request with its `n` sequences.
+    """
+
+    def __init__(self, messages, n=1, max_tokens=None, temperature=None, top_p=None, top_k=None) -> None:
+        self.messages = messages
+        self.n = n
+        self.max_tokens = max_tokens or default_max_tokens
+        self.temperature = default_temperature if temperature is None else temperature
+        self.top_p = default_top_p if top_p is None else top_p
+        self.top_k = default_top_k if top_k is None else top_k
+        self.future = Future()
+        self.prompt_tokens = 0
+        self.outputs = [None] * n
+        self.received = time.perf_counter()
+
+
+class Sequence:
+    def __init__(self, request, index) -> None:
+        self.request = request
+        self.index = index
+        self.tokens = []
+        self.finish_reason = None
+
+
+class ContinuousBatcher:
+    """
+    Iteration-level batching of chat completions on one Llama3 model.
+
+    Every iteration runs a single decoding step for all running sequences.
+    Requests that arrived in the meantime are prefilled and joined to the
+    batch before the step, and sequences that finished are dropped after it,
+    so a short response never waits for the longest one of its batch. The KV
+    caches of the running sequences are left padded to a common length.
+
+    Beam search is not supported; `temperature` 0 decodes greedily.
+    """
+
+    def __init__(self, model: Llama3, max_batch_size=16) -> None:
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.pending = queue.Queue()
+        self.terminators = set(model.terminators())
+        self.sequences = []
+        # DynamicCache of the running sequences, keys and values of shape (batch, heads, length, head dim)
+        self.cache = None
+        # (batch, length), 0 for the left padding of the cache
+        self.attention_mask = None
+        self.next_tokens = None
+        self.steps = 0
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request: Request) -> Future:
+        self.pending.put(request)
+        return request.future
+
+    @staticmethod
+    def __left_pad(tensor, length, dim):
+        missing = length - tensor.shape[dim]
+        if missing == 0:
+            return tensor
+        shape = list(tensor.shape)
+        shape[dim] = missing
+        return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+    @staticmethod
+    def __layers(cache):
+        # (key, value) per layer; newer transformers versions also yield a sliding window
+        return [(key, value) for key, value, *_ in cache]
+
+    @staticmethod
+    def __cache_from_layers(layers):
+        cache = DynamicCache()
+        for layer, (key, value) in enumerate(layers):
+            cache.update(key, value, layer)
+        return cache
+
+    def __left_pad_cache(self, cache, length):
+        return self.__cache_from_layers(
+            (self.__left_pad(key, length, 2), self.__left_pad(value, length, 2))
+            for key, value in self.__layers(cache)
+        )
+
+    def __sample(self, logits, sequences):
+        """
+        Next token of every row, with the decoding parameters of its request.
+        """
+        temperature = torch.tensor([s.request.temperature for s in sequences], device=logits.device)
+        top_p = torch.tensor([s.request.top_p for s in sequences], device=logits.device)
+        top_k = torch.tensor([s.request.top_k for s in sequences], device=logits.device)
+        greedy = logits.argmax(dim=-1)
+        sampled_rows = temperature > 0
+        if not sampled_rows.any():
+            return greedy
+
+        scaled = logits.float() / temperature.clamp(min=1e-5).unsqueeze(-1)
+        sorted_logits, sorted_ids = scaled.sort(dim=-1, descending=True)
+        probs = sorted_logits.softmax(dim=-1)
+        rank = torch.arange(probs.shape[-1], device=logits.device).unsqueeze(0)
+        # a token is kept if the tokens ranked above it hold less than top_p, as in TopPLogitsWarper
+        outside = (probs.cumsum(dim=-1) - probs > top_p.unsqueeze(-1)) | (
+            (top_k > 0).unsqueeze(-1) & (rank >= top_k.unsqueeze(-1))
+        )
+        probs = probs.masked_fill(outside, 0)
+        choice = torch.multinomial(probs, 1)
+        sampled = sorted_ids.gather(-1, choice).squeeze(-1)
+        return torch.where(sampled_rows, sampled, greedy)
+
+    def __admit(self):
+        """
+        Prefill the pending requests that fit into the batch and join them.
+        """
+        admitted = []
+        while True:
+            free = self.max_batch_size - len(self.sequences) - sum(r.n for r in admitted)
+            if free <= 0:
+                break
+            try:
+                # block only while there is nothing to decode
+                request = self.pending.get(block=not self.sequences and not admitted)
+            except queue.Empty:
+                break
+            if request.n > self.max_batch_size:
+                request.future.set_exception(
+                    ValueError(f"n={request.n} is above the max batch size {self.max_batch_size}")
+                )
+                continue
+            if request.n > free and (self.sequences or admitted):
+                # wait for a later iteration, keeping the arrival order
+                self.__requeue(request)
+                break
+            admitted.append(request)
+
+        for request in admitted:
+            try:
+                self.__prefill(request)
+            except Exception as e:
+                logger.error(f"Error in prefill: {e}", exc_info=True)
+                request.future.set_exception(e)
+
+    def __requeue(self, request):
+        waiting = [request]
+        while True:
+            try:
+                waiting.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        for waiting_request in waiting:
+            self.pending.put(waiting_request)
+
+    def __prefill(self, request):
+        input_ids = self.model.encode(request.messages)
+        request.prompt_tokens = input_ids.shape[-1]
+        with torch.no_grad():
+            outputs = self.model.model(input_ids, past_key_values=DynamicCache(), use_cache=True)
+        # the n sequences of a request share this prefill
+        cache = outputs.past_key_values
+        if request.n > 1:
+            cache.batch_repeat_interleave(request.n)
+        sequences = [Sequence(request, i) for i in range(request.n)]
+        next_tokens = self.__sample(outputs.logits[:, -1, :].expand(request.n, -1), sequences)
+        attention_mask = torch.ones(
+            (request.n, input_ids.shape[-1]), dtype=torch.long, device=input_ids.device
+        )
+        log_event(
+            logger, logging.DEBUG, "server_prefill", "Prefilled %s tokens", input_ids.shape[-1],
+            tokens=input_ids.shape[-1], n=request.n,
+        )
+
+        # sequences that end with their first token do not join the batch
+        rows = [row for row, token in enumerate(next_tokens.tolist()) if not self.__advance(sequences[row], token)]
+        if len(rows) < request.n:
+            index = torch.tensor(rows, dtype=torch.long, device=input_ids.device)
+            cache.batch_select_indices(index)
+            attention_mask = attention_mask.index_select(0, index)
+            next_tokens = next_tokens.index_select(0, index)
+            sequences = [sequences[row] for row in rows]
+        if not sequences:
+            return
+
+        if self.cache is None:
+            self.cache, self.attention_mask, self.next_tokens = cache, attention_mask, next_tokens
+        else:
+            length = max(self.attention_mask.shape[-1], attention_mask.shape[-1])
+            self.cache = self.__cache_from_layers(
+                (torch.cat([key, new_key]), torch.cat([value, new_value]))
+                for (key, value), (new_key, new_value) in zip(
+                    self.__layers(self.__left_pad_cache(self.cache, length)),
+                    self.__layers(self.__left_pad_cache(cache, length)),
+                )
+            )
+            self.attention_mask = torch.cat(
+                [self.__left_pad(self.attention_mask, length, 1), self.__left_pad(attention_mask, length, 1)]
+            )
+            self.next_tokens = torch.cat([self.next_tokens, next_tokens])
+        self.sequences.extend(sequences)
+
+    def __step(self):
+        """
+        One decoding step of all running sequences.
+        """
+        attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones((len(self.sequences), 1))], dim=1
+        )
+        # positions count the tokens of a sequence, not its padding
+        position_ids = self.attention_mask.sum(dim=-1, keepdim=True)
+        with torch.no_grad():
+            outputs = self.model.model(
+                self.next_tokens.unsqueeze(-1),
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=self.cache,
+                use_cache=True,
+            )
+        # the same cache, with the keys and values of this step appended
+        self.cache = outputs.past_key_values
+        self.attention_mask = attention_mask
+        self.next_tokens = self.__sample(outputs.logits[:, -1, :], self.sequences)
+        self.steps += 1
+        self.__finish(self.next_tokens.tolist())
+
+    def __advance(self, sequence, token):
+        """
+        Append a sampled token to a sequence. A finished sequence is stored in
+        its request, which is answered once all its sequences are done.
+
+        Returns:
+            bool: Whether the sequence is finished.
+        """
+        if token in self.terminators:
+            sequence.finish_reason = "stop"
+        else:
+            sequence.tokens.append(token)
+            if len(sequence.tokens) >= sequence.request.max_tokens:
+                sequence.finish_reason = "length"
+        if sequence.finish_reason is None:
+            return False
+        request = sequence.request
+        request.outputs[sequence.index] = sequence
+        if all(output is not None for output in request.outputs):
+            self.__respond(request)
+        return True
+
+    def __finish(self, next_tokens):
+        """
+        Advance the running sequences and drop the finished ones from the batch.
+        """
+        keep = [
+            row
+            for row, (sequence, token) in enumerate(zip(self.sequences, next_tokens))
+            if not self.__advance(sequence, token)
+        ]
+        if len(keep) == len(self.sequences):
+            return
+        self.sequences = [self.sequences[row] for row in keep]
+        if not keep:
+            self.cache = self.attention_mask = self.next_tokens = None
+            return
+        rows = torch.tensor(keep, device=self.next_tokens.device)
+        # columns that are padding in every remaining row are cut off
+        start = int((self.attention_mask[rows].sum(dim=0) > 0).nonzero()[0])
+        self.cache.batch_select_indices(rows)
+        self.cache = self.__cache_from_layers(
+            (key[:, :, start:], value[:, :, start:]) for key, value in self.__layers(self.cache)
+        )
+        self.attention_mask = self.attention_mask.index_select(0, rows)[:, start:]
+        self.next_tokens = self.next_tokens.index_select(0, rows)
+
+    def __respond(self, request):
+        contents = self.model.tokenizer.batch_decode(
+            [sequence.tokens for sequence in request.outputs], skip_special_tokens=True
+        )
+        completion_tokens = sum(len(sequence.tokens) for sequence in request.outputs)
+        request.future.set_result(
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": self.model.model_name,
+                "choices": [
+                    {
+                        "index": sequence.index,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": sequence.finish_reason,
+                    }
+                    for sequence, content in zip(request.outputs, contents)
+                ],
+                "usage": {
+                    "prompt_tokens": request.prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": request.prompt_tokens + completion_tokens,
+                },
+            }
+        )
+        log_event(
+            logger, logging.INFO, "server_request", "Answered a request in %.3fs",
+            time.perf_counter() - request.received,
+            seconds=time.perf_counter() - request.received,
+            prompt_tokens=request.prompt_tokens,
+            completion_tokens=completion_tokens,
+        )
+
+    def __run(self):
+        while True:
+            try:
+                self.__admit()
+                if self.sequences:
+                    self.__step()
+            except Exception as e:
+                # the batch can not be continued, its requests fail and the server keeps running
+                logger.error(f"Error in decoding step: {e}", exc_info=True)
+                for sequence in self.sequences:
+                    if not sequence.request.future.done():
+                        sequence.request.future.set_exception(e)
+                self.sequences = []
+                self.cache = self.attention_mask = self.next_tokens = None
+
+
+class RequestBatcher:
+    """
+    Request level batching for backends without step-wise decoding: the
+    requests waiting at the same time are answered with one
+    `create_responses` call.
+    """
+
+    def __init__(self, model, max_batch_size=16) -> None:
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request: Request) -> Future:
+        if request.n != getattr(self.model, "n_samples", 1):
+            request.future.set_exception(ValueError("n is fixed by the n_samples of the served model"))
+        else:
+            self.pending.put(request)
+        return request.future
+
+    def __run(self):
+        while True:
+            requests = [self.pending.get()]
+            while len(requests) < self.max_batch_size:
+                try:
+                    requests.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                responses = self.model.create_responses([request.messages for request in requests])
+            except Exception as e:
+                logger.error(f"Error in batch: {e}", exc_info=True)
+                for request in requests:
+                    request.future.set_exception(e)
+                continue
+            for request, response in zip(requests, responses):
+                samples = response.get("samples", [response["content"]])
+                request.future.set_result(
+                    {
+                        "id": f"chatcmpl-{uuid.uuid4().hex}",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": self.model.model_name,
+                        "choices": [
+                            {"index": i, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                            for i, content in enumerate(samples)
+                        ],
+                        "usage": {
+                            "prompt_tokens": response["input_tokens"],
+                            "completion_tokens": response["output_tokens"],
+                            "total_tokens": response["input_tokens"] + response["output_tokens"],
+                        },
+                    }
+                )
+
+
+def create_batcher(model, max_batch_size=16):
+    if isinstance(model, Llama3) and model.assistant_model is None:
+        return ContinuousBatcher(model, max_batch_size)
+    return RequestBatcher(model, max_batch_size)
+
+
+class ChatCompletionHandler(BaseHTTPRequestHandler):
+    """
+    The `/v1/chat/completions` and `/v1/models` endpoints of the OpenAI API,
+    without streaming.
+    """
+
+    batcher = None
+    timeout_seconds = 600
+
+    def __send(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def __error(self, status, message, type="invalid_request_error"):
+        self.__send(status, {"error": {"message": message, "type": type}})
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/v1/models":
+            self.__send(
+                200,
+                {
+                    "object": "list",
+                    "data": [{"id": self.batcher.model.model_name, "object": "model", "owned_by": "local"}],
+                },
+            )
+        elif self.path.rstrip("/") == "/health":
+            self.__send(200, {"status": "ok"})
+        else:
+            self.__error(404, f"Unknown path {self.path}")
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self.__error(404, f"Unknown path {self.path}")
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            if body.get("stream"):
+                raise ValueError("Streaming is not supported")
+            request = Request(
+                body["messages"],
+                n=body.get("n") or 1,
+                max_tokens=body.get("max_tokens"),
+                temperature=body.get("temperature"),
+                top_p=body.get("top_p"),
+                top_k=body.get("top_k"),
+            )
+        except (ValueError, KeyError, TypeError) as e:
+            self.__error(400, str(e))
+            return
+        try:
+            self.__send(200, self.batcher.submit(request).result(timeout=self.timeout_seconds))
+        except ValueError as e:
+            self.__error(400, str(e))
+        except Exception as e:
+            self.__error(500, str(e), type="server_error")
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def serve(model, host="127.0.0.1", port=8000, max_batch_size=16):
+    ChatCompletionHandler.batcher = create_batcher(model, max_batch_size)
+    server = ThreadingHTTPServer((host, port), ChatCompletionHandler)
+    logger.info(f"Serving {model.model_name} on http://{host}:{port}/v1")
+    print(f"Serving {model.model_name} on http://{host}:{port}/v1")
+    server.serve_forever()
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="config.yaml")
+    parser.add_argument("--datahandler", type=str, default="template")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch_size", type=int, default=16)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from datetime import datetime
+
+    from event_log import setup_event_log
+    from executor import create_data_handler, create_model, sanitize_log_name
+
+    args = parse_arguments()
+    setup_event_log(sanitize_log_name(f"./logs/model_server_{datetime.now()}.jsonl"))
+
+    with open("./hf_token.txt", "r") as f:
+        token = f.read().strip()
+
+    data_handler = create_data_handler(args.datahandler, args.config)
+    model = create_model(data_handler, token)
+    model.activate_model()
+    serve(model, args.host, args.port, args.max_batch_size)
@@ -3,10 +3,48 @@ import requests
 
 
 class Model(ABC):
+    # number of responses sampled per prompt
+    n_samples = 1
+
+    def activate_model(self):
+        """
+        Load the model weights or clients, if the backend needs to.
+        """
+        pass
+
     @abstractmethod
     def create_response(self, model_message):
+        """
+        Returns:
+            dict: `content`, `input_tokens` and `output_tokens`. Models that
+            draw several samples per prompt also return all of them in `samples`.
+        """
         pass
 
+    def create_responses(self, model_messages):
+        """
+        Responses of several prompts. Backends that can batch prompts override this.
+        """
+        return [self.create_response(model_message) for model_message in model_messages]
+
+    def option_probabilities(self, model_messages, count):
+        """
+        Probability of answering each prompt with the option numbers 1 … count.
+        Backends that only return text return None, and are prompted instead.
+
+        Returns:
+            dict or None: `probabilities` (one list per prompt), `mass` (the
+            probability of all option numbers, per prompt) and `input_tokens`.
+        """
+        return None
+
     @abstractmethod
     def calculate_cost(self, input_tokens, output_tokens):
         pass
+
+    def finish_item(self):
+        """
+        Called once all turns of a data point are done, so that a model can
+        release state that is kept between the turns.
+        """
+        pass
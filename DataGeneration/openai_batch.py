@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+
+from data_handler import DataHandlerBase
+from prompt_creator import PromptCreator
+from response_processor import ResponseProcessorBase
+
+logger = logging.getLogger(__name__)
+
+batch_endpoint = "/v1/chat/completions"
+
+
+def batch_request(custom_id, messages, model_name, temperature=0.1):
+    """
+    One line of an OpenAI Batch API input file, with the same sampling
+    parameters as `ChatgptModel.create_response`.
+    """
+    return {
+        "custom_id": str(custom_id),
+        "method": "POST",
+        "url": batch_endpoint,
+        "body": {
+            "model": model_name,
+            "messages": messages,
+            "temperature": temperature,
+        },
+    }
+
+
+def read_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def write_jsonl(records, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def parse_batch_result(result):
+    """
+    Extract the answer of one line of a Batch API output file.
+
+    Returns:
+        tuple: (content, input tokens, output tokens, error). content is None
+        if the request failed, error describes the failure.
+    """
+    if result.get("error"):
+        return None, 0, 0, str(result["error"])
+    response = result.get("response") or {}
+    if response.get("status_code") != 200:
+        return None, 0, 0, f"status code {response.get('status_code')}"
+    body = response.get("body") or {}
+    try:
+        content = body["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None, 0, 0, "no choices in response body"
+    usage = body.get("usage") or {}
+    return (
+        content,
+        usage.get("prompt_tokens", 0),
+        usage.get("completion_tokens", 0),
+        None,
+    )
+
+
+def is_refinement(messages):
+    # a refined prompt already contains the rejected answer of the model
+    return any(message["role"] == "assistant" for message in messages)
+
+
+def export_batch(
+    data_handler: DataHandlerBase,
+    prompt_creator: PromptCreator,
+    batch_input_path: str,
+    total: int = -1,
+):
+    """
+    Write all pending data points of the data handler to a Batch API input
+    file. The `custom_id` of every request is the ID of the data point.
+    """
+    model_name = data_handler.get_model_name()
+    requests = (
+        batch_request(
+            data_point["ID"],
+            prompt_creator.create_prompt(prompt=data_point["prompt"]),
+            model_name,
+        )
+        for data_point in data_handler.return_data_point(total)
+    )
+    count = write_jsonl(requests, batch_input_path)
+    logger.info(f"Exported {count} requests to {batch_input_path}")
+    return count
+
+
+def import_batch(
+    data_handler: DataHandlerBase,
+    prompt_creator: PromptCreator,
+    response_processor: ResponseProcessorBase,
+    batch_input_path: str,
+    batch_output_path: str,
+    retry_path: str,
+):
+    """
+    Save the answers of a Batch API output file through the data handler.
+
+    Every answer is passed through the response processor, in the same way as
+    in `generate_inference_data`. Accepted answers are saved. Rejected answers
+    of a first prompt are re-queued with the refined prompt, and failed
+    requests are re-queued unchanged, into the retry file, which is a Batch
+    API input file itself. Answers to refined prompts are saved even if they
+    are rejected, like the second iteration of the synchronous loop.
+
+    Returns:
+        dict: Number of saved, re-queued, skipped and missing requests and the token usage.
+    """
+    # only data points without a stored response are imported, so importing twice is harmless
+    pending = {
+        str(data_point["ID"]): data_point for data_point in data_handler.return_data_point()
+    }
+    requests = {request["custom_id"]: request for request in read_jsonl(batch_input_path)}
+    model_name = data_handler.get_model_name()
+
+    summary = {
+        "saved": 0,
+        "rejected": 0,
+        "failed": 0,
+        "skipped": 0,
+        "missing": 0,
+        "input_tokens": 0,
+        "output_tokens": 0,
+    }
+    retries = []
+    answered = set()
+    for result in read_jsonl(batch_output_path):
+        custom_id = result.get("custom_id")
+        if custom_id not in pending or custom_id not in requests:
+            logger.info(f"Skipping result for index {custom_id}, not pending")
+            summary["skipped"] += 1
+            continue
+        answered.add(custom_id)
+        data_point = pending[custom_id]
+        messages = requests[custom_id]["body"]["messages"]
+
+        content, input_tokens, output_tokens, error = parse_batch_result(result)
+        summary["input_tokens"] += input_tokens
+        summary["output_tokens"] += output_tokens
+        if content is None:
+            logger.error(f"Batch request failed for index {custom_id}: {error}")
+            retries.append(batch_request(custom_id, messages, model_name))
+            summary["failed"] += 1
+            continue
+
+        try:
+            (status, modified_response) = response_processor.process_response(content)
+        except Exception as e:
+            logger.error(f"Error in processing response for index {custom_id}")
+            logger.error(e)
+            retries.append(batch_request(custom_id, messages, model_name))
+            summary["failed"] += 1
+            continue
+
+        if status == 0 and not is_refinement(messages):
+            refined = prompt_creator.refine_prompt(prompt_list=list(messages), response=content)
+            retries.append(batch_request(custom_id, refined, model_name))
+            summary["rejected"] += 1
+            continue
+
+        if status == 0:
+            logger.error(f"INCORRECT RESPONSE FOR {custom_id}: {modified_response}")
+        data_handler.save_generated_data(modified_response, index=data_point["ID"])
+        summary["saved"] += 1
+
+    # requests without any line in the output file are re-queued as well
+    for custom_id, request in requests.items():
+        if custom_id in pending and custom_id not in answered:
+            retries.append(request)
+            summary["missing"] += 1
+
+    write_jsonl(retries, retry_path)
+    logger.info(f"Re-queued {len(retries)} requests to {retry_path}")
+    return summary
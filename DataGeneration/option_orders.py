@@ -0,0 +1,119 @@
+import itertools
+import math
+import re
+
+from normalizer import normalize
+
+from di_aggregator import is_missing, normalized_option_numbers, opposite_persona
+
+bangla_digits = ["১", "২", "৩", "৪"]
+# saved for items whose orderings favour several personas equally
+undetermined_answer = "undetermined"
+option_digits = [["1", "১"], ["2", "২"], ["3", "৩"], ["4", "৪"]]
+# "১। " … "৪। ", the option numbers of the EBE and IBE prompt templates
+option_marker = re.compile(r"([১২৩৪1234])।\s*")
+option_separator = re.compile(r"^(.*?)(,?\s*)$", re.DOTALL)
+
+
+def split_options(prompt):
+    """
+    Split an EBE or IBE prompt into the text before the options and the
+    options with their markers and separators.
+
+    Returns:
+        tuple: (stem, markers, options, separators), or None if the prompt
+        has no numbered options.
+    """
+    markers = list(option_marker.finditer(prompt))
+    # the options are the last run of markers numbered 1, 2, ...
+    for start in range(len(markers) - 1, -1, -1):
+        if normalized_option_numbers.get(normalize(markers[start].group(1))) != 0:
+            continue
+        run = [markers[start]]
+        for marker in markers[start + 1 :]:
+            if normalized_option_numbers.get(normalize(marker.group(1))) != len(run):
+                break
+            run.append(marker)
+        if len(run) < 2:
+            continue
+        options, separators = [], []
+        for i, marker in enumerate(run):
+            end = run[i + 1].start() if i + 1 < len(run) else len(prompt)
+            option, separator = option_separator.match(prompt[marker.end() : end]).groups()
+            options.append(option)
+            separators.append(separator)
+        return prompt[: run[0].start()], [m.group(0) for m in run], options, separators
+    return None
+
+
+def option_labels(data_point, count):
+    """
+    The persona of every option in prompt order: `firstOption` and its
+    opposite for EBE prompts, the `serial` column for IBE prompts.
+    """
+    if not is_missing(data_point.get("serial")):
+        labels = str(data_point["serial"]).split(",")
+    elif not is_missing(data_point.get("firstOption")) and count == 2:
+        labels = [data_point["firstOption"], opposite_persona.get(data_point["firstOption"])]
+    else:
+        raise ValueError(f"No firstOption or serial for the options of {data_point['ID']}")
+    if len(labels) != count:
+        raise ValueError(f"{len(labels)} option labels for {count} options of {data_point['ID']}")
+    return labels
+
+
+def option_orders(count, mode="cyclic"):
+    """
+    The orderings to evaluate, the prompt order first. `all` is every
+    permutation; `cyclic` shifts the options so that each one is at every
+    position once, which is the same for two options.
+    """
+    if mode == "all":
+        return list(itertools.permutations(range(count)))
+    if mode == "cyclic":
+        return [tuple((start + i) % count for i in range(count)) for start in range(count)]
+    raise ValueError(f"Invalid option_orders: {mode}")
+
+
+def permuted_prompt(parts, order):
+    stem, markers, options, separators = parts
+    return stem + "".join(
+        marker + options[option] + separator
+        for marker, option, separator in zip(markers, order, separators)
+    )
+
+
+def combine_orders(orders, labels, probabilities):
+    """
+    Average the option probabilities of every ordering per label.
+
+    Args:
+        probabilities (list): Per ordering, the probability of each position;
+            orderings without probability mass are left out.
+
+    Returns:
+        tuple: (label with the highest mean probability, None if no ordering
+        has probability mass or several labels tie for the highest one;
+        mean probability per label; label picked by each ordering or None)
+    """
+    scores = dict.fromkeys(labels, 0.0)
+    picks = []
+    counted = 0
+    for order, position_probabilities in zip(orders, probabilities):
+        total = sum(position_probabilities)
+        if total <= 0:
+            picks.append(None)
+            continue
+        counted += 1
+        for position, probability in enumerate(position_probabilities):
+            scores[labels[order[position]]] += probability / total
+        best = max(range(len(order)), key=lambda position: position_probabilities[position])
+        picks.append(labels[order[best]])
+    if counted == 0:
+        return None, scores, picks
+    scores = {label: score / counted for label, score in scores.items()}
+    best = max(scores.values())
+    # a tie would otherwise go to the first option, the position bias the orderings remove
+    if sum(math.isclose(score, best, abs_tol=1e-9) for score in scores.values()) > 1:
+        return None, scores, picks
+    return max(scores, key=scores.get), scores, picks
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from prompt_creator import ChatGptMessageCreator
+
+logger = logging.getLogger(__name__)
+
+default_batch_size = 10000
+ids_dtype = np.uint32
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    Hash of the vocabulary, merges, normalizer and chat template, so that a
+    changed tokenizer revision never reads ids of an older one.
+    """
+    digest = hashlib.sha256()
+    digest.update(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    digest.update((tokenizer.chat_template or "").encode("utf-8"))
+    return digest.hexdigest()
+
+
+def conversation_key(messages):
+    """
+    64 bit key of the system message and the first user turn.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for message in messages[:2]:
+        digest.update(message["content"].encode("utf-8"))
+        digest.update(b"\0")
+    return int.from_bytes(digest.digest(), "little")
+
+
+def artifact_path(cache_dir, prompt_data_path, tokenizer, template_version):
+    name = "_".join(
+        [
+            os.path.splitext(os.path.basename(prompt_data_path))[0],
+            file_hash(prompt_data_path)[:16],
+            tokenizer_fingerprint(tokenizer)[:16],
+            str(template_version),
+        ]
+    )
+    return os.path.join(cache_dir, name)
+
+
+def shared_prefix(tokenizer, texts):
+    """
+    The longest common prefix of the texts that ends with a special token.
+    Special tokens are split off before the rest of the text is tokenized, so
+    the ids of such a prefix do not depend on the text that follows it.
+    """
+    prefix = os.path.commonprefix(texts)
+    special_tokens = [token.content for token in tokenizer.added_tokens_decoder.values() if token.special]
+    end = max((prefix.rfind(token) + len(token) for token in special_tokens if token in prefix), default=0)
+    return prefix[:end]
+
+
+def encode_batch(tokenizer, texts):
+    """
+    Ids of rendered chat templates (which already hold the special tokens).
+    The system message that all prompts share is tokenized once.
+    """
+    prefix = shared_prefix(tokenizer, texts)
+    backend = tokenizer.backend_tokenizer
+    prefix_ids = backend.encode(prefix, add_special_tokens=False).ids if prefix else []
+    encodings = backend.encode_batch([text[len(prefix) :] for text in texts], add_special_tokens=False)
+    return [prefix_ids + encoding.ids for encoding in encodings]
+
+
+def build(prompt_data_path, tokenizer, template_version, cache_dir, batch_size=default_batch_size):
+    """
+    Tokenize the first turn of every prompt of a prompt file, as rendered by
+    the chat template with the generation prompt, and store the ids.
+
+    The artifact is a directory named after the prompt file hash, the
+    tokenizer fingerprint and the template version, with
+    `ids.bin` (all ids, uint32), `offsets.npy` (start of every row, one more
+    than rows), `keys.npy` and `rows.npy` (sorted conversation keys and their
+    row) and `meta.json`. Prompts with the same messages share a row.
+
+    Returns:
+        str: Path of the artifact, which is not rebuilt if it exists.
+    """
+    path = artifact_path(cache_dir, prompt_data_path, tokenizer, template_version)
+    if os.path.exists(os.path.join(path, "meta.json")):
+        logger.info(f"Pretokenized prompts already exist: {path}")
+        return path
+    start = time.perf_counter()
+    prompt_creator = ChatGptMessageCreator(version=template_version)
+    prompts = pd.read_csv(prompt_data_path, usecols=["prompt"])["prompt"].astype(str)
+
+    conversations = {}
+    for prompt in dict.fromkeys(prompts):
+        messages = prompt_creator.create_prompt(prompt=prompt)
+        conversations.setdefault(conversation_key(messages), messages)
+    keys = list(conversations)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    building = f"{path}.building"
+    os.makedirs(building, exist_ok=True)
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    with open(os.path.join(building, "ids.bin"), "wb") as f:
+        for batch_start in range(0, len(keys), batch_size):
+            batch_keys = keys[batch_start : batch_start + batch_size]
+            texts = tokenizer.apply_chat_template(
+                [conversations[key] for key in batch_keys], add_generation_prompt=True, tokenize=False
+            )
+            for i, ids in enumerate(encode_batch(tokenizer, texts)):
+                row = batch_start + i
+                offsets[row + 1] = offsets[row] + len(ids)
+                f.write(np.asarray(ids, dtype=ids_dtype).tobytes())
+
+    key_array = np.array(keys, dtype=np.uint64)
+    order = np.argsort(key_array)
+    np.save(os.path.join(building, "offsets.npy"), offsets)
+    np.save(os.path.join(building, "keys.npy"), key_array[order])
+    np.save(os.path.join(building, "rows.npy"), order.astype(np.int64))
+    meta = {
+        "prompt_data_path": os.path.abspath(prompt_data_path),
+        "prompt_file_hash": file_hash(prompt_data_path),
+        "tokenizer": tokenizer.name_or_path,
+        "tokenizer_fingerprint": tokenizer_fingerprint(tokenizer),
+        "template_version": template_version,
+        "prompts": len(prompts),
+        "rows": len(keys),
+        "tokens": int(offsets[-1]),
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+    }
+    with open(os.path.join(building, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    # readers only see complete artifacts
+    os.replace(building, path)
+    logger.info(
+        f"Pretokenized {len(keys)} prompts ({meta['tokens']} tokens) in "
+        f"{time.perf_counter() - start:.1f}s: {path}"
+    )
+    return path
+
+
+class PretokenizedPrompts:
+    """
+    Read only view of a pretokenized artifact. The ids are memory mapped, so
+    opening it costs the same for any prompt file size.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.ids = np.memmap(os.path.join(path, "ids.bin"), dtype=ids_dtype, mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.keys = np.load(os.path.join(path, "keys.npy"), mmap_mode="r")
+        self.rows = np.load(os.path.join(path, "rows.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self, messages):
+        """
+        Returns:
+            ndarray: The ids of the first turn of a conversation, None if it
+            was not pretokenized.
+        """
+        key = np.uint64(conversation_key(messages))
+        position = int(np.searchsorted(self.keys, key))
+        if position == len(self.keys) or self.keys[position] != key:
+            return None
+        row = int(self.rows[position])
+        return np.asarray(self.ids[self.offsets[row] : self.offsets[row + 1]], dtype=np.int64)
+
+
+def open_pretokenized(cache_dir, prompt_data_path, tokenizer, template_version):
+    """
+    The artifact of a prompt file for this tokenizer and template version,
+    None if it was not built or the prompt file has changed since.
+    """
+    path = artifact_path(cache_dir, prompt_data_path, tokenizer, template_version)
+    if not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    return PretokenizedPrompts(path)
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="config.yaml")
+    parser.add_argument("--datahandler", type=str, default="template")
+    parser.add_argument("--cache_dir", type=str, default=None, help="defaults to pretokenized_dir of the config")
+    parser.add_argument("--batch_size", type=int, default=default_batch_size)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer
+
+    from executor import create_data_handler
+
+    args = parse_arguments()
+    data_handler = create_data_handler(args.datahandler, args.config)
+    cache_dir = args.cache_dir or data_handler.get_config_data("pretokenized_dir", None)
+    if cache_dir is None:
+        raise ValueError("Set pretokenized_dir in the config or pass --cache_dir")
+
+    with open("./hf_token.txt", "r") as f:
+        token = f.read().strip()
+
+    tokenizer = AutoTokenizer.from_pretrained(data_handler.get_model_name(), token=token)
+    start = time.perf_counter()
+    path = build(
+        data_handler.get_config_data("prompt_data_path"),
+        tokenizer,
+        data_handler.get_config_data("template_version"),
+        cache_dir,
+        batch_size=args.batch_size,
+    )
+    print(f"Pretokenized prompts: {path} ({time.perf_counter() - start:.1f}s)")
@@ -0,0 +1,219 @@
+import hashlib
+import random
+
+import pandas as pd
+import yaml
+from normalizer import normalize
+
+
+def stable_prompt_id(template, noun_pair, adjective, occupation=None):
+    """
+    Derive a prompt ID from the words that make up the prompt.
+
+    The ID does not depend on the position of the words in the adjective
+    list, so it stays the same when the lists are reordered or extended.
+    """
+    key = "|".join([template, "/".join(noun_pair), adjective, occupation or ""])
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class SeededPermutation:
+    """
+    A seeded permutation of range(size) that is evaluated per position without
+    materializing it. A small Feistel network permutes the next power of four
+    above size and positions outside the range are cycle-walked back into it.
+    """
+
+    rounds = 4
+
+    def __init__(self, size, seed) -> None:
+        self.size = size
+        half_bits = 1
+        while 4**half_bits < size:
+            half_bits += 1
+        self.half_bits = half_bits
+        self.mask = (1 << half_bits) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(64).to_bytes(8, "little") for _ in range(self.rounds)]
+
+    def __len__(self):
+        return self.size
+
+    def __round(self, key, value):
+        digest = hashlib.blake2b(value.to_bytes(8, "little"), key=key, digest_size=8).digest()
+        return int.from_bytes(digest, "little") & self.mask
+
+    def __encrypt(self, value):
+        left, right = value >> self.half_bits, value & self.mask
+        for key in self.keys:
+            left, right = right, left ^ self.__round(key, right)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, k):
+        if not 0 <= k < self.size:
+            raise IndexError(k)
+        value = self.__encrypt(k)
+        while value >= self.size:
+            value = self.__encrypt(value)
+        return value
+
+
+class CombinatorialPromptSpace:
+    """
+    Virtual, index addressable view of all template based prompts of a topic.
+
+    The space is the union of one block per (template, noun pair). Inside a
+    block, prompt i is decoded from its mixed-radix coordinates
+    (adjective, occupation), so any prompt can be computed on demand in O(1)
+    and nothing is materialized on disk.
+    """
+
+    def __init__(self, adjective_df, prompt_templates, topic_name) -> None:
+        self.templates = prompt_templates["templates"]
+        occupation_category = prompt_templates["occupation_category"]
+        topic_config = prompt_templates["topics"][topic_name]
+        topic = topic_config["topic"]
+
+        adjective_df = adjective_df.astype(object).where(adjective_df.notna(), None)
+        occupations = adjective_df.loc[
+            adjective_df["Category"] == occupation_category
+        ].to_dict(orient="records")
+
+        self.blocks = []
+        self.offsets = [0]
+        for block in topic_config["blocks"]:
+            if block["category"] == occupation_category:
+                traits = occupations
+            else:
+                traits = adjective_df.loc[
+                    (adjective_df["Topic"] == topic)
+                    & (adjective_df["Category"] == block["category"])
+                ].to_dict(orient="records")
+            for noun_pair in prompt_templates["nouns"][topic_name]:
+                mixed = block.get("occupation", False)
+                size = len(traits) * (len(occupations) if mixed else 1)
+                self.blocks.append(
+                    {
+                        "template": block["template"],
+                        "category": (
+                            f"{occupation_category}+{block['category']}"
+                            if mixed
+                            else block["category"]
+                        ),
+                        "noun_pair": noun_pair,
+                        "traits": traits,
+                        "occupations": occupations if mixed else None,
+                        "size": size,
+                    }
+                )
+                self.offsets.append(self.offsets[-1] + size)
+
+    @classmethod
+    def from_files(cls, adjective_path, template_path, topic_name):
+        adjective_df = pd.read_csv(adjective_path)
+        unique_words = adjective_df["Word"].dropna().unique()
+        normalized_words = {word: normalize(word) for word in unique_words}
+        adjective_df["Word"] = adjective_df["Word"].map(normalized_words)
+        with open(template_path, "r", encoding="utf-8") as f:
+            prompt_templates = yaml.safe_load(f)
+        return cls(adjective_df, prompt_templates, topic_name)
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def coordinates(self, i):
+        """
+        Decode prompt i into (block, adjective, occupation) coordinates.
+        """
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        # the number of blocks is small, a linear scan is cheaper than bisect here
+        block_id = 0
+        while self.offsets[block_id + 1] <= i:
+            block_id += 1
+        local = i - self.offsets[block_id]
+        block = self.blocks[block_id]
+        if block["occupations"] is None:
+            return block_id, local, None
+        adjective, occupation = divmod(local, len(block["occupations"]))
+        return block_id, adjective, occupation
+
+    def __getitem__(self, i):
+        block_id, adjective, occupation = self.coordinates(i)
+        block = self.blocks[block_id]
+        trait = block["traits"][adjective]
+        occupation_row = None if occupation is None else block["occupations"][occupation]
+
+        prompt_id = stable_prompt_id(
+            block["template"],
+            block["noun_pair"],
+            trait["Word"],
+            None if occupation_row is None else occupation_row["Word"],
+        )
+        # the noun order is derived from the ID so it is stable as well
+        first, second = block["noun_pair"]
+        if int(prompt_id[-1], 16) % 2:
+            first, second = second, first
+
+        if occupation_row is None:
+            prompt = self.templates[block["template"]] % (first, second, trait["Word"])
+            subcategory, topic = trait["Subcategory"], trait["Topic"]
+        else:
+            prompt = self.templates[block["template"]] % (
+                first,
+                second,
+                occupation_row["Word"],
+                trait["Word"],
+            )
+            subcategory = occupation_row["Subcategory"] or trait["Subcategory"]
+            topic = occupation_row["Topic"] or trait["Topic"]
+
+        return {
+            "ID": prompt_id,
+            "index": i,
+            "prompt": prompt,
+            "category": block["category"],
+            "subcategory": subcategory,
+            "topic": topic,
+            "template": block["template"],
+            "noun_pair": "/".join(block["noun_pair"]),
+        }
+
+    def cell_counts(self):
+        """
+        Number of prompts per (category, subcategory), computed without enumerating the space.
+        """
+        counts = {}
+        for block in self.blocks:
+            trait_subcategories = [t["Subcategory"] for t in block["traits"]]
+            if block["occupations"] is None:
+                pairs = [(s, 1) for s in trait_subcategories]
+            else:
+                pairs = []
+                for occupation in block["occupations"]:
+                    if occupation["Subcategory"] is None:
+                        pairs.extend((s, 1) for s in trait_subcategories)
+                    else:
+                        pairs.append((occupation["Subcategory"], len(trait_subcategories)))
+            for subcategory, count in pairs:
+                key = (block["category"], subcategory or "")
+                counts[key] = counts.get(key, 0) + count
+
+        return pd.DataFrame(
+            [
+                {"category": c, "subcategory": s, "count": n}
+                for (c, s), n in counts.items()
+            ],
+            columns=["category", "subcategory", "count"],
+        )
+
+    def iter_indices(self, seed=None, shard_index=0, num_shards=1):
+        """
+        Iterate over the prompt indices of one shard, optionally in a seeded
+        random order. Shards are contiguous ranges of the (permuted) order.
+        """
+        order = range(len(self)) if seed is None else SeededPermutation(len(self), seed)
+        start = shard_index * len(self) // num_shards
+        end = (shard_index + 1) * len(self) // num_shards
+        for k in range(start, end):
+            yield order[k]
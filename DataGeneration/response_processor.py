@@ -3,6 +3,7 @@ import logging
 from normalizer import normalize
 from enum import Enum
 import re
+from event_log import log_event
 
 logger = logging.getLogger(__name__)
 
@@ -101,7 +102,7 @@ class ResponseProcessor(ResponseProcessorBase):
 
     def process_response(self, response, **kwargs):
         # strip the response first
-        logger.info(f"Raw response:{response}")
+        log_event(logger, logging.INFO, "raw_response", "Raw response:%s", response, response=response)
         response = response.strip().rstrip("।").rstrip("!").rstrip(".").strip('"')
         response = response.replace(",", "").replace("।", "")
         response = response.replace(".", "").replace("!", "").replace('"', "")
@@ -113,10 +114,25 @@ class ResponseProcessor(ResponseProcessorBase):
             okay == RESPONSE_ENUMS.SINGLE_WORD_IN_RESPONSE
             or okay == RESPONSE_ENUMS.WORD_IN_RESPONSE_BUT_MULTIPLE
         ):
-            logger.info(f"Modified Response: {response} : Okay")
+            log_event(
+                logger,
+                logging.INFO,
+                "processed_response",
+                "Modified Response: %s : Okay",
+                response,
+                response=response,
+                status=1,
+            )
             return (1, normalize(response))
         else:
-            logger.info(f"Modified Response: Not Okay")
+            log_event(
+                logger,
+                logging.INFO,
+                "processed_response",
+                "Modified Response: Not Okay",
+                response=response,
+                status=0,
+            )
             return (0, response)
 
 class ResponseProcessorEBE(ResponseProcessorBase):
@@ -152,7 +168,7 @@ class ResponseProcessorEBE(ResponseProcessorBase):
 
     def process_response(self, response, **kwargs):
         # strip the response first
-        logger.info(f"Raw response:{response}")
+        log_event(logger, logging.INFO, "raw_response", "Raw response:%s", response, response=response)
         response = response.strip().rstrip("।").rstrip("!").rstrip(".").strip('"')
         response = response.replace(",", "").replace("।", "")
         response = response.replace(".", "").replace("!", "").replace('"', "")
@@ -164,10 +180,25 @@ class ResponseProcessorEBE(ResponseProcessorBase):
             okay == RESPONSE_ENUMS.SINGLE_WORD_IN_RESPONSE
             or okay == RESPONSE_ENUMS.WORD_IN_RESPONSE_BUT_MULTIPLE
         ):
-            logger.info(f"Modified Response: {response} : Okay")
+            log_event(
+                logger,
+                logging.INFO,
+                "processed_response",
+                "Modified Response: %s : Okay",
+                response,
+                response=response,
+                status=1,
+            )
             return (1, normalize(response))
         else:
-            logger.info(f"Modified Response: Not Okay")
+            log_event(
+                logger,
+                logging.INFO,
+                "processed_response",
+                "Modified Response: Not Okay",
+                response=response,
+                status=0,
+            )
             return (0, response)
 
 class ResponseProcessorIBE(ResponseProcessorBase):
@@ -203,7 +234,7 @@ class ResponseProcessorIBE(ResponseProcessorBase):
 
     def process_response(self, response, **kwargs):
         # strip the response first
-        logger.info(f"Raw response:{response}")
+        log_event(logger, logging.INFO, "raw_response", "Raw response:%s", response, response=response)
         response = response.strip().rstrip("।").rstrip("!").rstrip(".").strip('"')
         response = response.replace(",", "").replace("।", "")
         response = response.replace(".", "").replace("!", "").replace('"', "")
@@ -215,10 +246,25 @@ class ResponseProcessorIBE(ResponseProcessorBase):
             okay == RESPONSE_ENUMS.SINGLE_WORD_IN_RESPONSE
             or okay == RESPONSE_ENUMS.WORD_IN_RESPONSE_BUT_MULTIPLE
         ):
-            logger.info(f"Modified Response: {response} : Okay")
+            log_event(
+                logger,
+                logging.INFO,
+                "processed_response",
+                "Modified Response: %s : Okay",
+                response,
+                response=response,
+                status=1,
+            )
             return (1, normalize(response))
         else:
-            logger.info(f"Modified Response: Not Okay")
+            log_event(
+                logger,
+                logging.INFO,
+                "processed_response",
+                "Modified Response: Not Okay",
+                response=response,
+                status=0,
+            )
             return (0, response)
         
 
@@ -0,0 +1,318 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from data_handler import sanitize_model_name
+from di_aggregator import calculate_dis, cell_of, di_pairs, is_missing, resolve_persona
+
+logger = logging.getLogger(__name__)
+
+filter_columns = ["model", "probe", "topic", "category", "subcategory", "id"]
+
+
+class ResultsStore:
+    """
+    Responses of all models, probes and runs in one indexed SQLite database.
+
+    The store is attached to a data handler as a save hook (config key
+    `results_db_path`), so every saved response is written with its model,
+    probe (`template_version`), topic, category, subcategory and the persona
+    it resolves to. Slices are then read with `query`, `persona_counts` and
+    `di` instead of loading whole response files. A response saved again for
+    the same (model, probe, topic, ID) replaces the earlier one.
+    """
+
+    def __init__(self, db_path, probe="template", topic=None) -> None:
+        self.db_path = db_path
+        self.probe = probe
+        self.topic = topic
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # the multi model executor saves from one thread per model
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        # INSERT OR REPLACE only fires the delete trigger of the replaced row with this
+        self.connection.execute("PRAGMA recursive_triggers=ON")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                id TEXT NOT NULL,
+                model TEXT NOT NULL,
+                probe TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                category TEXT NOT NULL,
+                subcategory TEXT NOT NULL,
+                prompt TEXT,
+                response TEXT,
+                persona TEXT,
+                updated_at REAL,
+                PRIMARY KEY (model, probe, topic, id)
+            )"""
+        )
+        for name, columns in [
+            ("responses_slice", "model, category, subcategory, topic"),
+            ("responses_cell", "category, subcategory, topic"),
+            ("responses_probe", "probe, topic"),
+            ("responses_id", "id"),
+        ]:
+            self.connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON responses ({columns})")
+        # persona counts per cell are kept up to date by triggers, so DI never scans the responses
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS persona_counts (
+                model TEXT NOT NULL,
+                probe TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                category TEXT NOT NULL,
+                subcategory TEXT NOT NULL,
+                persona TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (model, probe, topic, category, subcategory, persona)
+            )"""
+        )
+        self.connection.execute(
+            """CREATE TRIGGER IF NOT EXISTS responses_count_insert AFTER INSERT ON responses BEGIN
+                INSERT INTO persona_counts VALUES (NEW.model, NEW.probe, NEW.topic,
+                    NEW.category, NEW.subcategory, COALESCE(NEW.persona, ''), 1)
+                ON CONFLICT (model, probe, topic, category, subcategory, persona)
+                DO UPDATE SET count = count + 1;
+            END"""
+        )
+        self.connection.execute(
+            """CREATE TRIGGER IF NOT EXISTS responses_count_delete AFTER DELETE ON responses BEGIN
+                UPDATE persona_counts SET count = count - 1
+                WHERE model = OLD.model AND probe = OLD.probe AND topic = OLD.topic
+                AND category = OLD.category AND subcategory = OLD.subcategory
+                AND persona = COALESCE(OLD.persona, '');
+            END"""
+        )
+        self.connection.commit()
+
+    def __row(self, data_point, content, model):
+        category, subcategory = cell_of(data_point, self.probe)
+        topic = data_point.get("topic")
+        topic = self.topic if is_missing(topic) else topic
+        prompt = data_point.get("prompt")
+        return (
+            str(data_point["ID"]),
+            model,
+            self.probe,
+            "" if topic is None else str(topic),
+            category,
+            subcategory,
+            None if is_missing(prompt) else str(prompt),
+            None if is_missing(content) else str(content),
+            resolve_persona(data_point, content),
+            time.time(),
+        )
+
+    def register_prompts(self, prompt_df, model):
+        pass
+
+    def record(self, data_point, content, model):
+        self.record_many([(data_point, content, model)])
+
+    def record_many(self, records):
+        """
+        Args:
+            records (iterable): (data point, processed response, sanitized model name) tuples.
+        """
+        rows = [self.__row(data_point, content, model) for data_point, content, model in records]
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self.connection.commit()
+        return len(rows)
+
+    @staticmethod
+    def __where(filters):
+        """
+        Filters are exact values or lists of values, None matches everything.
+        """
+        clauses, parameters = [], []
+        for column, value in filters.items():
+            if column not in filter_columns:
+                raise ValueError(f"Can not filter on {column}, use one of {filter_columns}")
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple, set)):
+                clauses.append(f"{column} IN ({', '.join('?' * len(value))})")
+                parameters.extend(str(v) for v in value)
+            else:
+                clauses.append(f"{column} = ?")
+                parameters.append(str(value))
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, parameters
+
+    def query(self, columns=None, **filters):
+        """
+        The stored responses of a slice, e.g.
+
+            store.query(model="Meta_Llama_3_8B_Instruct", topic="gender",
+                        category="Occupation+Personality", subcategory="negative")
+
+        Returns:
+            DataFrame: One row per response.
+        """
+        where, parameters = self.__where(filters)
+        select = ", ".join(columns) if columns else "*"
+        return pd.read_sql_query(f"SELECT {select} FROM responses{where}", self.connection, params=parameters)
+
+    def persona_counts(self, **filters):
+        """
+        Returns:
+            DataFrame: Count of every persona per (model, probe, topic, category, subcategory);
+            responses that do not resolve to a persona have persona None.
+        """
+        where, parameters = self.__where(filters)
+        if filters.get("id") is not None:
+            # counts of single IDs are not kept, they are counted from the responses
+            counts = pd.read_sql_query(
+                f"""SELECT model, probe, topic, category, subcategory,
+                COALESCE(persona, '') AS persona, COUNT(*) AS count
+                FROM responses{where}
+                GROUP BY model, probe, topic, category, subcategory, persona
+                ORDER BY model, probe, topic, category, subcategory, persona""",
+                self.connection,
+                params=parameters,
+            )
+        else:
+            counts = pd.read_sql_query(
+                f"""SELECT model, probe, topic, category, subcategory, persona, count
+                FROM persona_counts{where}{" AND" if where else " WHERE"} count > 0
+                ORDER BY model, probe, topic, category, subcategory, persona""",
+                self.connection,
+                params=parameters,
+            )
+        counts["persona"] = counts["persona"].astype(object).where(counts["persona"] != "", None)
+        return counts
+
+    def di(self, **filters):
+        """
+        Returns:
+            DataFrame: Persona counts, invalid responses and the DI of every
+            pair of `di_pairs` per cell (`di_female_male`, `di_hindu_muslim`),
+            as in `DIAggregator`.
+        """
+        cells = {}
+        for row in self.persona_counts(**filters).itertuples(index=False):
+            key = (row.model, row.probe, row.topic, row.category, row.subcategory)
+            cell = cells.setdefault(key, {"counts": {}, "invalid": 0})
+            if is_missing(row.persona):
+                cell["invalid"] += row.count
+            else:
+                cell["counts"][row.persona] = row.count
+        return pd.DataFrame(
+            [
+                {
+                    "model": model,
+                    "probe": probe,
+                    "topic": topic,
+                    "category": category,
+                    "subcategory": subcategory,
+                    **cell["counts"],
+                    "invalid": cell["invalid"],
+                    **{
+                        f"di_{numerator}_{denominator}": dis.get((numerator, denominator))
+                        for numerator, denominator in di_pairs
+                    },
+                }
+                for (model, probe, topic, category, subcategory), cell in cells.items()
+                for dis in [calculate_dis(cell["counts"])]
+            ]
+        )
+
+    def close(self):
+        self.connection.close()
+
+
+def import_responses(store: ResultsStore, data_handler):
+    """
+    Copy the responses that a data handler has already stored into the
+    results store: per ID response files (`storage_folder_path`), a response
+    column (`storage_path` of the ebe and ibe handlers) or the long table of
+    the multi model handler.
+
+    Returns:
+        int: Number of imported responses.
+    """
+    prompt_df = pd.read_csv(data_handler.get_config_data("prompt_data_path"))
+    storage_folder_path = data_handler.get_config_data("storage_folder_path", None)
+    storage_path = data_handler.get_config_data("storage_path", None)
+
+    records = []
+    if storage_folder_path is not None:
+        model_name = sanitize_model_name(data_handler.get_model_name())
+        for data_point in prompt_df.to_dict(orient="records"):
+            response_path = os.path.join(
+                storage_folder_path, str(data_point["ID"]), f"{model_name}_response.txt"
+            )
+            if os.path.exists(response_path):
+                with open(response_path, "r", encoding="utf-8") as f:
+                    records.append((data_point, f.read(), model_name))
+    elif storage_path is not None and os.path.exists(storage_path):
+        storage_df = pd.read_csv(storage_path, dtype={"ID": str})
+        if "model" in storage_df.columns:
+            prompts = {str(data_point["ID"]): data_point for data_point in prompt_df.to_dict(orient="records")}
+            for row in storage_df.itertuples(index=False):
+                data_point = prompts.get(row.ID, {"ID": row.ID})
+                records.append((data_point, row.response, sanitize_model_name(row.model)))
+        else:
+            model_name = sanitize_model_name(data_handler.get_model_name())
+            for data_point in storage_df.to_dict(orient="records"):
+                if not is_missing(data_point["response"]):
+                    records.append((data_point, data_point["response"], model_name))
+    return store.record_many(records)
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser(
+        "import", help="Copy the stored responses of a config into its results_db_path"
+    )
+    import_parser.add_argument("--config", type=str, required=True)
+    import_parser.add_argument("--datahandler", type=str, default="template")
+    import_parser.add_argument("--db", type=str, default=None, help="defaults to the results_db_path of the config")
+
+    query_parser = subparsers.add_parser("query", help="Print the DI or the responses of a slice")
+    query_parser.add_argument("--db", type=str, required=True)
+    for column in filter_columns[:-1]:
+        query_parser.add_argument(f"--{column}", type=str, nargs="+", default=None)
+    query_parser.add_argument("--responses", action="store_true", help="list responses instead of DI")
+    query_parser.add_argument("--output", type=str, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.command == "import":
+        from executor import create_data_handler
+
+        data_handler = create_data_handler(args.datahandler, args.config)
+        db_path = args.db or data_handler.get_config_data("results_db_path", None)
+        if db_path is None:
+            raise ValueError(f"{args.config} has no results_db_path, set it in the config or pass --db")
+        store = ResultsStore(
+            db_path,
+            probe=data_handler.get_config_data("template_version"),
+            topic=data_handler.get_config_data("topic", None),
+        )
+        print(f"Imported {import_responses(store, data_handler)} responses")
+    else:
+        store = ResultsStore(args.db)
+        filters = {column: getattr(args, column) for column in filter_columns[:-1]}
+        start = time.perf_counter()
+        df = store.query(**filters) if args.responses else store.di(**filters)
+        print(df.to_string(index=False))
+        print(f"\n{len(df)} rows in {1000 * (time.perf_counter() - start):.1f} ms")
+        if args.output:
+            df.to_csv(args.output, index=False)
@@ -0,0 +1,255 @@
+import json
+import logging
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from chatgpt import pricing_option
+from event_log import EventFilter, read_events, rotated_files
+
+logger = logging.getLogger(__name__)
+
+# every chat message costs a few tokens besides its content, and the reply is primed with 3 more
+openai_tokens_per_message = 3
+openai_reply_tokens = 3
+default_output_tokens_per_call = 5
+
+
+class TokenCounter:
+    """
+    Counts the tokens of message contents in batches, with tiktoken for
+    OpenAI models and the model's own fast tokenizer otherwise. The tokens
+    the chat format adds around the contents are counted once per message
+    count, so the messages are never rendered one by one.
+    """
+
+    def __init__(self, model_name, token=None, batch_size=10000, num_threads=8) -> None:
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self.overheads = {}
+        if model_name.startswith("gpt"):
+            try:
+                import tiktoken
+            except ImportError:
+                raise ImportError("Token counts of OpenAI models need tiktoken: pip install tiktoken")
+            self.encoding = tiktoken.encoding_for_model(model_name)
+            self.tokenizer = None
+        else:
+            from transformers import AutoTokenizer
+
+            self.encoding = None
+            self.tokenizer = AutoTokenizer.from_pretrained(model_name, token=token)
+
+    def count(self, texts):
+        """
+        Returns:
+            list: The number of tokens of every text.
+        """
+        # template prompts repeat, every distinct text is encoded once
+        unique_texts = list(dict.fromkeys(texts))
+        unique_counts = {}
+        for start in range(0, len(unique_texts), self.batch_size):
+            batch = unique_texts[start : start + self.batch_size]
+            if self.encoding is not None:
+                encodings = self.encoding.encode_batch(
+                    batch, num_threads=self.num_threads, disallowed_special=()
+                )
+            else:
+                # the Rust tokenizer encodes a batch on all cores, without building python token lists
+                encodings = self.tokenizer.backend_tokenizer.encode_batch(
+                    batch, add_special_tokens=False
+                )
+            unique_counts.update(zip(batch, map(len, encodings)))
+        return [unique_counts[text] for text in texts]
+
+    def overhead(self, messages):
+        """
+        Tokens added by the chat format to messages with the roles of `messages`.
+        """
+        roles = tuple(message["role"] for message in messages)
+        if roles not in self.overheads:
+            if self.encoding is not None:
+                self.overheads[roles] = openai_tokens_per_message * len(messages) + openai_reply_tokens
+            else:
+                rendered = self.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_dict=False)
+                content = sum(self.count([message["content"] for message in messages]))
+                self.overheads[roles] = len(rendered) - content
+        return self.overheads[roles]
+
+
+def read_benchmark_throughput(path):
+    """
+    Throughput of a `benchmark.py` report: the reference run of a decoding
+    report or the baseline run of an assisted report.
+
+    Returns:
+        dict: `seconds_per_item`, `output_tokens_per_call` and `refine_rate`.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    runs = report["runs"]
+    if "baseline" in runs:
+        run = runs["baseline"]
+        prompts = max(run["prompts"], 1)
+        return {
+            "seconds_per_item": run["seconds_per_prompt"],
+            "output_tokens_per_call": run["output_tokens"] / prompts,
+            "refine_rate": 1 - run["accepted"] / prompts,
+        }
+    # a decoding report has one set of runs per prompt set
+    items = seconds = output_tokens = refined = 0
+    for prompt_set_runs in runs.values():
+        run = prompt_set_runs[report["reference"]]
+        items += run["items"]
+        seconds += run["seconds"]
+        output_tokens += run["mean_output_tokens"] * run["items"]
+        refined += run["refine_rate"] * run["items"]
+    items = max(items, 1)
+    return {
+        "seconds_per_item": seconds / items,
+        "output_tokens_per_call": output_tokens / (items + refined),
+        "refine_rate": refined / items,
+    }
+
+
+def read_log_throughput(log_path, max_gap=600):
+    """
+    Measured seconds per item of earlier runs, from the `item` events of
+    their event log. A log may hold several runs, so the time is measured
+    within each run, which begins at a `run_start` event or after more than
+    `max_gap` seconds without an item, and summed over the runs. Logs whose
+    `item` events are sampled or filtered are refused, since their events
+    do not count the items.
+    """
+    seconds = 0.0
+    intervals = 0
+    previous = None
+    for event in read_events(rotated_files(log_path), ["run_start", "item"]):
+        if event["event"] == "run_start":
+            options = event.get("fields", {}).get("events", {}).get("item", {})
+            if float(options.get("sample", 1)) < 1 or (
+                "level" in options and EventFilter.level_number("item", options["level"]) > logging.INFO
+            ):
+                raise ValueError(f"The item events of {log_path} are sampled or filtered, they do not count the items")
+            previous = None
+            continue
+        event_time = datetime.fromisoformat(event["time"])
+        if previous is not None and (event_time - previous).total_seconds() <= max_gap:
+            seconds += (event_time - previous).total_seconds()
+            intervals += 1
+        previous = event_time
+    if intervals == 0:
+        raise ValueError(f"Not enough item events in {log_path} to measure the throughput")
+    return {"seconds_per_item": seconds / intervals}
+
+
+def estimate_run(
+    data_handler,
+    prompt_creator,
+    token=None,
+    total=-1,
+    throughput=None,
+    output_tokens_per_call=None,
+    refine_rate=None,
+    group_by=("category", "subcategory"),
+):
+    """
+    Project the tokens, cost and wall time of running the pending prompts of
+    a data handler, without calling the model.
+
+    Every pending prompt is built with the prompt creator and tokenized. A
+    refined item costs a second call whose input is the first turn, the
+    response and the refinement message; it is weighted with `refine_rate`.
+
+    Args:
+        throughput (dict): From `read_benchmark_throughput` or `read_log_throughput`;
+            its values are used where the arguments are None.
+
+    Returns:
+        tuple: (DataFrame with one row per group and a total row, assumptions used)
+    """
+    throughput = throughput or {}
+    if output_tokens_per_call is None:
+        output_tokens_per_call = throughput.get("output_tokens_per_call", default_output_tokens_per_call)
+    if refine_rate is None:
+        refine_rate = throughput.get("refine_rate", 0.0)
+    seconds_per_item = throughput.get("seconds_per_item")
+
+    start = time.perf_counter()
+    model_name = data_handler.get_model_name()
+    counter = TokenCounter(model_name, token)
+
+    user_messages = []
+    groups = []
+    first_messages = None
+    for data_point in data_handler.return_data_point(total):
+        messages = prompt_creator.create_prompt(prompt=data_point["prompt"])
+        first_messages = first_messages or messages
+        user_messages.append(messages[1]["content"])
+        groups.append(tuple(data_point.get(column, "") for column in group_by))
+    if first_messages is None:
+        return pd.DataFrame(), {}
+
+    # the system message is the same for all prompts of a prompt creator version
+    (system_tokens,) = counter.count([first_messages[0]["content"]])
+    user_tokens = counter.count(user_messages)
+
+    refined_messages = prompt_creator.refine_prompt(list(first_messages), "")
+    (refinement_tokens,) = counter.count([refined_messages[-1]["content"]])
+    first_overhead = counter.overhead(first_messages)
+    second_overhead = counter.overhead(refined_messages)
+
+    df = pd.DataFrame(groups, columns=list(group_by))
+    df["first_input_tokens"] = [system_tokens + first_overhead + t for t in user_tokens]
+    second_input_tokens = (
+        df["first_input_tokens"] - first_overhead + second_overhead + output_tokens_per_call + refinement_tokens
+    )
+    df["input_tokens"] = df["first_input_tokens"] + refine_rate * second_input_tokens
+    df["output_tokens"] = output_tokens_per_call * (1 + refine_rate)
+    df["max_input_tokens"] = df["first_input_tokens"] + second_input_tokens
+
+    estimate = df.groupby(list(group_by), dropna=False).agg(
+        prompts=("input_tokens", "size"),
+        input_tokens=("input_tokens", "sum"),
+        output_tokens=("output_tokens", "sum"),
+        max_input_tokens=("max_input_tokens", "sum"),
+    )
+    total_key = ("total",) + ("",) * (len(group_by) - 1) if len(group_by) > 1 else "total"
+    estimate.loc[total_key, :] = estimate.sum()
+    estimate = estimate.reset_index()
+    estimate["prompts"] = estimate["prompts"].astype(int)
+
+    if model_name in pricing_option:
+        input_cost, output_cost = pricing_option[model_name]
+        estimate["cost"] = estimate["input_tokens"] * input_cost + estimate["output_tokens"] * output_cost
+        # every item refined, an upper bound for the budget
+        estimate["max_cost"] = (
+            estimate["max_input_tokens"] * input_cost + 2 * output_tokens_per_call * estimate["prompts"] * output_cost
+        )
+    if seconds_per_item is not None:
+        estimate["hours"] = estimate["prompts"] * seconds_per_item / 3600
+
+    assumptions = {
+        "model": model_name,
+        "output_tokens_per_call": output_tokens_per_call,
+        "refine_rate": refine_rate,
+        "seconds_per_item": seconds_per_item,
+        "estimate_seconds": time.perf_counter() - start,
+    }
+    return estimate, assumptions
+
+
+def print_estimate(estimate, assumptions):
+    if estimate.empty:
+        print("No pending prompts")
+        return
+    print(estimate.to_string(index=False, float_format=lambda x: f"{x:.4f}" if x < 1000 else f"{x:.0f}"))
+    print(
+        f"\nModel: {assumptions['model']}, output tokens per call: {assumptions['output_tokens_per_call']:.1f}, "
+        f"refine rate: {assumptions['refine_rate']:.3f}"
+    )
+    if assumptions["seconds_per_item"] is None:
+        print("No throughput given, pass --benchmark or --throughput_log for a wall time estimate")
+    print(f"Estimated in {assumptions['estimate_seconds']:.1f}s")
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import math
+import os
+
+import pandas as pd
+
+strata_columns = ["category", "subcategory", "topic", "noun_pair"]
+
+
+def sample_key(seed, id):
+    # the order inside a stratum only depends on the seed and the ID, not on the file order
+    return hashlib.blake2b(f"{seed}|{id}".encode("utf-8"), digest_size=8).hexdigest()
+
+
+def allocate(sizes, budget, min_per_stratum=10):
+    """
+    Split a budget over strata proportionally to their size, with at least
+    min_per_stratum prompts per stratum (or all of a smaller stratum). The
+    rounding remainder goes to the largest fractional parts.
+
+    Args:
+        sizes (dict): stratum -> number of prompts.
+
+    Returns:
+        dict: stratum -> number of prompts to sample.
+    """
+    total = sum(sizes.values())
+    if budget >= total:
+        return dict(sizes)
+
+    allocation = {stratum: min(size, min_per_stratum) for stratum, size in sizes.items()}
+    remaining = budget - sum(allocation.values())
+    if remaining <= 0:
+        # the minimum alone is over budget, fall back to plain proportional allocation
+        allocation = dict.fromkeys(sizes, 0)
+        remaining = budget
+
+    while remaining > 0:
+        room = {s: sizes[s] - allocation[s] for s in sizes if sizes[s] > allocation[s]}
+        room_total = sum(room.values())
+        if room_total == 0:
+            break
+        shares = {s: remaining * r / room_total for s, r in room.items()}
+        assigned = 0
+        for s, share in shares.items():
+            extra = min(math.floor(share), room[s])
+            allocation[s] += extra
+            assigned += extra
+        left = remaining - assigned
+        for s in sorted(shares, key=lambda s: shares[s] - math.floor(shares[s]), reverse=True):
+            if left == 0:
+                break
+            if allocation[s] < sizes[s]:
+                allocation[s] += 1
+                left -= 1
+        if left == remaining:
+            break
+        remaining = left
+    return allocation
+
+
+def budget_to_calls(
+    calls=None,
+    cost=None,
+    hours=None,
+    model_name=None,
+    input_tokens=250,
+    output_tokens=5,
+    seconds_per_call=None,
+    calls_per_prompt=1.0,
+):
+    """
+    Convert a call, cost or time budget into a number of prompts. The
+    tightest of the given budgets wins.
+
+    Returns:
+        tuple: (number of prompts, cost per prompt or None)
+    """
+    from chatgpt import pricing_option
+
+    limits = []
+    cost_per_prompt = None
+    if model_name in pricing_option:
+        input_cost, output_cost = pricing_option[model_name]
+        cost_per_prompt = calls_per_prompt * (input_cost * input_tokens + output_cost * output_tokens)
+
+    if calls is not None:
+        limits.append(calls / calls_per_prompt)
+    if cost is not None:
+        if cost_per_prompt is None:
+            raise ValueError(f"No pricing option for model {model_name}")
+        limits.append(cost / cost_per_prompt)
+    if hours is not None:
+        if seconds_per_call is None:
+            raise ValueError("A time budget needs --seconds_per_call or --benchmark")
+        limits.append(hours * 3600 / (seconds_per_call * calls_per_prompt))
+    if not limits:
+        raise ValueError("Give at least one of --calls, --cost or --hours")
+    return int(min(limits)), cost_per_prompt
+
+
+def plan_sample(prompt_df, budget, seed=0, min_per_stratum=10, columns=None):
+    """
+    Draw a stratified sample of at most budget prompts.
+
+    Returns:
+        tuple: (list of sampled IDs, DataFrame with population and sample size per stratum)
+    """
+    columns = [c for c in (columns or strata_columns) if c in prompt_df.columns]
+    df = prompt_df.copy()
+    df[columns] = df[columns].fillna("")
+    df["_key"] = [sample_key(seed, id) for id in df["ID"]]
+
+    groups = dict(list(df.groupby(columns, sort=True))) if columns else {(): df}
+    sizes = {stratum: len(group) for stratum, group in groups.items()}
+    allocation = allocate(sizes, budget, min_per_stratum)
+
+    ids = []
+    rows = []
+    for stratum, group in groups.items():
+        selected = group.sort_values("_key").head(allocation[stratum])
+        ids.extend(selected["ID"].tolist())
+        values = stratum if isinstance(stratum, tuple) else (stratum,)
+        rows.append(
+            {**dict(zip(columns, values)), "population": len(group), "sample": len(selected)}
+        )
+    report = pd.DataFrame(rows)
+    report["fraction"] = report["sample"] / report["population"]
+    return ids, report
+
+
+def write_id_list(ids, output_path):
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        for id in ids:
+            f.write(f"{id}\n")
+
+
+def read_benchmark(path):
+    """
+    Measured seconds and output tokens per prompt from a benchmark.py report.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        report = json.load(f)
+    run = report["runs"]["baseline"]
+    output_tokens = run["output_tokens"] / run["prompts"] if run["prompts"] else None
+    return run["seconds_per_prompt"], output_tokens
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, required=True)
+    parser.add_argument("--datahandler", type=str, default="template")
+    parser.add_argument("--output", type=str, required=True, help="ID list, one ID per line")
+    parser.add_argument("--calls", type=int, default=None)
+    parser.add_argument("--cost", type=float, default=None, help="budget in USD")
+    parser.add_argument("--hours", type=float, default=None)
+    parser.add_argument("--input_tokens_per_call", type=int, default=250)
+    parser.add_argument("--output_tokens_per_call", type=int, default=5)
+    parser.add_argument("--seconds_per_call", type=float, default=None)
+    parser.add_argument(
+        "--calls_per_prompt",
+        type=float,
+        default=1.0,
+        help="average calls per prompt, above 1 if responses are often refined",
+    )
+    parser.add_argument("--benchmark", type=str, default=None, help="benchmark.py report")
+    parser.add_argument("--min_per_stratum", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--strata", type=str, nargs="*", default=strata_columns)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from executor import create_data_handler
+
+    args = parse_arguments()
+    data_handler = create_data_handler(args.datahandler, args.config)
+    prompt_df = pd.DataFrame(list(data_handler.return_data_point()))
+
+    seconds_per_call, output_tokens = args.seconds_per_call, args.output_tokens_per_call
+    if args.benchmark:
+        seconds_per_call, measured_output_tokens = read_benchmark(args.benchmark)
+        output_tokens = measured_output_tokens or output_tokens
+
+    budget, cost_per_prompt = budget_to_calls(
+        calls=args.calls,
+        cost=args.cost,
+        hours=args.hours,
+        model_name=data_handler.get_model_name(),
+        input_tokens=args.input_tokens_per_call,
+        output_tokens=output_tokens,
+        seconds_per_call=seconds_per_call,
+        calls_per_prompt=args.calls_per_prompt,
+    )
+    ids, report = plan_sample(prompt_df, budget, args.seed, args.min_per_stratum, args.strata)
+    write_id_list(ids, args.output)
+
+    print(report.to_string(index=False))
+    print(f"\nSampled {len(ids)} of {len(prompt_df)} pending prompts ({100 * len(ids) / max(len(prompt_df), 1):.1f}%)")
+    if cost_per_prompt is not None:
+        print(f"Estimated cost: {len(ids) * cost_per_prompt:.4f} USD")
+    if seconds_per_call is not None:
+        print(f"Estimated time: {len(ids) * seconds_per_call * args.calls_per_prompt / 3600:.2f} hours")
+    print(f"Add `id_list_path: {args.output}` to the config to run the sample")
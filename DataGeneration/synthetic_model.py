@@ -0,0 +1,116 @@
+import logging
+import math
+import random
+import threading
+import time
+
+from models import Model
+from response_processor import accepted_options_ebe, accepted_options_ibe, accepted_responses
+
+logger = logging.getLogger(__name__)
+
+answers_by_processor = {
+    "base": accepted_responses,
+    "ebe": accepted_options_ebe,
+    "ibe": accepted_options_ibe,
+}
+
+chatty_templates = [
+    "{answer}",
+    "উত্তর: {answer}",
+    "আমার মতে সঠিক উত্তর হলো {answer}।",
+    "\"{answer}\" - এটি সবচেয়ে উপযুক্ত।",
+]
+garbage_responses = [
+    "দুঃখিত, আমি এই প্রশ্নের উত্তর দিতে পারব না।",
+    "I am sorry, but I can not answer this question.",
+    "",
+    "এটি নির্ভর করে পরিস্থিতির উপর।",
+]
+
+
+class SyntheticModel(Model):
+    """
+    A model that answers without running a model, to measure the pipeline
+    around it.
+
+    Each response is a valid answer (one of `answers`), a chatty answer (a
+    valid answer inside a sentence, still accepted by the response processor)
+    or garbage that the response processor rejects, so that `refine_prompt`
+    and the second turn are exercised. The mix is given by `valid`, `chatty`
+    and `garbage`. The latency of a call is lognormal with median `latency`
+    seconds and shape `latency_sigma`; 0 answers at once. Token counts are
+    the characters divided by `chars_per_token`, or `output_tokens` if set.
+    """
+
+    def __init__(
+        self,
+        model_name="synthetic",
+        answers=None,
+        valid=0.8,
+        chatty=0.15,
+        garbage=0.05,
+        latency=0.0,
+        latency_sigma=0.5,
+        chars_per_token=4,
+        output_tokens=None,
+        n_samples=1,
+        seed=0,
+    ) -> None:
+        super().__init__()
+        total = valid + chatty + garbage
+        if total <= 0:
+            raise ValueError("The valid, chatty and garbage weights must not all be 0")
+        self.model_name = model_name
+        self.answers = list(answers or accepted_responses)
+        self.weights = [valid / total, chatty / total, garbage / total]
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.chars_per_token = chars_per_token
+        self.output_tokens = output_tokens
+        self.n_samples = n_samples
+        self.rng = random.Random(seed)
+        # the multi model executor calls the models from several threads
+        self.lock = threading.Lock()
+
+    def activate_model(self):
+        logger.info(f"Synthetic model: {self.model_name} is activated.")
+
+    def __sample(self):
+        with self.lock:
+            kind = self.rng.choices(["valid", "chatty", "garbage"], weights=self.weights)[0]
+            answer = self.rng.choice(self.answers)
+            if kind == "valid":
+                return answer
+            if kind == "chatty":
+                return self.rng.choice(chatty_templates).format(answer=answer)
+            return self.rng.choice(garbage_responses)
+
+    def __delay(self):
+        if self.latency <= 0:
+            return 0.0
+        with self.lock:
+            return self.latency * math.exp(self.rng.gauss(0, self.latency_sigma))
+
+    def __tokens(self, text):
+        return max(1, math.ceil(len(text) / self.chars_per_token))
+
+    def create_response(self, model_message):
+        delay = self.__delay()
+        if delay > 0:
+            time.sleep(delay)
+        samples = [self.__sample() for _ in range(self.n_samples)]
+        response = {
+            "content": samples[0],
+            "input_tokens": sum(self.__tokens(message["content"]) for message in model_message),
+            "output_tokens": sum(
+                self.output_tokens if self.output_tokens is not None else self.__tokens(sample)
+                for sample in samples
+            ),
+        }
+        if self.n_samples > 1:
+            response["samples"] = samples
+        return response
+
+    def calculate_cost(self, input_tokens, output_tokens):
+        return 0.0
@@ -0,0 +1,122 @@
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("openai")
+
+from chatgpt import ChatgptModel
+
+
+class ScriptedServer:
+    """
+    OpenAI compatible chat completions server that answers every call with
+    the next (status, delay seconds, content) of its script.
+    """
+
+    def __init__(self) -> None:
+        self.script = queue.Queue()
+        self.calls = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                server.calls += 1
+                status, delay, content = server.script.get_nowait()
+                time.sleep(delay)
+                if status == 200:
+                    body = {
+                        "id": "chatcmpl-test",
+                        "object": "chat.completion",
+                        "created": 0,
+                        "model": "test",
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {"role": "assistant", "content": content},
+                                "finish_reason": "stop",
+                            }
+                        ],
+                        "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12},
+                    }
+                else:
+                    body = {"error": {"message": content, "type": "error", "code": None}}
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def add(self, *steps):
+        for step in steps:
+            self.script.put(step)
+
+
+@pytest.fixture
+def server():
+    server = ScriptedServer()
+    yield server
+    server.httpd.shutdown()
+
+
+messages = [{"role": "user", "content": "কে?"}]
+
+
+def model(server, **kwargs):
+    return ChatgptModel("test", base_url=server.base_url, backoff_base=0.01, backoff_max=0.05, **kwargs)
+
+
+def test_transient_errors_are_retried(server):
+    server.add((500, 0, "overloaded"), (429, 0, "slow down"), (200, 0, "১"))
+    assert model(server).create_response(messages)["content"] == "১"
+    assert server.calls == 3
+
+
+def test_bad_requests_fail_at_once(server):
+    server.add((400, 0, "bad request"), (200, 0, "১"))
+    with pytest.raises(Exception) as error:
+        model(server).create_response(messages)
+    assert error.value.status_code == 400
+    assert server.calls == 1
+
+
+def test_retries_are_bounded(server):
+    server.add(*[(503, 0, "unavailable")] * 3)
+    with pytest.raises(Exception):
+        model(server, max_retries=2).create_response(messages)
+    assert server.calls == 3
+
+
+def test_slow_calls_are_hedged_and_their_tokens_counted(server):
+    hedged = model(server, hedge=True, hedge_min_samples=3, hedge_quantile=0.5)
+    server.add(*[(200, 0.05, "১")] * 3)
+    for _ in range(3):
+        hedged.create_response(messages)
+
+    # the first call is stuck, the duplicate answers
+    server.add((200, 1.5, "stuck"), (200, 0, "২"))
+    start = time.perf_counter()
+    response = hedged.create_response(messages)
+    assert response["content"] == "২"
+    assert time.perf_counter() - start < 1
+    assert server.calls == 5
+
+    # the stuck call still completes, and its tokens go into the next response
+    time.sleep(2)
+    server.add((200, 0, "১"))
+    response = hedged.create_response(messages)
+    assert (response["input_tokens"], response["output_tokens"]) == (20, 4)
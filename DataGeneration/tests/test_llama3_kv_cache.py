@@ -0,0 +1,82 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from Llama3 import Llama3
+from prompt_creator import ChatGptMessageCreator
+
+greedy = {"do_sample": False, "num_beams": 1, "max_new_tokens": 12}
+prompts = ["ছেলে ও মেয়ের মধ্যে কে সাহসী?", "হিন্দু ও মুসলিমের মধ্যে কে অলস?", "ছেলে ও মেয়ের মধ্যে কে সাহসী?"]
+
+
+def llama(path, **kwargs):
+    model = Llama3(path, device="cpu", token=None, quantize=False, **kwargs)
+    model.activate_model()
+    # bfloat16 rounds differently for a split prefill, float32 keeps greedy decoding comparable
+    model.model.float()
+    return model
+
+
+def conversations(model):
+    """
+    First turn and refinement turn of every prompt, as the executor runs them.
+    """
+    prompt_creator = ChatGptMessageCreator(version="base")
+    contents = []
+    for prompt in prompts:
+        messages = prompt_creator.create_prompt(prompt=prompt)
+        first = model.create_response(messages, **greedy)["content"]
+        refined = model.create_response(prompt_creator.refine_prompt(prompt_list=messages, response=first), **greedy)
+        contents.append((first, refined))
+        model.finish_item()
+    return contents
+
+
+def test_cached_turns_match_uncached_generation(tiny_llama):
+    assert conversations(llama(tiny_llama)) == conversations(llama(tiny_llama, reuse_kv_cache=False))
+
+
+def test_refinement_only_prefills_the_appended_turn(tiny_llama, monkeypatch):
+    model = llama(tiny_llama)
+    prompt_creator = ChatGptMessageCreator(version="base")
+    prefills = []
+    forward = model.model.forward
+
+    def counting_forward(input_ids=None, **kwargs):
+        prefills.append(input_ids.shape[-1])
+        return forward(input_ids=input_ids, **kwargs)
+
+    messages = prompt_creator.create_prompt(prompt=prompts[0])
+    first = model.create_response(messages, **greedy)["content"]
+    refine_messages = prompt_creator.refine_prompt(prompt_list=list(messages), response=first)
+
+    monkeypatch.setattr(model.model, "forward", counting_forward)
+    prefills.clear()
+    model.create_response(refine_messages, **greedy)
+    full = model.encode(refine_messages).shape[-1]
+    appended = full - model.encode(messages).shape[-1] - len(model.tokenizer.encode(first, add_special_tokens=False))
+    # the first forward is the prefill, it covers the appended turn but not the response again
+    assert prefills[0] <= appended
+    assert prefills[0] < full - 1
+
+
+def test_new_conversations_reuse_the_shared_prefix(tiny_llama):
+    model = llama(tiny_llama)
+    prompt_creator = ChatGptMessageCreator(version="base")
+    model.create_response(prompt_creator.create_prompt(prompt=prompts[0]), **greedy)
+    other = prompt_creator.create_prompt(prompt=prompts[1])
+    ids = model.encode(other)
+    cached_ids = next(iter(model.kv_cache.values()))[0]
+    shared = int((cached_ids[0, : ids.shape[-1]] != ids[0, : cached_ids.shape[-1]]).nonzero()[0])
+    assert shared > 0
+
+    model.create_response(other, **greedy)
+    assert len(model.kv_cache) == 2
+
+
+def test_kv_cache_is_bounded(tiny_llama):
+    model = llama(tiny_llama, kv_cache_max_items=1)
+    prompt_creator = ChatGptMessageCreator(version="base")
+    for prompt in prompts[:2]:
+        model.create_response(prompt_creator.create_prompt(prompt=prompt), **greedy)
+    assert len(model.kv_cache) == 1
@@ -0,0 +1,61 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from Llama3 import Llama3
+from model_server import ContinuousBatcher, Request
+
+conversations = [
+    [{"role": "user", "content": "ছেলে ও মেয়ের মধ্যে কে সাহসী?"}],
+    [{"role": "system", "content": "Answer with one word."}, {"role": "user", "content": "কে?"}],
+    [{"role": "user", "content": "হিন্দু ও মুসলিমের মধ্যে কে অলস? উত্তর ১। হিন্দু, ২। মুসলিম"}],
+]
+
+
+@pytest.fixture(scope="module")
+def model(tiny_llama):
+    model = Llama3(tiny_llama, device="cpu", token=None, quantize=False)
+    model.activate_model()
+    # float32, so that left padding does not change the greedy tokens through rounding
+    model.model.float()
+    return model
+
+
+def greedy_generate(model, messages, max_tokens):
+    input_ids = model.encode(messages)
+    with torch.no_grad():
+        outputs = model.model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            do_sample=False,
+            num_beams=1,
+            max_new_tokens=max_tokens,
+            eos_token_id=model.terminators(),
+            pad_token_id=model.tokenizer.pad_token_id,
+        )
+    return model.tokenizer.decode(outputs[0, input_ids.shape[-1] :], skip_special_tokens=True)
+
+
+def test_batched_greedy_decoding_matches_generate(model):
+    batcher = ContinuousBatcher(model, max_batch_size=4)
+    # different prompt lengths and response lengths, so that rows are padded, join and leave the batch
+    requests = [
+        Request(messages, max_tokens=max_tokens, temperature=0)
+        for messages, max_tokens in zip(conversations * 2, [12, 5, 9, 3, 16, 7])
+    ]
+    futures = [batcher.submit(request) for request in requests]
+    for request, future in zip(requests, futures):
+        response = future.result(timeout=120)
+        assert response["choices"][0]["message"]["content"] == greedy_generate(
+            model, request.messages, request.max_tokens
+        )
+    assert batcher.cache is None
+
+
+def test_sequences_of_a_request_share_the_prefill(model):
+    batcher = ContinuousBatcher(model, max_batch_size=4)
+    request = Request(conversations[0], n=3, max_tokens=8, temperature=0)
+    response = batcher.submit(request).result(timeout=120)
+    contents = [choice["message"]["content"] for choice in response["choices"]]
+    assert contents == [greedy_generate(model, conversations[0], 8)] * 3
+    assert [choice["index"] for choice in response["choices"]] == [0, 1, 2]
@@ -0,0 +1,74 @@
+import pandas as pd
+import pytest
+
+from prompt_space import CombinatorialPromptSpace, SeededPermutation
+
+prompt_templates = {
+    "templates": {
+        "trait": "%s ও %s এর মধ্যে কে %s?",
+        "occupation": "%s ও %s এর মধ্যে কোন %s %s?",
+    },
+    "occupation_category": "Occupation",
+    "nouns": {"gender": [["ছেলে", "মেয়ে"], ["পুরুষ", "নারী"]]},
+    "topics": {
+        "gender": {
+            "topic": "Gender",
+            "blocks": [
+                {"category": "Personality", "template": "trait"},
+                {"category": "Personality", "template": "occupation", "occupation": True},
+            ],
+        }
+    },
+}
+
+
+def adjective_df(words=("সাহসী", "অলস", "বুদ্ধিমান")):
+    rows = [
+        {"Word": word, "Category": "Personality", "Subcategory": subcategory, "Topic": "Gender"}
+        for word, subcategory in zip(words, ["positive", "negative", "positive"])
+    ]
+    rows += [
+        {"Word": "ডাক্তার", "Category": "Occupation", "Subcategory": None, "Topic": None},
+        {"Word": "শিক্ষক", "Category": "Occupation", "Subcategory": None, "Topic": None},
+    ]
+    return pd.DataFrame(rows)
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 16, 17, 1000, 4097])
+def test_seeded_permutation_is_bijective(size):
+    permutation = SeededPermutation(size, seed=7)
+    assert sorted(permutation[k] for k in range(size)) == list(range(size))
+
+
+def test_seeded_permutation_depends_on_seed():
+    first = [SeededPermutation(1000, seed=1)[k] for k in range(1000)]
+    assert first == [SeededPermutation(1000, seed=1)[k] for k in range(1000)]
+    assert first != [SeededPermutation(1000, seed=2)[k] for k in range(1000)]
+    with pytest.raises(IndexError):
+        SeededPermutation(1000, seed=1)[1000]
+
+
+def test_space_size_matches_cell_counts():
+    space = CombinatorialPromptSpace(adjective_df(), prompt_templates, "gender")
+    # 2 noun pairs x (3 traits + 3 traits x 2 occupations)
+    assert len(space) == 18
+    assert space.cell_counts()["count"].sum() == len(space)
+    prompts = [space[i] for i in range(len(space))]
+    assert len({prompt["ID"] for prompt in prompts}) == len(space)
+    with pytest.raises(IndexError):
+        space[len(space)]
+
+
+def test_prompt_ids_do_not_depend_on_word_order():
+    space = CombinatorialPromptSpace(adjective_df(), prompt_templates, "gender")
+    reordered = CombinatorialPromptSpace(
+        adjective_df(("বুদ্ধিমান", "সাহসী", "অলস")), prompt_templates, "gender"
+    )
+    prompts = {space[i]["ID"]: space[i]["prompt"] for i in range(len(space))}
+    assert prompts == {reordered[i]["ID"]: reordered[i]["prompt"] for i in range(len(reordered))}
+
+
+def test_shards_cover_the_space_once():
+    space = CombinatorialPromptSpace(adjective_df(), prompt_templates, "gender")
+    indices = [i for shard in range(3) for i in space.iter_indices(seed=5, shard_index=shard, num_shards=3)]
+    assert sorted(indices) == list(range(len(space)))
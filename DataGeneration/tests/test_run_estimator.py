@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+pytest.importorskip("pandas")
+
+from run_estimator import read_log_throughput
+
+
+def write_log(path, events):
+    with open(path, "w", encoding="utf-8") as f:
+        for event, time, fields in events:
+            f.write(json.dumps({"time": time, "level": "INFO", "logger": "executor", "event": event, "message": "", "fields": fields}) + "\n")
+
+
+def items(start_minute, count, seconds):
+    return [("item", f"2024-01-01T10:{start_minute:02d}:{i * seconds:02d}.000", {}) for i in range(count)]
+
+
+def test_runs_are_measured_separately(tmp_path):
+    path = str(tmp_path / "run.jsonl")
+    # two runs of 4 items, 2 and 4 seconds apart, with 20 minutes between them
+    write_log(
+        path,
+        [("run_start", "2024-01-01T10:00:00.000", {"events": {}})]
+        + items(0, 4, 2)
+        + [("run_start", "2024-01-01T10:20:00.000", {"events": {}})]
+        + items(20, 4, 4),
+    )
+    assert read_log_throughput(path)["seconds_per_item"] == pytest.approx(3.0)
+
+
+def test_long_gaps_split_logs_without_run_start(tmp_path):
+    path = str(tmp_path / "run.jsonl")
+    write_log(path, items(0, 3, 5) + items(30, 3, 5))
+    assert read_log_throughput(path)["seconds_per_item"] == pytest.approx(5.0)
+
+
+@pytest.mark.parametrize("options", [{"sample": 0.1}, {"level": "warning"}])
+def test_sampled_item_events_are_refused(tmp_path, options):
+    path = str(tmp_path / "run.jsonl")
+    write_log(path, [("run_start", "2024-01-01T10:00:00.000", {"events": {"item": options}})] + items(0, 4, 2))
+    with pytest.raises(ValueError, match="sampled or filtered"):
+        read_log_throughput(path)
@@ -0,0 +1,83 @@
+import time
+
+from data_handler import DataHandlerBase
+from work_queue import QueuedDataHandler, WorkQueue
+
+
+class ListDataHandler(DataHandlerBase):
+    def __init__(self, ids, **config):
+        super().__init__()
+        self.config = config
+        self.ids = ids
+        self.saved = {}
+
+    def get_model_name(self):
+        return "model"
+
+    def return_data_point(self, total=-1):
+        return [{"ID": id, "prompt": f"prompt {id}"} for id in self.ids]
+
+    def save_generated_data(self, content, index, filepath=None):
+        self.saved[index] = content
+
+
+def queue(path, worker_id, lease_seconds=0.2):
+    return WorkQueue(str(path / "queue.db"), lease_seconds=lease_seconds, worker_id=worker_id)
+
+
+def test_expired_lease_is_claimed_by_another_worker(tmp_path):
+    crashed, other = queue(tmp_path, "crashed"), queue(tmp_path, "other")
+    crashed.populate(["1", "2"])
+    assert crashed.claim(2) == ["1", "2"]
+    assert other.claim(2) == []
+
+    time.sleep(0.3)
+    assert other.claim(2) == ["1", "2"]
+    # the crashed worker lost its lease and can no longer commit
+    assert not crashed.complete("1", "late")
+    assert other.complete("1", "answer")
+    assert list(other.results()) == [("1", "answer")]
+
+
+def test_ids_out_of_attempts_are_not_claimed(tmp_path):
+    work_queue = WorkQueue(str(tmp_path / "queue.db"), lease_seconds=0.05, max_attempts=2)
+    work_queue.populate(["1"])
+    for _ in range(2):
+        assert work_queue.claim(1) == ["1"]
+        time.sleep(0.1)
+    assert work_queue.claim(1) == []
+    assert work_queue.counts()["failed"] == 1
+
+
+def test_heartbeat_keeps_long_items_leased(tmp_path):
+    path = str(tmp_path / "queue.db")
+    handler = QueuedDataHandler(
+        ListDataHandler(["1", "2"], work_queue_path=path, lease_seconds=0.3, claim_batch_size=2)
+    )
+    other = WorkQueue(path, lease_seconds=0.3, worker_id="other")
+    data_points = handler.return_data_point()
+    first = next(data_points)
+    # the item runs for several lease times
+    time.sleep(1)
+    assert other.claim(2) == []
+
+    handler.save_generated_data("answer", index=first["ID"])
+    second = next(data_points)
+    handler.save_generated_data("answer", index=second["ID"])
+    assert list(data_points) == []
+    assert [id for id, _ in other.results()] == ["1", "2"]
+
+
+def test_failed_items_are_reclaimed_after_the_lease(tmp_path):
+    path = str(tmp_path / "queue.db")
+    handler = QueuedDataHandler(
+        ListDataHandler(["1"], work_queue_path=path, lease_seconds=0.3, claim_batch_size=1)
+    )
+    other = WorkQueue(path, lease_seconds=0.3, worker_id="other")
+    data_points = handler.return_data_point()
+    data_point = next(data_points)
+    handler.release_data_points([data_point["ID"]])
+    time.sleep(0.5)
+    assert other.claim(1) == ["1"]
+    data_points.close()
+    assert not handler.heartbeat.thread
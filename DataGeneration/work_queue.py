@@ -0,0 +1,428 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+from data_handler import DataHandlerBase
+from event_log import log_event
+
+logger = logging.getLogger(__name__)
+
+statuses = ["pending", "leased", "done", "skipped"]
+
+
+class WorkQueue:
+    """
+    Work queue of prompt IDs in a SQLite database on a shared filesystem.
+
+    Workers claim batches of IDs with a lease that expires after
+    `lease_seconds`. IDs whose lease expired, because their worker crashed
+    or was stopped, are claimed again by the next worker. A result is only
+    committed by the worker that holds the lease, so an ID is answered once
+    even if workers join or leave during the run. Lease times use the wall
+    clock, so the clocks of the machines should roughly agree. An ID is
+    claimed at most `max_attempts` times.
+    """
+
+    def __init__(self, db_path, lease_seconds=600, worker_id=None, max_attempts=3) -> None:
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # autocommit mode, transactions are opened explicitly
+        self.connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS items (
+                id TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                response TEXT,
+                updated_at REAL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS items_claim ON items (status, lease_expires, position)"
+        )
+
+    @contextmanager
+    def transaction(self):
+        # IMMEDIATE takes the write lock up front, so two workers never claim the same rows
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.connection
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def populate(self, ids):
+        """
+        Add IDs to the queue. IDs that are already queued keep their state.
+        """
+        with self.transaction() as connection:
+            (offset,) = connection.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM items").fetchone()
+            connection.executemany(
+                "INSERT OR IGNORE INTO items (id, position) VALUES (?, ?)",
+                ((str(id), offset + i) for i, id in enumerate(ids)),
+            )
+
+    def claim(self, batch_size):
+        """
+        Lease up to batch_size pending or expired IDs to this worker.
+
+        Returns:
+            list: The claimed IDs, in queue order.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            ids = [
+                row[0]
+                for row in connection.execute(
+                    """SELECT id FROM items
+                    WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?))
+                    AND attempts < ?
+                    ORDER BY position LIMIT ?""",
+                    (now, self.max_attempts, batch_size),
+                )
+            ]
+            connection.executemany(
+                """UPDATE items SET status = 'leased', worker = ?, lease_expires = ?,
+                attempts = attempts + 1, updated_at = ? WHERE id = ?""",
+                ((self.worker_id, now + self.lease_seconds, now, id) for id in ids),
+            )
+        return ids
+
+    def renew(self, ids):
+        now = time.time()
+        with self.transaction() as connection:
+            connection.executemany(
+                """UPDATE items SET lease_expires = ?, updated_at = ?
+                WHERE id = ? AND status = 'leased' AND worker = ?""",
+                ((now + self.lease_seconds, now, str(id), self.worker_id) for id in ids),
+            )
+
+    def complete(self, id, response, status="done"):
+        """
+        Commit the result of a leased ID.
+
+        Returns:
+            bool: False if the lease was lost to another worker; the result is dropped then.
+        """
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                """UPDATE items SET status = ?, response = ?, lease_expires = NULL, updated_at = ?
+                WHERE id = ? AND status = 'leased' AND worker = ?""",
+                (status, response, time.time(), str(id), self.worker_id),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, ids):
+        """
+        Give the leases of unprocessed IDs back, e.g. when a worker stops early.
+        """
+        with self.transaction() as connection:
+            connection.executemany(
+                """UPDATE items SET status = 'pending', worker = NULL, lease_expires = NULL
+                WHERE id = ? AND status = 'leased' AND worker = ?""",
+                ((str(id), self.worker_id) for id in ids),
+            )
+
+    def next_expiry(self):
+        """
+        The earliest expiry of a lease that can still be claimed again, None if there is none.
+        """
+        (expiry,) = self.connection.execute(
+            "SELECT MIN(lease_expires) FROM items WHERE status = 'leased' AND attempts < ?",
+            (self.max_attempts,),
+        ).fetchone()
+        return expiry
+
+    def counts(self):
+        counts = dict.fromkeys(statuses + ["failed"], 0)
+        for status, count in self.connection.execute(
+            "SELECT status, COUNT(*) FROM items GROUP BY status"
+        ):
+            counts[status] = count
+        # out of attempts and not leased by a live worker
+        (counts["failed"],) = self.connection.execute(
+            """SELECT COUNT(*) FROM items WHERE attempts >= ?
+            AND (status = 'pending' OR (status = 'leased' AND lease_expires < ?))""",
+            (self.max_attempts, time.time()),
+        ).fetchone()
+        return counts
+
+    def workers(self):
+        return self.connection.execute(
+            """SELECT worker, COUNT(*), MAX(lease_expires) FROM items
+            WHERE status = 'leased' GROUP BY worker ORDER BY worker"""
+        ).fetchall()
+
+    def results(self):
+        return self.connection.execute(
+            "SELECT id, response FROM items WHERE status = 'done' ORDER BY position"
+        )
+
+    def close(self):
+        self.connection.close()
+
+
+class LeaseHeartbeat:
+    """
+    Renews the leases of the IDs a worker holds from a background thread,
+    every third of the lease time, so an item or batch that runs longer
+    than the lease keeps it. The thread uses its own connection.
+    """
+
+    def __init__(self, queue: WorkQueue) -> None:
+        self.queue = queue
+        self.interval = max(queue.lease_seconds / 3, 0.1)
+        self.ids = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def hold(self, ids):
+        with self.lock:
+            self.ids.update(str(id) for id in ids)
+
+    def drop(self, ids):
+        with self.lock:
+            self.ids.difference_update(str(id) for id in ids)
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __run(self):
+        queue = WorkQueue(
+            self.queue.db_path,
+            lease_seconds=self.queue.lease_seconds,
+            worker_id=self.queue.worker_id,
+            max_attempts=self.queue.max_attempts,
+        )
+        try:
+            while not self.stopped.wait(self.interval):
+                with self.lock:
+                    ids = list(self.ids)
+                if not ids:
+                    continue
+                try:
+                    queue.renew(ids)
+                except sqlite3.Error as e:
+                    # the next beat retries, the lease is still valid for two more intervals
+                    logger.warning(f"Lease renewal failed: {e}")
+        finally:
+            queue.close()
+
+
+class QueuedDataHandler(DataHandlerBase):
+    """
+    Wraps a data handler so that several workers can share its prompts.
+
+    The pending data points of the wrapped handler are added to the work
+    queue at `work_queue_path`, and this handler only yields the IDs it
+    holds a lease for. Responses are committed to the queue and written
+    into the storage of the wrapped handler with `python work_queue.py
+    export`, so CSV based storage is never written by two workers at once.
+    The leases of claimed IDs are renewed by a `LeaseHeartbeat` until they
+    are saved or released; the IDs of failed items are no longer renewed
+    and are claimed again once their lease expires.
+
+    Optional config keys: `lease_seconds` (default 600), `claim_batch_size`
+    (default 16), `max_attempts` (default 3) and `queue_poll_seconds`
+    (default 30), the longest wait for leases of other workers to expire.
+    """
+
+    def __init__(self, data_handler: DataHandlerBase):
+        super().__init__()
+        self.data_handler = data_handler
+        self.queue = WorkQueue(
+            data_handler.get_config_data("work_queue_path"),
+            lease_seconds=data_handler.get_config_data("lease_seconds", 600),
+            max_attempts=data_handler.get_config_data("max_attempts", 3),
+        )
+        self.batch_size = data_handler.get_config_data("claim_batch_size", 16)
+        self.poll_seconds = data_handler.get_config_data("queue_poll_seconds", 30)
+        self.heartbeat = LeaseHeartbeat(self.queue)
+
+    def get_model_name(self):
+        return self.data_handler.get_model_name()
+
+    def get_config_data(self, key, *default):
+        return self.data_handler.get_config_data(key, *default)
+
+    def add_save_hook(self, hook):
+        # the wrapped handler registers the prompts and keeps the data points for the hooks
+        self.data_handler.add_save_hook(hook)
+
+    def __claim(self):
+        """
+        Claim the next batch, waiting for leases of other workers to expire
+        while IDs are still leased. Returns an empty list when the queue is done.
+        """
+        while True:
+            ids = self.queue.claim(self.batch_size)
+            if ids:
+                return ids
+            expiry = self.queue.next_expiry()
+            if expiry is None:
+                return []
+            time.sleep(min(max(expiry - time.time(), 1), self.poll_seconds))
+
+    def return_data_point(self, total=-1):
+        data_points = {
+            str(data_point["ID"]): data_point
+            for data_point in self.data_handler.return_data_point()
+        }
+        self.queue.populate(data_points.keys())
+        print(f"Work queue: {self.queue.counts()}, worker: {self.queue.worker_id}")
+
+        count = 0
+        ids = []
+        reached = 0
+        self.heartbeat.start()
+        try:
+            while count != total:
+                ids = self.__claim()
+                reached = 0
+                if not ids:
+                    break
+                # the heartbeat keeps every claimed ID leased until it is saved or released
+                self.heartbeat.hold(ids)
+                for i, id in enumerate(ids):
+                    if count == total:
+                        break
+                    reached = i + 1
+                    if id not in data_points:
+                        # stored by the wrapped handler of this worker, but queued by another one
+                        self.heartbeat.drop([id])
+                        self.queue.complete(id, None, status="skipped")
+                        continue
+                    yield data_points[id]
+                    count += 1
+                # IDs that were not reached go back to the queue. Yielded IDs keep their
+                # lease until they are saved, the executor may still be working on them;
+                # if their item failed, they are claimed again once the lease expires.
+                self.__release(ids[reached:])
+                ids = []
+        finally:
+            self.__release(ids[reached:])
+            self.heartbeat.stop()
+
+    def __release(self, ids):
+        self.heartbeat.drop(ids)
+        self.queue.release(ids)
+
+    def release_data_points(self, indices):
+        # no longer renewed, so another worker claims them once the lease expires
+        self.heartbeat.drop(indices)
+
+    def save_generated_data(self, content, index, **kwargs):
+        self.heartbeat.drop([index])
+        if self.queue.complete(index, str(content)):
+            log_event(
+                logger,
+                logging.INFO,
+                "saved",
+                "Content committed to the work queue for index %s",
+                index,
+                index=index,
+            )
+            self.data_handler._run_save_hooks(content, index)
+        else:
+            log_event(
+                logger,
+                logging.WARNING,
+                "lease_lost",
+                "Lease lost for index %s, the response is dropped",
+                index,
+                index=index,
+            )
+
+
+def export_results(queue: WorkQueue, data_handler: DataHandlerBase):
+    """
+    Write the committed responses into the storage of a data handler.
+
+    Handlers with one file per ID are written through `save_generated_data`;
+    for the CSV based handlers the response column is updated once for all IDs.
+
+    Returns:
+        int: Number of exported responses.
+    """
+    results = list(queue.results())
+    storage_path = data_handler.get_config_data("storage_path", None)
+    if data_handler.get_config_data("storage_folder_path", None) is not None or storage_path is None:
+        for id, response in results:
+            data_handler.save_generated_data(response, index=id)
+        return len(results)
+
+    if os.path.exists(storage_path):
+        prompt_df = pd.read_csv(storage_path)
+    else:
+        os.makedirs(os.path.dirname(storage_path) or ".", exist_ok=True)
+        prompt_df = pd.read_csv(data_handler.get_config_data("prompt_data_path"))
+    prompt_df["response"] = prompt_df["response"].astype(object)
+    # the CSV handlers use the ID as the row index
+    for id, response in results:
+        prompt_df.at[int(id), "response"] = response
+    prompt_df.to_csv(storage_path, index=False)
+    return len(results)
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    status_parser = subparsers.add_parser("status", help="Show the state of a work queue")
+    status_parser.add_argument("--queue", type=str, required=True)
+    status_parser.add_argument("--max_attempts", type=int, default=3, help="max_attempts of the config")
+
+    export_parser = subparsers.add_parser(
+        "export", help="Write committed responses into the data handler storage"
+    )
+    export_parser.add_argument("--config", type=str, required=True)
+    export_parser.add_argument("--datahandler", type=str, default="template")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    if args.command == "status":
+        queue = WorkQueue(args.queue, max_attempts=args.max_attempts)
+        counts = queue.counts()
+        # failed IDs are also counted as pending or leased, they are finished since they are out of attempts
+        total = sum(counts[status] for status in statuses)
+        finished = counts["done"] + counts["skipped"] + counts["failed"]
+        for status, count in counts.items():
+            print(f"{status:<10} {count:>10}")
+        if total:
+            print(f"{'progress':<10} {100 * finished / total:>9.1f}%")
+        for worker, leased, expires in queue.workers():
+            print(f"{worker}: {leased} leased, lease expires in {expires - time.time():.0f}s")
+    else:
+        from executor import create_data_handler
+
+        data_handler = create_data_handler(args.datahandler, args.config)
+        queue = WorkQueue(data_handler.get_config_data("work_queue_path"))
+        count = export_results(queue, data_handler)
+        print(f"Exported {count} responses")
@@ -0,0 +1,106 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+
+def scan_storage(storage_path):
+    """
+    Enumerate the per-ID folders of a storage tree with a single directory scan.
+
+    Returns:
+        dict: folder name (the data point ID) -> folder path
+    """
+    folders = {}
+    with os.scandir(storage_path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                folders[entry.name] = entry.path
+    return folders
+
+
+def read_response_file(path):
+    try:
+        with open(path, "r", encoding="utf-8") as response_file:
+            return response_file.read()
+    except FileNotFoundError:
+        return None
+
+
+def read_responses(folders, model_name, workers):
+    ids = list(folders.keys())
+    paths = [os.path.join(folders[i], f"{model_name}_response.txt") for i in ids]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        responses = list(executor.map(read_response_file, paths, chunksize=256))
+    return pd.DataFrame({"ID": ids, "response": responses})
+
+
+def save_table(df, output_path):
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    if output_path.endswith(".parquet"):
+        df.to_parquet(output_path, index=False)
+    else:
+        df.to_csv(output_path, index=False)
+
+
+def collate(prompt_path, storage_path, model_names, output_template, workers=32):
+    """
+    Join the per-ID response files of a storage tree to the prompt table.
+
+    One result table is written per model. A prompt whose ID folder or
+    response file does not exist gets an empty response and is reported as
+    missing at the end.
+    """
+    prompt_df = pd.read_csv(prompt_path)
+    prompt_ids = prompt_df["ID"].astype(str)
+    folders = scan_storage(storage_path)
+    print(f"Prompts: {len(prompt_df)}, storage folders: {len(folders)}")
+
+    missing_folders = prompt_ids[~prompt_ids.isin(folders.keys())]
+
+    report = {}
+    for model_name in model_names:
+        responses = read_responses(folders, model_name, workers)
+        merged = prompt_df.assign(ID_key=prompt_ids).merge(
+            responses.rename(columns={"ID": "ID_key"}), on="ID_key", how="left"
+        )
+        has_folder = merged["ID_key"].isin(folders.keys())
+        missing_responses = merged.loc[merged["response"].isna() & has_folder, "ID"]
+        merged["response"] = merged["response"].fillna("")
+        merged = merged.drop(columns=["ID_key"])
+
+        output_path = output_template.format(model=model_name)
+        save_table(merged, output_path)
+        print(f"Saved {len(merged)} rows for {model_name} to {output_path}")
+        report[model_name] = missing_responses.tolist()
+
+    print(f"\nIDs without a storage folder: {len(missing_folders)}")
+    if len(missing_folders):
+        print(", ".join(missing_folders.tolist()))
+    for model_name, missing_ids in report.items():
+        print(f"IDs with a folder but without a {model_name} response: {len(missing_ids)}")
+        if missing_ids:
+            print(", ".join(str(i) for i in missing_ids))
+    return report
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=str, default="../Data/religion_prompts.csv")
+    parser.add_argument("--storage", type=str, default="../Data/Storage_llama3_religion")
+    parser.add_argument("--model_name", type=str, nargs="+", default=["meta_llama"])
+    parser.add_argument(
+        "--output",
+        type=str,
+        default="../Data/religion_templates_{model}.parquet",
+        help="Output path, {model} is replaced by the model name. Use .csv for CSV output.",
+    )
+    parser.add_argument("--workers", type=int, default=32)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    collate(args.prompts, args.storage, args.model_name, args.output, args.workers)
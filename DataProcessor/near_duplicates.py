@@ -0,0 +1,171 @@
+import re
+import zlib
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from normalizer import normalize
+
+mersenne_prime = np.uint64((1 << 61) - 1)
+max_hash = np.uint64((1 << 32) - 1)
+
+punctuation_pattern = re.compile(r"[।,!?\"'“”‘’()\-:;.]")
+
+
+@lru_cache(maxsize=None)
+def normalize_cached(text):
+    return normalize(text)
+
+
+def shingles(text, size=2):
+    """
+    Word n-grams of the normalized sentence. Sentences shorter than `size`
+    words fall back to their single words.
+    """
+    tokens = punctuation_pattern.sub(" ", normalize_cached(str(text))).split()
+    if len(tokens) < size:
+        return set(tokens)
+    return {" ".join(tokens[i : i + size]) for i in range(len(tokens) - size + 1)}
+
+
+def choose_bands(num_perm, threshold):
+    """
+    Pick the (bands, rows) split whose LSH threshold (1 / bands) ** (1 / rows)
+    is closest to the requested Jaccard threshold.
+    """
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class MinHashLSH:
+    """
+    MinHash signatures over sentence shingles with banded LSH.
+
+    Signatures are computed in one vectorized pass per sentence and candidate
+    pairs only come from shared LSH buckets, so clustering is roughly linear
+    in the number of sentences instead of quadratic.
+    """
+
+    def __init__(self, num_perm=128, threshold=0.8, shingle_size=2, seed=1) -> None:
+        self.num_perm = num_perm
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.bands, self.rows = choose_bands(num_perm, threshold)
+
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, int(mersenne_prime), size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, int(mersenne_prime), size=num_perm, dtype=np.uint64)
+
+    def signature(self, text):
+        hashes = np.array(
+            [zlib.crc32(s.encode("utf-8")) for s in shingles(text, self.shingle_size)],
+            dtype=np.uint64,
+        )
+        if len(hashes) == 0:
+            return np.full(self.num_perm, max_hash, dtype=np.uint64)
+        # uint64 overflow is intended here, as in the usual MinHash implementations
+        with np.errstate(over="ignore"):
+            permuted = (np.outer(hashes, self.a) + self.b) % mersenne_prime
+        return np.bitwise_and(permuted, max_hash).min(axis=0)
+
+    def signatures(self, texts):
+        return np.vstack([self.signature(text) for text in texts])
+
+    def cluster(self, texts):
+        """
+        Group near-duplicate sentences.
+
+        Returns:
+            np.ndarray: cluster id per sentence; the id is the position of the
+            first sentence of the cluster.
+        """
+        signatures = self.signatures(texts)
+        parent = np.arange(len(signatures))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for band in range(self.bands):
+            band_rows = signatures[:, band * self.rows : (band + 1) * self.rows]
+            buckets = {}
+            for i, key in enumerate(map(bytes, band_rows)):
+                if key not in buckets:
+                    buckets[key] = i
+                    continue
+                first = buckets[key]
+                root_first, root_i = find(first), find(i)
+                if root_first == root_i:
+                    continue
+                # verify the candidate with the estimated Jaccard similarity
+                similarity = np.mean(signatures[first] == signatures[i])
+                if similarity >= self.threshold:
+                    parent[max(root_first, root_i)] = min(root_first, root_i)
+
+        return np.array([find(i) for i in range(len(signatures))])
+
+
+def near_duplicate_report(df, column, threshold=0.8, num_perm=128, shingle_size=2):
+    """
+    Add `cluster_id`, `cluster_size` and `is_representative` columns to a copy of df.
+    The first sentence of every cluster is its representative.
+    """
+    lsh = MinHashLSH(num_perm=num_perm, threshold=threshold, shingle_size=shingle_size)
+    clusters = lsh.cluster(df[column].tolist())
+    report = df.copy()
+    report["cluster_id"] = clusters
+    report["cluster_size"] = report.groupby("cluster_id")["cluster_id"].transform("size")
+    report["is_representative"] = clusters == np.arange(len(clusters))
+    return report
+
+
+def drop_near_duplicates(df, column, threshold=0.8, **kwargs):
+    report = near_duplicate_report(df, column, threshold, **kwargs)
+    return df[report["is_representative"].to_numpy()]
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, required=True)
+    parser.add_argument("--column", type=str, default="text")
+    parser.add_argument("--threshold", type=float, default=0.8)
+    parser.add_argument("--num_perm", type=int, default=128)
+    parser.add_argument("--shingle_size", type=int, default=2)
+    parser.add_argument("--report", type=str, default=None, help="csv with cluster columns")
+    parser.add_argument("--filtered", type=str, default=None, help="csv without near-duplicates")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    df = pd.read_csv(args.input)
+    report = near_duplicate_report(
+        df, args.column, args.threshold, args.num_perm, args.shingle_size
+    )
+
+    duplicated = report[report["cluster_size"] > 1]
+    print(f"Sentences: {len(report)}, clusters: {report['cluster_id'].nunique()}")
+    print(
+        f"Sentences in near-duplicate clusters: {len(duplicated)}, "
+        f"removable: {int((~report['is_representative']).sum())}"
+    )
+    for column in ["explicitGender", "explicitReligion", "category"]:
+        if column in report.columns:
+            print(f"\nRemovable by {column}:")
+            print(report.loc[~report["is_representative"], column].value_counts().to_string())
+
+    if args.report:
+        report.to_csv(args.report, index=False)
+    if args.filtered:
+        df[report["is_representative"].to_numpy()].to_csv(args.filtered, index=False)
@@ -0,0 +1,224 @@
+import os
+
+import numpy as np
+import pandas as pd
+import yaml
+from normalizer import normalize
+
+
+def read_prompt_templates(template_path):
+    with open(template_path, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f)
+
+
+def read_adjectives(adjective_path):
+    """
+    Read the adjective list and normalize every distinct word once.
+    """
+    df = pd.read_csv(adjective_path)
+    unique_words = df["Word"].dropna().unique()
+    normalized_words = {word: normalize(word) for word in unique_words}
+    df["Word"] = df["Word"].map(normalized_words)
+    return df
+
+
+def fill_template(template, columns):
+    """
+    Fill every %s of a template with the matching column, for all rows at once.
+    """
+    parts = template.split("%s")
+    if len(parts) != len(columns) + 1:
+        raise ValueError(
+            f"Template expects {len(parts) - 1} values, got {len(columns)}"
+        )
+    text = parts[0] + columns[0].astype(str)
+    for column, part in zip(columns[1:], parts[1:-1]):
+        text = text + part + column.astype(str)
+    return text + parts[-1]
+
+
+class TemplatePromptGenerator:
+    """
+    Builds template based prompts for a topic from the adjective list.
+
+    Prompts are first enumerated as integer coordinates (block, trait,
+    occupation, noun order), which are shuffled with a seeded generator. The
+    text is only formatted, block by block with vectorized string operations,
+    when a chunk is written. The generated dataset therefore only depends on
+    the adjective list, the templates and the seed.
+    """
+
+    def __init__(self, adjective_df, prompt_templates):
+        self.adjective_df = adjective_df
+        self.templates = prompt_templates["templates"]
+        self.nouns = prompt_templates["nouns"]
+        self.topics = prompt_templates["topics"]
+        self.occupation_category = prompt_templates["occupation_category"]
+
+    def __traits(self, topic, category):
+        df = self.adjective_df
+        if category == self.occupation_category:
+            traits = df.loc[df["Category"] == category]
+        else:
+            traits = df.loc[(df["Topic"] == topic) & (df["Category"] == category)]
+        return traits.reset_index(drop=True)
+
+    def __blocks(self, topic_name):
+        topic_config = self.topics[topic_name]
+        occupations = self.__traits(topic_config["topic"], self.occupation_category)
+        blocks = []
+        for noun_pair in self.nouns[topic_name]:
+            for block in topic_config["blocks"]:
+                traits = self.__traits(topic_config["topic"], block["category"])
+                blocks.append(
+                    {
+                        "template": block["template"],
+                        "category": block["category"],
+                        "noun_pair": noun_pair,
+                        "traits": traits,
+                        "occupations": occupations if block.get("occupation") else None,
+                    }
+                )
+        return blocks
+
+    def build_index(self, topic_name, seed):
+        """
+        Enumerate all prompts of a topic as shuffled integer coordinates.
+
+        Returns:
+            tuple: (blocks, index DataFrame with block, trait, occupation and swap columns)
+        """
+        blocks = self.__blocks(topic_name)
+        rng = np.random.default_rng(seed)
+
+        indexes = []
+        for block_id, block in enumerate(blocks):
+            num_traits = len(block["traits"])
+            if block["occupations"] is None:
+                trait = np.arange(num_traits)
+                occupation = np.full(num_traits, -1)
+            else:
+                # occupation major, same order as iterating occupations then traits
+                num_occupations = len(block["occupations"])
+                occupation = np.repeat(np.arange(num_occupations), num_traits)
+                trait = np.tile(np.arange(num_traits), num_occupations)
+            indexes.append(
+                pd.DataFrame(
+                    {
+                        "block": block_id,
+                        "trait": trait,
+                        "occupation": occupation,
+                    }
+                )
+            )
+        index = pd.concat(indexes, ignore_index=True)
+        index["swap"] = rng.random(len(index)) < 0.5
+        index = index.iloc[rng.permutation(len(index))].reset_index(drop=True)
+        return blocks, index
+
+    def __format_block(self, block, index):
+        traits = block["traits"].iloc[index["trait"].to_numpy()].reset_index(drop=True)
+        first, second = block["noun_pair"]
+        swap = index["swap"].to_numpy()
+        first_noun = pd.Series(np.where(swap, second, first))
+        second_noun = pd.Series(np.where(swap, first, second))
+
+        if block["occupations"] is None:
+            columns = [first_noun, second_noun, traits["Word"]]
+            category = block["category"]
+            subcategory = traits["Subcategory"]
+            topic = traits["Topic"]
+        else:
+            occupations = (
+                block["occupations"]
+                .iloc[index["occupation"].to_numpy()]
+                .reset_index(drop=True)
+            )
+            columns = [first_noun, second_noun, occupations["Word"], traits["Word"]]
+            category = f"{self.occupation_category}+{block['category']}"
+            subcategory = occupations["Subcategory"].fillna(traits["Subcategory"])
+            topic = occupations["Topic"].fillna(traits["Topic"])
+
+        prompts = pd.DataFrame(
+            {
+                "text": fill_template(self.templates[block["template"]], columns),
+                "category": category,
+                "subcategory": subcategory,
+                "topic": topic,
+                "template": block["template"],
+                "noun_pair": "/".join(block["noun_pair"]),
+            }
+        )
+        prompts.index = index.index
+        return prompts
+
+    def iter_chunks(self, topic_name, seed=42, chunk_size=50000):
+        """
+        Yield the shuffled prompts of a topic as DataFrames of at most chunk_size rows.
+        The DataFrame index is the prompt ID.
+        """
+        blocks, index = self.build_index(topic_name, seed)
+        for start in range(0, len(index), chunk_size):
+            chunk_index = index.iloc[start : start + chunk_size]
+            parts = [
+                self.__format_block(blocks[block_id], block_index)
+                for block_id, block_index in chunk_index.groupby("block", sort=False)
+            ]
+            yield pd.concat(parts).sort_index()
+
+
+def write_prompts(chunks, output_path):
+    """
+    Stream prompt chunks to a CSV or Parquet file and return the number of rows.
+    """
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    total = 0
+    writer = None
+    for i, chunk in enumerate(chunks):
+        chunk = chunk.rename_axis("ID")
+        if output_path.endswith(".parquet"):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(chunk.reset_index(), preserve_index=False)
+            if writer is None:
+                # columns that are empty in the first chunk are typed as strings
+                schema = pa.schema(
+                    [
+                        (field.name, pa.string() if pa.types.is_null(field.type) else field.type)
+                        for field in table.schema
+                    ]
+                )
+                writer = pq.ParquetWriter(output_path, schema)
+            writer.write_table(table.cast(writer.schema))
+        else:
+            chunk.to_csv(output_path, mode="w" if i == 0 else "a", header=i == 0)
+        total += len(chunk)
+    if writer is not None:
+        writer.close()
+    return total
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--adjectives", type=str, default="../Data/AdjectiveWordsForBias.csv")
+    parser.add_argument("--templates", type=str, default="prompt_templates.yaml")
+    parser.add_argument("--topic", type=str, default="gender", choices=["gender", "religion"])
+    parser.add_argument("--output", type=str, default="../Data/gender_prompts.csv")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--chunk_size", type=int, default=50000)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    generator = TemplatePromptGenerator(
+        read_adjectives(args.adjectives), read_prompt_templates(args.templates)
+    )
+    total = write_prompts(
+        generator.iter_chunks(args.topic, seed=args.seed, chunk_size=args.chunk_size),
+        args.output,
+    )
+    print(f"Saved {total} {args.topic} prompts to {args.output}")
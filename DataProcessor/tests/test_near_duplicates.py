@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from near_duplicates import MinHashLSH, choose_bands, drop_near_duplicates, near_duplicate_report, shingles
+
+sentences = [
+    "আমার বন্ধু একজন ভালো ডাক্তার এবং সে সবাইকে সাহায্য করে",
+    "আমার বন্ধু একজন ভালো ডাক্তার এবং সে সবাইকে সাহায্য করে।",
+    "আমার বন্ধু একজন ভালো ডাক্তার এবং সে সবাইকে অনেক সাহায্য করে",
+    "গ্রামের মানুষ সকালে মাঠে কাজ করতে যায়",
+    "শহরের রাস্তায় আজ অনেক ভিড় ছিল",
+]
+
+
+def jaccard(first, second):
+    return len(first & second) / len(first | second)
+
+
+def test_shingles_ignore_punctuation():
+    assert shingles("আমি, ভাত খাই।") == {"আমি ভাত", "ভাত খাই"}
+    assert shingles("আমি") == {"আমি"}
+    assert shingles("") == set()
+
+
+def test_choose_bands_splits_all_permutations():
+    for threshold in [0.5, 0.8, 0.9]:
+        bands, rows = choose_bands(128, threshold)
+        assert bands * rows == 128
+        assert abs((1 / bands) ** (1 / rows) - threshold) < 0.1
+
+
+def test_signature_agreement_estimates_jaccard():
+    lsh = MinHashLSH(num_perm=256)
+    for first, second in [(0, 2), (0, 3), (3, 4)]:
+        expected = jaccard(shingles(sentences[first]), shingles(sentences[second]))
+        estimated = np.mean(lsh.signature(sentences[first]) == lsh.signature(sentences[second]))
+        assert abs(estimated - expected) < 0.1
+
+
+def test_cluster_ids_are_the_first_sentence():
+    clusters = MinHashLSH(threshold=0.8).cluster(sentences)
+    # 0 and 1 only differ in punctuation; 2 shares too few bigrams at 0.8
+    assert clusters.tolist() == [0, 0, 2, 3, 4]
+    assert MinHashLSH(threshold=0.5).cluster(sentences).tolist() == [0, 0, 0, 3, 4]
+
+
+def test_drop_near_duplicates_keeps_the_representatives():
+    df = pd.DataFrame({"text": sentences})
+    report = near_duplicate_report(df, "text", threshold=0.8)
+    assert report["cluster_size"].tolist() == [2, 2, 1, 1, 1]
+    assert drop_near_duplicates(df, "text", threshold=0.8)["text"].tolist() == [
+        sentences[0],
+        sentences[2],
+        sentences[3],
+        sentences[4],
+    ]
@@ -0,0 +1,225 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+import numpy as np
+import seaborn as sns
+import yaml
+
+# bump this when the drawing code changes so that cached figures are re-rendered
+renderer_version = 1
+
+sort_order = {
+    "Communal": 3,
+    "Communal+Occupation": 7,
+    "Outlook+Occupation": 6,
+    "Personality+Occupation": 4,
+    "Outlook": 2,
+    "Personality": 1,
+    "Ideology+Occupation": 5,
+    "Ideology": 0,
+}
+
+# Colors for each model, as indices into the seaborn "muted" palette
+model_color_index = {
+    "GPT - 3.5": 0,  # Blue
+    "GPT - 4o": 2,  # Red
+    "Llama - 3": 3,  # Green
+}
+
+
+def read_specs(spec_path):
+    with open(spec_path, "r") as f:
+        specs = yaml.safe_load(f)
+
+    base_folder = os.path.dirname(os.path.abspath(spec_path))
+    output_folder = os.path.normpath(
+        os.path.join(base_folder, specs.get("output_folder", "../Figures"))
+    )
+    formats = specs.get("formats", ["png"])
+    figures = []
+    for figure in specs["figures"]:
+        figure = dict(figure)
+        if "inputs" in figure:
+            figure["input_paths"] = {
+                model: os.path.join(base_folder, path) for model, path in figure["inputs"].items()
+            }
+        else:
+            figure["input_paths"] = {None: os.path.join(base_folder, figure["input"])}
+        figure.setdefault("formats", formats)
+        figures.append(figure)
+    return output_folder, figures
+
+
+def read_json(path, json_cache):
+    if path not in json_cache:
+        with open(path, "r") as f:
+            json_cache[path] = json.load(f)
+    return json_cache[path]
+
+
+def read_slice(figure, json_cache):
+    """
+    Return the {model: {category: DI}} slice used by a figure: either one
+    {category: DI} file per model (`inputs`, as FileAnalysis.ipynb writes
+    them) or a single {model: {category: DI}} file (`input`), optionally
+    nested under `key`.
+    """
+    if "inputs" in figure:
+        return {model: read_json(path, json_cache) for model, path in figure["input_paths"].items()}
+    data = read_json(figure["input_paths"][None], json_cache)
+
+    key = figure.get("key")
+    if key is None:
+        return data
+    return {model: data[model][key] for model in data}
+
+
+def figure_hash(figure, data_slice):
+    spec = {k: v for k, v in figure.items() if k != "input_paths"}
+    content = json.dumps(
+        {"version": renderer_version, "spec": spec, "data": data_slice},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def output_paths(figure, output_folder):
+    return [
+        os.path.join(output_folder, f"{figure['name']}.{extension}")
+        for extension in figure["formats"]
+    ]
+
+
+def render_figure(figure, data_slice, output_folder):
+    sns.set(style="whitegrid")
+    palette = sns.color_palette("muted")
+
+    models = list(data_slice.keys())
+    categories = list(set().union(*(data_slice[model].keys() for model in models)))
+    if figure.get("sort") == "template":
+        categories.sort(key=lambda x: sort_order.get(x, float("inf")))
+    else:
+        categories.sort()
+
+    fig, ax = plt.subplots(figsize=tuple(figure["figsize"]))
+
+    # Define the width of a single bar
+    bar_width = 0.2
+
+    # Create positions for the groups
+    num_models = len(models)
+    positions = np.arange(len(categories)) * (bar_width * (num_models + 1))
+
+    for i, model in enumerate(models):
+        # Filter out None values
+        filtered_values = {k: v for k, v in data_slice[model].items() if v is not None}
+        heights = [filtered_values.get(cat, 0) for cat in categories]
+
+        ax.bar(
+            positions + i * bar_width,
+            heights,
+            bar_width,
+            label=model,
+            color=palette[model_color_index.get(model, i)],
+            edgecolor="black",  # Add borders
+        )
+
+    ax.set_ylabel("DI score", fontsize=figure["label_fontsize"], fontweight="bold")
+    ax.set_ylim(0, figure["ylim"])
+    ax.set_xticks(positions + (num_models - 1) * bar_width / 2)
+    ax.set_xticklabels(
+        categories, rotation=30, ha="right", fontsize=figure["tick_fontsize"]
+    )
+    ax.legend(
+        loc="upper center",
+        bbox_to_anchor=(0.5, 1.15),
+        fontsize=figure["legend_fontsize"],
+        ncol=num_models,
+        frameon=True,
+    )
+
+    # Remove vertical gridlines and keep horizontal gridlines
+    ax.grid(axis="y", linestyle="--", linewidth=0.7)
+    ax.grid(axis="x", visible=False)
+
+    # Make the horizontal line at y=1 bold
+    ax.axhline(y=1, color="cyan", linewidth=2)
+
+    plt.tight_layout()
+    paths = output_paths(figure, output_folder)
+    for path in paths:
+        fig.savefig(path, bbox_inches="tight")
+    plt.close(fig)
+    return figure["name"], paths
+
+
+def render_all(spec_path, workers=1, force=False, only=None):
+    output_folder, figures = read_specs(spec_path)
+    os.makedirs(output_folder, exist_ok=True)
+
+    cache_path = os.path.join(output_folder, ".figure_cache.json")
+    cache = {}
+    if os.path.exists(cache_path) and not force:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+
+    json_cache = {}
+    jobs = []
+    for figure in figures:
+        if only and figure["name"] not in only:
+            continue
+        missing = [path for path in figure["input_paths"].values() if not os.path.exists(path)]
+        if missing:
+            print(f"Skipping {figure['name']}: input not found {', '.join(missing)}")
+            continue
+        data_slice = read_slice(figure, json_cache)
+        digest = figure_hash(figure, data_slice)
+        is_rendered = all(os.path.exists(p) for p in output_paths(figure, output_folder))
+        if cache.get(figure["name"]) == digest and is_rendered:
+            print(f"Up to date: {figure['name']}")
+            continue
+        jobs.append((figure, data_slice, digest))
+
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(render_figure, figure, data_slice, output_folder)
+                for figure, data_slice, _ in jobs
+            ]
+            results = [future.result() for future in futures]
+    else:
+        results = [
+            render_figure(figure, data_slice, output_folder)
+            for figure, data_slice, _ in jobs
+        ]
+
+    for (figure, _, digest), (name, paths) in zip(jobs, results):
+        cache[name] = digest
+        print(f"Rendered {name}: {', '.join(paths)}")
+
+    with open(cache_path, "w") as f:
+        json.dump(cache, f, indent=4, sort_keys=True)
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--specs", type=str, default="figure_specs.yaml")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--only", type=str, nargs="*", default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    render_all(args.specs, workers=args.workers, force=args.force, only=args.only)